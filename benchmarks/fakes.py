@@ -0,0 +1,69 @@
+"""Offline Telegram: a bot session that answers every API call locally, and
+builders for the updates the handlers receive."""
+from datetime import datetime
+from itertools import count
+from typing import Any, AsyncGenerator, Optional
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import TelegramMethod
+from aiogram.types import CallbackQuery, Chat, Message, Update, User
+
+_ids = count(1)
+
+
+def _message(chat_id: int, text: Optional[str] = None, user: Optional[User] = None) -> Message:
+        return Message(
+                message_id=next(_ids),
+                date=datetime.now(),
+                chat=Chat(id=chat_id, type="private"),
+                from_user=user,
+                text=text,
+        )
+
+
+class FakeSession(BaseSession):
+        """Answers API calls without a network: methods returning a Message get a
+        stub message, everything else gets True. Calls are counted per method."""
+
+        def __init__(self) -> None:
+                super().__init__()
+                self.calls: dict = {}
+
+        async def make_request(self, bot: Bot, method: TelegramMethod, timeout: Optional[int] = None) -> Any:
+                name = type(method).__name__
+                self.calls[name] = self.calls.get(name, 0) + 1
+                if method.__returning__ is Message:
+                        return _message(getattr(method, "chat_id", 0) or 0, getattr(method, "text", None))
+                return True
+
+        async def stream_content(self, url: str, headers: Optional[dict] = None, timeout: int = 30,
+                                 chunk_size: int = 65536, raise_for_status: bool = True) -> AsyncGenerator[bytes, None]:
+                yield b""
+
+        async def close(self) -> None:
+                pass
+
+
+def fake_bot() -> Bot:
+        return Bot(token="123456:BENCHMARK", session=FakeSession())
+
+
+def _user(user_id: int) -> User:
+        return User(id=user_id, is_bot=False, first_name="Bench", username=f"bench{user_id}")
+
+
+def message_update(user_id: int, text: str) -> Update:
+        return Update(update_id=next(_ids), message=_message(user_id, text, _user(user_id)))
+
+
+def callback_update(user_id: int, data: str) -> Update:
+        return Update(
+                update_id=next(_ids),
+                callback_query=CallbackQuery(
+                        id=str(next(_ids)),
+                        from_user=_user(user_id),
+                        chat_instance="bench",
+                        message=_message(user_id, "menu", _user(user_id)),
+                        data=data,
+                ),
+        )
@@ -0,0 +1,409 @@
+"""End-to-end load test: simulated users against the real bot process.
+
+The bot runs unmodified (``python -m bot.main``) with its Telegram and Crypto
+Pay endpoints pointed at local stand-ins (:mod:`benchmarks.servers`). Every
+simulated user goes through browse -> pick -> promo -> pay -> confirm by
+clicking the buttons the bot actually sent, so contention for the same
+numbers, throttling and the Crypto Pay budget all behave as in production.
+
+        python -m benchmarks.loadtest --users 2000 --numbers 5000 --ramp 30 --out campaign.json
+
+Reported: latency per step and for the whole checkout, throughput, outcome
+and error counts, and double bookings (a number rented to two users, checked
+in the final state after the bot has flushed it).
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import signal
+import socket
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+import aiohttp
+from aiohttp import web
+
+from benchmarks.servers import Chat, FakeCryptoPay, FakeTelegram, make_app
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+BOT_TOKEN = "123456:LOADTEST"
+PROMO_CODE = "BENCH10"
+# Bot metrics copied into the report
+BOT_METRICS = (
+        "bot_handler_errors_total",
+        "bot_throttled_updates_total",
+        "bot_crypto_pay_budget_total",
+        "bot_crypto_pay_errors_total",
+        "bot_background_errors_total",
+)
+
+
+def _buttons(event: Optional[Dict[str, Any]]) -> List[Tuple[str, str]]:
+        markup = (event or {}).get("reply_markup") or {}
+        return [(b.get("text", ""), b.get("callback_data", "")) for row in markup.get("inline_keyboard", []) for b in row]
+
+
+def _has_button(prefix: str):
+        return lambda event: any(data.startswith(prefix) for _, data in _buttons(event))
+
+
+def _percentiles(samples: List[float]) -> Dict[str, float]:
+        samples = sorted(samples)
+        n = len(samples)
+        if not n:
+                return {"n": 0}
+        pick = lambda q: round(samples[min(n - 1, int(n * q))] * 1000, 1)
+        return {"n": n, "p50_ms": pick(0.5), "p95_ms": pick(0.95), "p99_ms": pick(0.99), "max_ms": round(samples[-1] * 1000, 1)}
+
+
+class Run:
+        """Shared counters for one load test."""
+
+        def __init__(self, args: argparse.Namespace, telegram: FakeTelegram, crypto: FakeCryptoPay):
+                self.args = args
+                self.telegram = telegram
+                self.crypto = crypto
+                self.latency: Dict[str, List[float]] = defaultdict(list)
+                self.outcomes: Counter = Counter()
+                self.alerts: Counter = Counter()
+                self.timeouts: Counter = Counter()
+                self.contention = 0
+                self.updates = 0
+                # number -> users told "арендован до"
+                self.confirmed: Dict[str, set] = defaultdict(set)
+
+
+class VirtualUser:
+        def __init__(self, run: Run, user_id: int):
+                self.run = run
+                self.user_id = user_id
+                self.chat: Chat = run.telegram.chat(user_id)
+                self.rnd = random.Random(user_id)
+
+        async def _think(self) -> None:
+                if self.run.args.think:
+                        await asyncio.sleep(self.rnd.uniform(0.5, 1.5) * self.run.args.think)
+
+        async def _send(self, step: str, text: str, predicate) -> Optional[Dict[str, Any]]:
+                since = len(self.chat.events)
+                started = time.monotonic()
+                self.run.updates += 1
+                self.run.telegram.send_text(self.user_id, text)
+                event = await self.chat.wait(since, predicate, self.run.args.timeout)
+                if event is None:
+                        self.run.timeouts[step] += 1
+                else:
+                        self.run.latency[step].append(time.monotonic() - started)
+                return event
+
+        async def _press(self, step: str, message_id: int, data: str) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+                """Click a button; returns (callback answer, last message the bot sent or edited meanwhile)."""
+                since = len(self.chat.events)
+                started = time.monotonic()
+                self.run.updates += 1
+                callback_id = self.run.telegram.press(self.user_id, message_id, data)
+                answer = await self.chat.wait(
+                        since,
+                        lambda e: e["method"] == "answerCallbackQuery" and e.get("callback_query_id") == callback_id,
+                        self.run.args.timeout,
+                )
+                if answer is None:
+                        self.run.timeouts[step] += 1
+                        return None, None
+                self.run.latency[step].append(time.monotonic() - started)
+                if answer.get("text"):
+                        self.run.alerts[answer["text"]] += 1
+                screens = [e for e in self.chat.events[since:] if e["method"] != "answerCallbackQuery"]
+                return answer, (screens[-1] if screens else None)
+
+        def _settled(self, since: int) -> Optional[str]:
+                """Outcome announced in the chat (by the "Я оплатил" handler or the reconciler)."""
+                for event in self.chat.events[since:]:
+                        text = event.get("text") or ""
+                        if "Оплата подтверждена" in text:
+                                return "completed"
+                        if "уже занят" in text and "Оплата получена" in text:
+                                return "conflict"
+                return None
+
+        async def _pick(self, screen: Dict[str, Any]) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+                """Pick a free number from the page, retrying on taken ones. Returns (number, duration screen)."""
+                failed = set()
+                for _ in range(self.run.args.retries):
+                        free = [data for text, data in _buttons(screen) if data.startswith("num:") and data not in failed and "🟢" in text]
+                        if not free:
+                                pages = [data for text, data in _buttons(screen) if text.startswith("Далее")]
+                                if not pages:
+                                        return None, None
+                                answer, screen = await self._press("page", screen["message_id"], pages[0])
+                                if screen is None:
+                                        return None, None
+                                continue
+                        choice = self.rnd.choice(free)
+                        answer, next_screen = await self._press("pick", screen["message_id"], choice)
+                        if answer is None:
+                                return None, None
+                        if _has_button("dur:")(next_screen):
+                                return choice[4:], next_screen
+                        self.run.contention += 1
+                        failed.add(choice)
+                        if next_screen is not None:
+                                screen = next_screen
+                        await self._think()
+                return None, None
+
+        async def _checkout(self, screen: Dict[str, Any]) -> Tuple[str, Optional[Dict[str, Any]]]:
+                """From the page to an invoice. Returns (outcome, invoice message)."""
+                number, screen = await self._pick(screen)
+                if number is None:
+                        return "no_free_number", None
+                await self._think()
+                months = self.rnd.choice([data for _, data in _buttons(screen) if data.startswith("dur:")])
+                answer, screen = await self._press("duration", screen["message_id"], months)
+                if not _has_button("skip_promo")(screen):
+                        return "error", None
+                await self._think()
+                if self.rnd.random() < self.run.args.promo_rate:
+                        await self._press("enter_promo", screen["message_id"], "enter_promo")
+                        await self._think()
+                        invoice = await self._send("promo_invoice", PROMO_CODE, lambda e: _has_button("paid:")(e) or (e.get("text") or "").startswith("❌"))
+                        answer = None
+                else:
+                        answer, invoice = await self._press("invoice", screen["message_id"], "skip_promo")
+                if _has_button("paid:")(invoice):
+                        return "invoice", invoice
+                text = ((answer or {}).get("text") or "") + ((invoice or {}).get("text") or "")
+                if "занят" in text:
+                        return "lost_race", None
+                if "счёт" in text:
+                        return "invoice_failed", None
+                return "timeout" if invoice is None and answer is None else "error", None
+
+        async def _confirm(self, invoice: Dict[str, Any]) -> str:
+                since = len(self.chat.events)
+                invoice_id = int(re.search(r"IV(\d+)", invoice.get("text", "")).group(1))
+                paid = next(data for _, data in _buttons(invoice) if data.startswith("paid:"))
+                await asyncio.sleep(self.run.args.pay_delay)
+                self.run.crypto.pay(invoice_id)
+                for _ in range(self.run.args.retries):
+                        await self._think()
+                        answer, screen = await self._press("confirm", invoice["message_id"], paid)
+                        outcome = self._settled(since)
+                        if outcome:
+                                return outcome
+                        if answer is None:
+                                return "timeout"
+                        if "уже обработан" in (answer.get("text") or ""):
+                                # The reconciler got there first; its notification may still be on the way
+                                event = await self.chat.wait(since, lambda e: bool(self._settled(since)), self.run.args.timeout)
+                                return self._settled(since) if event else "timeout"
+                return "unconfirmed"
+
+        async def run_flow(self) -> None:
+                started = time.monotonic()
+                outcome = await self._flow()
+                self.run.outcomes[outcome] += 1
+                if outcome == "completed":
+                        self.run.latency["checkout_total"].append(time.monotonic() - started)
+
+        async def _flow(self) -> str:
+                if await self._send("start", "/start", lambda e: e["method"] == "sendMessage") is None:
+                        return "timeout"
+                await self._think()
+                menu = await self._send("numbers_menu", "📱 Номера", _has_button("cat:"))
+                if menu is None:
+                        return "timeout"
+                await self._think()
+                for _ in range(self.run.args.retries):
+                        answer, screen = await self._press("category", menu["message_id"], f"cat:{self.run.args.category}")
+                        if screen is None:
+                                return "timeout"
+                        await self._think()
+                        outcome, invoice = await self._checkout(screen)
+                        if outcome != "lost_race":
+                                break
+                        # Someone else reserved the number between the pick and the invoice
+                        self.run.contention += 1
+                if outcome != "invoice":
+                        return outcome
+                outcome = await self._confirm(invoice)
+                if outcome == "completed":
+                        number = invoice["text"].split(" номера ", 1)[-1].split(".", 1)[0].strip()
+                        self.run.confirmed[number].add(self.user_id)
+                return outcome
+
+
+def _free_port() -> int:
+        with socket.socket() as s:
+                s.bind(("127.0.0.1", 0))
+                return s.getsockname()[1]
+
+
+def _peak_rss_mb(pid: int) -> Optional[float]:
+        try:
+                with open(f"/proc/{pid}/status", encoding="ascii") as f:
+                        for line in f:
+                                if line.startswith("VmHWM:"):
+                                        return round(int(line.split()[1]) / 1024, 1)
+        except OSError:
+                pass
+        return None
+
+
+async def _scrape(port: int) -> Dict[str, float]:
+        try:
+                async with aiohttp.ClientSession() as session:
+                        async with session.get(f"http://127.0.0.1:{port}/metrics") as resp:
+                                body = await resp.text()
+        except aiohttp.ClientError:
+                return {}
+        return {
+                name: float(value)
+                for name, _, value in (line.rpartition(" ") for line in body.splitlines())
+                if name.startswith(BOT_METRICS)
+        }
+
+
+def _double_bookings(user_ids: List[int]) -> Dict[str, List[int]]:
+        """Numbers with an active rental for more than one user, read from the flushed state."""
+        from bot import storage
+        owners: Dict[str, List[int]] = defaultdict(list)
+        for user_id in user_ids:
+                for rental in storage.list_rentals(user_id):
+                        owners[rental["number"]].append(user_id)
+        return {number: users for number, users in owners.items() if len(users) > 1}
+
+
+async def run_load(args: argparse.Namespace) -> Dict[str, Any]:
+        workdir = tempfile.mkdtemp(prefix="loadtest-")
+        state_file = os.path.join(workdir, "state.json")
+        storage_env = {
+                "STORAGE_BACKEND": args.backend,
+                "STATE_FILE": state_file,
+                "STORAGE_SQLITE_PATH": os.path.join(workdir, "state.db"),
+                "PAYMENT_ARCHIVE_DIR": os.path.join(workdir, "archive"),
+        }
+        # bot.storage reads these on import; the double-booking check below must see the bot's state
+        os.environ.update(storage_env)
+        from benchmarks.synthetic import build_state
+
+        with open(state_file, "w", encoding="utf-8") as f:
+                json.dump(build_state(args.numbers), f, ensure_ascii=False)
+
+        telegram = FakeTelegram(args.telegram_latency)
+        crypto = FakeCryptoPay(args.crypto_latency, args.crypto_error_rate)
+        runner = web.AppRunner(make_app(telegram, crypto), access_log=None)
+        await runner.setup()
+        port = _free_port()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        metrics_port = _free_port()
+        env = dict(
+                os.environ,
+                BOT_TOKEN=BOT_TOKEN,
+                TELEGRAM_API_URL=f"http://127.0.0.1:{port}",
+                CRYPTO_PAY_TOKEN="loadtest",
+                CRYPTO_PAY_API_URL=f"http://127.0.0.1:{port}/api/",
+                CHECKOUT_SESSION_FILE="",
+                METRICS_HOST="127.0.0.1",
+                METRICS_PORT=str(metrics_port),
+                BOT_MODE="polling",
+        )
+        env.pop("CRYPTO_PAY_WEBHOOK_PATH", None)
+        bot = await asyncio.create_subprocess_exec(sys.executable, "-m", "bot.main", cwd=ROOT, env=env)
+        try:
+                await asyncio.wait_for(telegram.ready.wait(), 60)
+        except asyncio.TimeoutError:
+                bot.kill()
+                raise RuntimeError("the bot did not start polling within 60 seconds")
+
+        run = Run(args, telegram, crypto)
+        user_ids = list(range(10_000_000, 10_000_000 + args.users))
+        started = time.monotonic()
+
+        async def launch(index: int, user_id: int) -> None:
+                await asyncio.sleep(args.ramp * index / max(1, args.users))
+                try:
+                        await VirtualUser(run, user_id).run_flow()
+                except Exception:
+                        run.outcomes["client_error"] += 1
+
+        await asyncio.gather(*(launch(i, uid) for i, uid in enumerate(user_ids)))
+        duration = time.monotonic() - started
+        bot_metrics = await _scrape(metrics_port)
+        bot_rss = _peak_rss_mb(bot.pid)
+        bot.send_signal(signal.SIGINT)
+        await bot.wait()
+        await runner.cleanup()
+
+        synthetic_users = range(1_000_000, 1_000_000 + max(1, args.numbers // 20))
+        double_bookings = _double_bookings(user_ids + list(synthetic_users))
+        return {
+                "config": {k: v for k, v in vars(args).items() if k != "out"},
+                "duration_seconds": round(duration, 2),
+                "throughput": {
+                        "checkouts_per_sec": round(run.outcomes["completed"] / duration, 2),
+                        "updates_per_sec": round(run.updates / duration, 1),
+                },
+                "outcomes": dict(run.outcomes),
+                "error_rate": round(1 - run.outcomes["completed"] / max(1, args.users), 4),
+                "latency": {step: _percentiles(samples) for step, samples in run.latency.items()},
+                "timeouts": dict(run.timeouts),
+                "alerts": dict(run.alerts),
+                "contention_retries": run.contention,
+                "double_bookings": len(double_bookings),
+                "double_booked_numbers": double_bookings,
+                "double_confirmations": sum(1 for users in run.confirmed.values() if len(users) > 1),
+                "bot": {"exit_code": bot.returncode, "peak_rss_mb": bot_rss, "metrics": bot_metrics},
+                "telegram_calls": telegram.calls,
+                "crypto_pay_calls": crypto.calls,
+                "crypto_pay_injected_errors": crypto.errors,
+        }
+
+
+def _print_report(report: Dict[str, Any]) -> None:
+        print(f"\n{report['config']['users']} users in {report['duration_seconds']} s: "
+              f"{report['throughput']['checkouts_per_sec']} checkouts/s, {report['throughput']['updates_per_sec']} updates/s")
+        print("outcomes:", ", ".join(f"{k}={v}" for k, v in sorted(report["outcomes"].items())))
+        print(f"error rate: {report['error_rate']:.2%}, contention retries: {report['contention_retries']}, "
+              f"double bookings: {report['double_bookings']}, double confirmations: {report['double_confirmations']}")
+        print(f"\n{'step':18} {'n':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+        for step, stats in report["latency"].items():
+                print(f"{step:18} {stats['n']:>7} {stats['p50_ms']:>9} {stats['p95_ms']:>9} {stats['p99_ms']:>9} {stats['max_ms']:>9}")
+        if report["timeouts"]:
+                print("\ntimeouts:", report["timeouts"])
+        if report["alerts"]:
+                print("alerts:", report["alerts"])
+
+
+def main() -> None:
+        parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+        parser.add_argument("--users", type=int, default=1000, help="simulated users, each runs one checkout")
+        parser.add_argument("--numbers", type=int, default=5000, help="numbers in the synthetic inventory")
+        parser.add_argument("--category", default="anonymous")
+        parser.add_argument("--ramp", type=float, default=10, help="seconds over which users arrive")
+        parser.add_argument("--think", type=float, default=1.0, help="average pause between a user's actions (seconds)")
+        parser.add_argument("--promo-rate", type=float, default=0.5, help="share of users entering a promo code")
+        parser.add_argument("--pay-delay", type=float, default=2.0, help="seconds between the invoice and the payment")
+        parser.add_argument("--retries", type=int, default=5, help="attempts per step before a user gives up")
+        parser.add_argument("--timeout", type=float, default=30, help="seconds to wait for a reply")
+        parser.add_argument("--telegram-latency", type=float, default=0.05, help="added to every Bot API call (seconds)")
+        parser.add_argument("--crypto-latency", type=float, default=0.1, help="added to every Crypto Pay call (seconds)")
+        parser.add_argument("--crypto-error-rate", type=float, default=0.0, help="share of Crypto Pay calls answered with HTTP 500")
+        parser.add_argument("--backend", default="json", choices=("json", "sqlite"))
+        parser.add_argument("--out", default="", help="write the report to this JSON file")
+        args = parser.parse_args()
+        report = asyncio.run(run_load(args))
+        _print_report(report)
+        if args.out:
+                with open(args.out, "w", encoding="utf-8") as f:
+                        json.dump(report, f, ensure_ascii=False, indent=2)
+                print(f"\nReport written to {args.out}")
+
+
+if __name__ == "__main__":
+        main()
@@ -0,0 +1,236 @@
+"""Storage and handler benchmarks.
+
+        python -m benchmarks.run                          # 1k, 100k and 1M numbers, JSON backend
+        python -m benchmarks.run --sizes 1000,100000 --backend sqlite --out results.json
+        python -m benchmarks.run --compare before.json after.json
+
+Every (size, backend) pair runs in a fresh interpreter, so peak RSS is per
+run. Each operation reports ops/sec and p50/p99 latency; results are written
+as JSON so two runs can be compared.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+DEFAULT_SIZES = "1000,100000,1000000"
+# Operations that walk a whole category get fewer iterations on big states
+LINEAR_BUDGET = 2_000_000
+
+
+def _summary(samples: List[int]) -> Dict:
+        samples.sort()
+        n = len(samples)
+        total = sum(samples) or 1
+        return {
+                "n": n,
+                "ops_per_sec": round(n / (total / 1e9), 1),
+                "p50_us": round(samples[n // 2] / 1000, 2),
+                "p99_us": round(samples[min(n - 1, int(n * 0.99))] / 1000, 2),
+        }
+
+
+def measure(fn: Callable[[int], object], iterations: int) -> Dict:
+        samples = []
+        for i in range(iterations):
+                started = time.perf_counter_ns()
+                fn(i)
+                samples.append(time.perf_counter_ns() - started)
+        return _summary(samples)
+
+
+async def measure_async(fn: Callable[[int], object], iterations: int) -> Dict:
+        samples = []
+        for i in range(iterations):
+                started = time.perf_counter_ns()
+                await fn(i)
+                samples.append(time.perf_counter_ns() - started)
+        return _summary(samples)
+
+
+def _peak_rss_mb() -> float:
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def run_storage(size: int, iterations: int, backend: str) -> Dict:
+        from bot import storage
+        from bot.keyboards import numbers_inline_keyboard, numbers_page_keyboard
+        from benchmarks.synthetic import build_state, synthetic_number
+
+        # STATE_FILE points into the worker's temp dir (see _spawn), and so do the snapshot and journal next to it
+        state_path = storage.STATE_FILE
+        with open(state_path, "w", encoding="utf-8") as f:
+                json.dump(build_state(size), f, ensure_ascii=False)
+        ops: Dict[str, Dict] = {}
+        linear = max(3, min(iterations, LINEAR_BUDGET // size))
+        rnd = random.Random(7)
+
+        if backend == "sqlite":
+                from bot.storage_sqlite import import_state
+                ops["load"] = measure(lambda i: import_state(state_path), 1)
+        else:
+                ops["load"] = measure(lambda i: storage._load_state(), 1)
+        ops["list_numbers_category"] = measure(lambda i: storage.list_numbers(category="anonymous"), linear)
+        ops["list_numbers_category_status"] = measure(lambda i: storage.list_numbers(category="esim", status="free"), linear)
+        ops["get_number"] = measure(lambda i: storage.get_number(synthetic_number(rnd.randrange(size))), iterations)
+        first_page = storage.page_numbers("anonymous", 10)
+        ops["page_numbers_first"] = measure(lambda i: storage.page_numbers("anonymous", 10), iterations)
+        ops["page_numbers_next"] = measure(lambda i: storage.page_numbers("anonymous", 10, after=first_page["next"]), iterations)
+        ops["render_numbers_page_keyboard"] = measure(lambda i: numbers_page_keyboard("anonymous", first_page, False), iterations)
+        ops["render_numbers_inline_keyboard"] = measure(lambda i: numbers_inline_keyboard(first_page["items"]), iterations)
+
+        free = [n["number"] for n in storage.list_numbers(category="anonymous", status="free")]
+        rnd.shuffle(free)
+        rentable = min(iterations, len(free))
+        ops["add_rental"] = measure(lambda i: storage.add_rental(2_000_000 + i, free[i], 1), rentable)
+        # The first pass releases the rentals that expired "while the bot was down"
+        ops["release_if_expired_backlog"] = measure(lambda i: storage.release_if_expired(), 1)
+        ops["release_if_expired_idle"] = measure(lambda i: storage.release_if_expired(), iterations)
+        users = max(1, size // 20)
+        ops["register_user"] = measure(lambda i: storage.register_user(1_000_000 + rnd.randrange(users * 2), "bench"), iterations)
+        # Debounced writes make a mutation cheap; this is the write it defers
+        ops["flush"] = measure(lambda i: (storage.register_user(1_000_000, "bench"), storage.flush()), max(3, linear // 10))
+        if backend == "json" and storage.STATE_FORMAT == "snapshot":
+                from bot import snapshot
+                # A restart: the hot sections only, the payment history stays cold
+                ops["snapshot_load"] = measure(lambda i: snapshot.read_state(storage.STATE_SNAPSHOT_FILE, lazy=True), max(3, linear // 10))
+        return ops
+
+
+async def run_handlers(iterations: int) -> Dict:
+        from aiogram import Dispatcher
+        from bot import async_storage, storage
+        from bot.main import router, throttling
+        from bot.sessions import checkout_sessions
+        from benchmarks.fakes import callback_update, fake_bot, message_update
+
+        bot = fake_bot()
+        dp = Dispatcher(storage=checkout_sessions)
+        dp.message.outer_middleware(throttling)
+        dp.callback_query.outer_middleware(throttling)
+        dp.include_router(router)
+        async_storage.start()
+        page = storage.page_numbers("anonymous", 10)
+        number = page["items"][0]["number"]
+        # A new user per update, so per-user throttling never kicks in
+        user_ids = iter(range(5_000_000, 6_000_000))
+        cases = {
+                "handler_start": lambda: message_update(next(user_ids), "/start"),
+                "handler_numbers_menu": lambda: message_update(next(user_ids), "📱 Номера"),
+                "handler_select_category": lambda: callback_update(next(user_ids), "cat:anonymous"),
+                "handler_page_next": lambda: callback_update(next(user_ids), f"pg:anonymous:a:n:{page['next'][0]}:{page['next'][1]}"),
+                "handler_pick_number": lambda: callback_update(next(user_ids), f"num:{number}"),
+        }
+        ops = {}
+        for name, make_update in cases.items():
+                ops[name] = await measure_async(lambda i: dp.feed_update(bot, make_update()), iterations)
+        ops["telegram_api_calls"] = {"n": sum(bot.session.calls.values()), "by_method": bot.session.calls}
+        await async_storage.stop()
+        return ops
+
+
+def worker(size: int, iterations: int, backend: str) -> Dict:
+        from bot import storage
+
+        started = time.perf_counter()
+        ops = run_storage(size, iterations, backend)
+        ops.update(asyncio.run(run_handlers(iterations)))
+        return {
+                "size": size,
+                "backend": backend,
+                "iterations": iterations,
+                "state_file_mb": round(os.path.getsize(storage.STATE_FILE) / 2**20, 2),
+                "peak_rss_mb": _peak_rss_mb(),
+                "wall_seconds": round(time.perf_counter() - started, 2),
+                "ops": ops,
+        }
+
+
+def _spawn(size: int, iterations: int, backend: str) -> Dict:
+        workdir = tempfile.mkdtemp(prefix="bench-env-")
+        env = dict(
+                os.environ,
+                STORAGE_BACKEND=backend,
+                STORAGE_SQLITE_PATH=os.path.join(workdir, "state.db"),
+                # Every JSON backend path (snapshot, journal, lock) is derived from it inside workdir
+                STATE_FILE=os.path.join(workdir, "state.json"),
+                PAYMENT_ARCHIVE_DIR=os.path.join(workdir, "archive"),
+                CHECKOUT_SESSION_FILE="",
+                BOT_TOKEN=os.environ.get("BOT_TOKEN", "123456:BENCHMARK"),
+        )
+        for name in ("STATE_SNAPSHOT_FILE", "STATE_JOURNAL_FILE"):
+                env.pop(name, None)
+        cmd = [sys.executable, "-m", "benchmarks.run", "--worker", "--sizes", str(size), "--iterations", str(iterations), "--backend", backend]
+        out = subprocess.run(cmd, cwd=ROOT, env=env, check=True, stdout=subprocess.PIPE).stdout
+        return json.loads(out)
+
+
+def _print_table(results: List[Dict]) -> None:
+        for run in results:
+                print(f"\n== {run['size']:,} numbers, {run['backend']}: peak RSS {run['peak_rss_mb']} MB, state {run['state_file_mb']} MB ==")
+                print(f"{'operation':34} {'ops/sec':>12} {'p50 us':>10} {'p99 us':>10}")
+                for name, stats in run["ops"].items():
+                        if "ops_per_sec" in stats:
+                                print(f"{name:34} {stats['ops_per_sec']:>12,.1f} {stats['p50_us']:>10} {stats['p99_us']:>10}")
+
+
+def compare(before_path: str, after_path: str) -> None:
+        with open(before_path, encoding="utf-8") as f:
+                before = {(r["size"], r["backend"]): r for r in json.load(f)["results"]}
+        with open(after_path, encoding="utf-8") as f:
+                after = json.load(f)["results"]
+        for run in after:
+                base = before.get((run["size"], run["backend"]))
+                if not base:
+                        continue
+                print(f"\n== {run['size']:,} numbers, {run['backend']}: peak RSS {base['peak_rss_mb']} -> {run['peak_rss_mb']} MB ==")
+                for name, stats in run["ops"].items():
+                        old = base["ops"].get(name, {})
+                        if "ops_per_sec" in stats and old.get("ops_per_sec"):
+                                change = (stats["ops_per_sec"] / old["ops_per_sec"] - 1) * 100
+                                print(f"{name:34} {old['ops_per_sec']:>12,.1f} -> {stats['ops_per_sec']:>12,.1f} ops/s ({change:+.1f}%)")
+
+
+def main() -> None:
+        parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+        parser.add_argument("--sizes", default=DEFAULT_SIZES, help="comma-separated numbers of numbers in the synthetic state")
+        parser.add_argument("--iterations", type=int, default=2000, help="iterations per cheap operation")
+        parser.add_argument("--backend", default="json", choices=("json", "sqlite"))
+        parser.add_argument("--out", default="", help="write results to this JSON file")
+        parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two result files")
+        parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+        args = parser.parse_args()
+        if args.compare:
+                compare(*args.compare)
+                return
+        sizes = [int(s) for s in args.sizes.split(",") if s]
+        if args.worker:
+                json.dump(worker(sizes[0], args.iterations, args.backend), sys.stdout)
+                return
+        results = [_spawn(size, args.iterations, args.backend) for size in sizes]
+        _print_table(results)
+        if args.out:
+                report = {
+                        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                        "python": platform.python_version(),
+                        "platform": platform.platform(),
+                        "results": results,
+                }
+                with open(args.out, "w", encoding="utf-8") as f:
+                        json.dump(report, f, ensure_ascii=False, indent=2)
+                print(f"\nResults written to {args.out}")
+
+
+if __name__ == "__main__":
+        main()
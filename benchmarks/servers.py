@@ -0,0 +1,210 @@
+"""Local stand-ins for the Telegram Bot API and Crypto Pay.
+
+Both live in one aiohttp application, so the bot under test only needs
+``TELEGRAM_API_URL`` and ``CRYPTO_PAY_API_URL`` pointed at it. The Telegram
+side queues updates for ``getUpdates`` and records everything the bot sends,
+per chat, so a simulated user can wait for the reply to its last action. The
+Crypto Pay side keeps invoices in memory and lets the simulation mark them
+paid.
+"""
+import asyncio
+import json
+import random
+import time
+from itertools import count
+from typing import Any, Callable, Dict, List, Optional
+from aiohttp import web
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot"}
+
+
+class Chat:
+        """Everything the bot sent to one private chat, in order."""
+
+        def __init__(self) -> None:
+                self.events: List[Dict[str, Any]] = []
+                self.changed = asyncio.Event()
+
+        def add(self, event: Dict[str, Any]) -> None:
+                self.events.append(event)
+                self.changed.set()
+
+        async def wait(self, since: int, predicate: Callable[[Dict[str, Any]], bool], timeout: float) -> Optional[Dict[str, Any]]:
+                """First event at index >= since matching predicate, or None on timeout."""
+                deadline = time.monotonic() + timeout
+                while True:
+                        for event in self.events[since:]:
+                                if predicate(event):
+                                        return event
+                        since = len(self.events)
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                                return None
+                        self.changed.clear()
+                        try:
+                                await asyncio.wait_for(self.changed.wait(), remaining)
+                        except asyncio.TimeoutError:
+                                return None
+
+
+class FakeTelegram:
+        def __init__(self, latency: float = 0.0) -> None:
+                self.latency = latency
+                self.chats: Dict[int, Chat] = {}
+                self.calls: Dict[str, int] = {}
+                self.ready = asyncio.Event()
+                self._updates: List[Dict[str, Any]] = []
+                self._update_ids = count(1)
+                self._message_ids = count(1)
+                self._callback_chats: Dict[str, int] = {}
+                self._new_updates = asyncio.Event()
+
+        def chat(self, chat_id: int) -> Chat:
+                chat = self.chats.get(chat_id)
+                if chat is None:
+                        chat = self.chats[chat_id] = Chat()
+                return chat
+
+        def _user(self, user_id: int) -> Dict[str, Any]:
+                return {"id": user_id, "is_bot": False, "first_name": "Load", "username": f"load{user_id}"}
+
+        def _message(self, chat_id: int, text: str, message_id: Optional[int] = None, from_bot: bool = False) -> Dict[str, Any]:
+                return {
+                        "message_id": message_id or next(self._message_ids),
+                        "date": int(time.time()),
+                        "chat": {"id": chat_id, "type": "private"},
+                        "from": BOT_USER if from_bot else self._user(chat_id),
+                        "text": text,
+                }
+
+        def _push(self, update: Dict[str, Any]) -> None:
+                update["update_id"] = next(self._update_ids)
+                self._updates.append(update)
+                self._new_updates.set()
+
+        def send_text(self, user_id: int, text: str) -> None:
+                self._push({"message": self._message(user_id, text)})
+
+        def press(self, user_id: int, message_id: int, data: str) -> str:
+                """Click an inline button; returns the callback query id the answer will carry."""
+                callback_id = str(next(self._update_ids))
+                self._callback_chats[callback_id] = user_id
+                self._push({"callback_query": {
+                        "id": callback_id,
+                        "from": self._user(user_id),
+                        "chat_instance": str(user_id),
+                        "message": self._message(user_id, "", message_id, from_bot=True),
+                        "data": data,
+                }})
+                return callback_id
+
+        async def _get_updates(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+                offset = int(params.get("offset") or 0)
+                if offset:
+                        # Everything below offset is confirmed
+                        self._updates = [u for u in self._updates if u["update_id"] >= offset]
+                if not self._updates:
+                        self.ready.set()
+                        self._new_updates.clear()
+                        try:
+                                await asyncio.wait_for(self._new_updates.wait(), float(params.get("timeout") or 0))
+                        except asyncio.TimeoutError:
+                                pass
+                return self._updates[:int(params.get("limit") or 100)]
+
+        def _record(self, method: str, params: Dict[str, Any]) -> Any:
+                if method == "getMe":
+                        return BOT_USER
+                if method == "deleteWebhook":
+                        if str(params.get("drop_pending_updates")).lower() == "true":
+                                self._updates.clear()
+                        return True
+                if method == "answerCallbackQuery":
+                        chat_id = self._callback_chats.pop(str(params.get("callback_query_id")), None)
+                        if chat_id is not None:
+                                self.chat(chat_id).add({"method": method, **params})
+                        return True
+                chat_id = params.get("chat_id")
+                if chat_id is None:
+                        return True
+                chat_id = int(chat_id)
+                event = {"method": method, **params}
+                if "reply_markup" in event and isinstance(event["reply_markup"], str):
+                        event["reply_markup"] = json.loads(event["reply_markup"])
+                message_id = int(params["message_id"]) if params.get("message_id") else next(self._message_ids)
+                event["message_id"] = message_id
+                self.chat(chat_id).add(event)
+                if method.startswith("send") or method.startswith("edit"):
+                        return self._message(chat_id, params.get("text", ""), message_id, from_bot=True)
+                return True
+
+        async def handle(self, request: web.Request) -> web.Response:
+                method = request.match_info["method"]
+                params = dict(await request.post())
+                if not params and request.can_read_body:
+                        params = await request.json()
+                self.calls[method] = self.calls.get(method, 0) + 1
+                if method == "getUpdates":
+                        return web.json_response({"ok": True, "result": await self._get_updates(params)})
+                if self.latency:
+                        await asyncio.sleep(self.latency)
+                return web.json_response({"ok": True, "result": self._record(method, params)})
+
+
+class FakeCryptoPay:
+        def __init__(self, latency: float = 0.0, error_rate: float = 0.0) -> None:
+                self.latency = latency
+                self.error_rate = error_rate
+                self.invoices: Dict[int, Dict[str, Any]] = {}
+                self.calls: Dict[str, int] = {}
+                self.errors = 0
+                self._invoice_ids = count(1)
+
+        def pay(self, invoice_id: int) -> bool:
+                invoice = self.invoices.get(invoice_id)
+                if not invoice or invoice["status"] != "active":
+                        return False
+                invoice["status"] = "paid"
+                invoice["paid_at"] = time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime())
+                return True
+
+        def _create_invoice(self, data: Dict[str, Any]) -> Dict[str, Any]:
+                invoice_id = next(self._invoice_ids)
+                invoice = self.invoices[invoice_id] = {
+                        "invoice_id": invoice_id,
+                        "status": "active",
+                        "asset": data.get("asset"),
+                        "amount": data.get("amount"),
+                        "description": data.get("description"),
+                        "payload": data.get("payload"),
+                        "pay_url": f"https://t.me/CryptoBot?start=IV{invoice_id}",
+                }
+                return invoice
+
+        def _get_invoices(self, data: Dict[str, Any]) -> Dict[str, Any]:
+                ids = data.get("invoice_ids") or []
+                if isinstance(ids, str):
+                        ids = [int(i) for i in ids.split(",") if i]
+                return {"items": [self.invoices[int(i)] for i in ids if int(i) in self.invoices]}
+
+        async def handle(self, request: web.Request) -> web.Response:
+                method = request.match_info["method"]
+                self.calls[method] = self.calls.get(method, 0) + 1
+                if self.latency:
+                        await asyncio.sleep(self.latency)
+                if self.error_rate and random.random() < self.error_rate:
+                        self.errors += 1
+                        return web.json_response({"ok": False, "error": {"code": 500, "name": "INTERNAL_ERROR"}}, status=500)
+                data = await request.json() if request.can_read_body else {}
+                if method == "createInvoice":
+                        return web.json_response({"ok": True, "result": self._create_invoice(data)})
+                if method == "getInvoices":
+                        return web.json_response({"ok": True, "result": self._get_invoices(data)})
+                return web.json_response({"ok": False, "error": {"code": 400, "name": "METHOD_NOT_FOUND"}}, status=400)
+
+
+def make_app(telegram: FakeTelegram, crypto: FakeCryptoPay) -> web.Application:
+        app = web.Application(client_max_size=16 * 2**20)
+        app.router.add_route("*", "/bot{token}/{method}", telegram.handle)
+        app.router.add_post("/api/{method}", crypto.handle)
+        return app
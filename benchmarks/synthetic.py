@@ -0,0 +1,65 @@
+"""Deterministic synthetic states for benchmarks.
+
+The shape follows data/state.json: a third of the numbers are anonymous
+rentals, the rest eSIM and physical SIMs for sale; about 30% are busy, busy
+anonymous numbers have a rental (1% of them already expired), and there is
+one payment per ten numbers and one user per twenty.
+"""
+import random
+from datetime import datetime, timedelta
+from typing import Dict
+from bot.storage import ISO_FORMAT, SCHEMA_VERSION
+
+CATEGORIES = (
+        ("anonymous", "rent", 25),
+        ("esim", "sale", 15),
+        ("physical", "sale", 8),
+)
+
+
+def synthetic_number(i: int) -> str:
+        return f"+888 {i // 10000:03d} {i % 10000:04d}"
+
+
+def build_state(size: int, seed: int = 42) -> Dict:
+        rnd = random.Random(seed)
+        now = datetime.utcnow()
+        users = max(1, size // 20)
+        state = {
+                "schema_version": SCHEMA_VERSION,
+                "numbers": [],
+                "rentals": {},
+                "payments": {},
+                "promocodes": [{"code": "BENCH10", "percent": 10, "active": True, "created_at": now.strftime(ISO_FORMAT), "created_by": 0}],
+                "users": {},
+                "holds": {},
+        }
+        for i in range(size):
+                category, num_type, price = CATEGORIES[i % 3]
+                busy = rnd.random() < 0.3
+                number = synthetic_number(i)
+                state["numbers"].append({"number": number, "status": "busy" if busy else "free", "category": category, "type": num_type, "price": price})
+                if busy and num_type == "rent":
+                        # 1% of the rentals ran out while the bot was down
+                        days = -1 if rnd.random() < 0.01 else rnd.randint(1, 365)
+                        user_key = str(1_000_000 + rnd.randrange(users))
+                        state["rentals"].setdefault(user_key, []).append({"number": number, "until": (now + timedelta(days=days)).strftime(ISO_FORMAT)})
+        statuses = ("paid",) * 14 + ("expired",) * 4 + ("pending", "conflict")
+        started = int(now.timestamp()) - 90 * 86400
+        for i in range(max(1, size // 10)):
+                created = started + rnd.randrange(90 * 86400)
+                user_id = 1_000_000 + rnd.randrange(users)
+                number = synthetic_number(rnd.randrange(size))
+                state["payments"][f"{user_id}:{number}:1:{created}"] = {
+                        "user_id": user_id,
+                        "number": number,
+                        "months": 1,
+                        "price": 25,
+                        "invoice_id": 10_000_000 + i,
+                        "status": statuses[i % len(statuses)],
+                        "created_at": datetime.utcfromtimestamp(created).strftime(ISO_FORMAT),
+                }
+        first_seen = (now - timedelta(days=30)).strftime(ISO_FORMAT)
+        for i in range(users):
+                state["users"][str(1_000_000 + i)] = {"username": f"user{i}", "first_seen": first_seen, "last_seen": first_seen}
+        return state
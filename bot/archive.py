@@ -0,0 +1,162 @@
+"""Append-only archive of settled payments.
+
+Payments are partitioned by month of creation into ``<YYYY-MM>.jsonl.gz``
+segments. Every archive run appends one gzip member per touched segment (a
+file of concatenated members is still a valid gzip stream) and records each
+payment's member offset in the segment's ``.idx`` file, so a lookup by id
+decompresses a single member instead of the whole history. Segments are never
+rewritten.
+"""
+import gzip
+import json
+import os
+import threading
+import zlib
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+ARCHIVE_DIR = os.path.abspath(os.getenv(
+        "PAYMENT_ARCHIVE_DIR",
+        os.path.join(os.path.dirname(__file__), "..", "data", "archive", "payments"),
+))
+
+# Same as storage.ISO_FORMAT, which cannot be imported here: storage depends on this module
+ISO_FORMAT = "%Y-%m-%dT%H:%M:%S"
+# Segment for payments whose creation time is unknown
+LEGACY_PARTITION = "legacy"
+# Segment indexes kept in memory for lookups
+INDEX_CACHE_SIZE = 12
+
+# Serializes writers; held across compression and fsync
+_append_lock = threading.Lock()
+# Guards the index files' visible contents and the cache; held only briefly
+_lock = threading.Lock()
+_index_cache: Dict[str, Tuple[int, Dict[str, int]]] = {}  # partition -> (idx file size, payment_id -> member offset)
+
+
+def payment_time(payment_id: str, payment: Optional[Dict] = None) -> Optional[datetime]:
+        """Creation time of a payment: the unix time that ends its id, else its created_at.
+
+        The id comes first so that a lookup by id alone finds the same segment
+        the payment was written to.
+        """
+        try:
+                return datetime.utcfromtimestamp(int(payment_id.rsplit(":", 1)[1]))
+        except (IndexError, ValueError, OverflowError, OSError):
+                pass
+        if payment and payment.get("created_at"):
+                try:
+                        return datetime.strptime(payment["created_at"], ISO_FORMAT)
+                except ValueError:
+                        pass
+        return None
+
+
+def _partition(payment_id: str, payment: Optional[Dict] = None) -> Optional[str]:
+        created = payment_time(payment_id, payment)
+        return created.strftime("%Y-%m") if created else None
+
+
+def _segment_path(partition: str) -> str:
+        return os.path.join(ARCHIVE_DIR, f"{partition}.jsonl.gz")
+
+
+def _index_path(partition: str) -> str:
+        return os.path.join(ARCHIVE_DIR, f"{partition}.idx")
+
+
+def append_payments(items: List[Tuple[str, Dict]]) -> None:
+        """Append payments to their month segments; durable on disk before returning.
+
+        Members are compressed and synced without holding up lookups; a member
+        only becomes visible once its index lines are appended, in one write
+        under the lock.
+        """
+        by_partition: Dict[str, List[Tuple[str, Dict]]] = {}
+        for payment_id, payment in items:
+                by_partition.setdefault(_partition(payment_id, payment) or LEGACY_PARTITION, []).append((payment_id, payment))
+        members = {
+                partition: gzip.compress("".join(
+                        json.dumps({"payment_id": payment_id, **payment}, ensure_ascii=False) + "\n"
+                        for payment_id, payment in batch
+                ).encode("utf-8"))
+                for partition, batch in by_partition.items()
+        }
+        with _append_lock:
+                os.makedirs(ARCHIVE_DIR, exist_ok=True)
+                for partition, batch in by_partition.items():
+                        with open(_segment_path(partition), "ab") as f:
+                                offset = f.tell()
+                                f.write(members[partition])
+                                f.flush()
+                                os.fsync(f.fileno())
+                        # The index is written after its member, so every offset it names exists
+                        lines = "".join(f"{payment_id}\t{offset}\n" for payment_id, _ in batch).encode("utf-8")
+                        with open(_index_path(partition), "ab", buffering=0) as f:
+                                with _lock:
+                                        # One write, so a lookup never reads half an index line
+                                        view = memoryview(lines)
+                                        while view:
+                                                view = view[f.write(view):]
+                                os.fsync(f.fileno())
+
+
+def _load_index(partition: str) -> Dict[str, int]:
+        path = _index_path(partition)
+        try:
+                size = os.path.getsize(path)
+        except OSError:
+                return {}
+        cached = _index_cache.get(partition)
+        if cached and cached[0] == size:
+                return cached[1]
+        index: Dict[str, int] = {}
+        with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                        payment_id, _, offset = line.rstrip("\n").rpartition("\t")
+                        if payment_id:
+                                # A payment archived twice (crash before the hot copy was dropped) resolves to the latest copy
+                                index[payment_id] = int(offset)
+        if len(_index_cache) >= INDEX_CACHE_SIZE:
+                _index_cache.pop(next(iter(_index_cache)))
+        _index_cache[partition] = (size, index)
+        return index
+
+
+def _read_member(partition: str, offset: int) -> bytes:
+        decompressor = zlib.decompressobj(wbits=31)
+        chunks = []
+        with open(_segment_path(partition), "rb") as f:
+                f.seek(offset)
+                while not decompressor.eof:
+                        data = f.read(64 * 1024)
+                        if not data:
+                                break
+                        chunks.append(decompressor.decompress(data))
+        return b"".join(chunks)
+
+
+def _partitions() -> List[str]:
+        try:
+                names = os.listdir(ARCHIVE_DIR)
+        except OSError:
+                return []
+        return sorted((name[:-len(".idx")] for name in names if name.endswith(".idx")), reverse=True)
+
+
+def get_payment(payment_id: str) -> Optional[Dict]:
+        """Look an archived payment up by id, or None if it was never archived."""
+        partition = _partition(payment_id)
+        # Ids without a timestamp were filed by created_at, so any segment may hold them
+        candidates = [partition] if partition else _partitions()
+        for candidate in candidates:
+                with _lock:
+                        offset = _load_index(candidate).get(payment_id)
+                if offset is None:
+                        continue
+                # Members are never rewritten, so reading one needs no lock
+                for line in _read_member(candidate, offset).decode("utf-8").splitlines():
+                        record = json.loads(line)
+                        if record.pop("payment_id") == payment_id:
+                                return record
+        return None
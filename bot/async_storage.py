@@ -0,0 +1,271 @@
+"""Async facade over :mod:`bot.storage` for aiogram handlers.
+
+Reads run on a small dedicated thread pool. Writes are queued to a single
+writer task that applies them one at a time on its own thread, so a slow
+disk or database never blocks the event loop and writes keep their order.
+Payment archiving runs on a separate thread instead (see archive_payments).
+With the journal on (see bot/journal.py) a write completes once its record
+is on disk; the writer moves on meanwhile, so writes that arrive together
+share one fsync.
+"""
+import asyncio
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from typing import Any, Deque, Dict, List, Optional, Tuple
+from . import storage
+from .profiling import profiler
+
+STORAGE_READ_WORKERS = int(os.getenv("STORAGE_READ_WORKERS", "4"))
+
+_read_executor = ThreadPoolExecutor(max_workers=STORAGE_READ_WORKERS, thread_name_prefix="storage-read")
+_write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage-write")
+# Long maintenance jobs that take the storage lock only in short steps (archiving)
+_maintenance_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage-maintenance")
+_write_queue: Optional[asyncio.Queue] = None
+_writer_task: Optional[asyncio.Task] = None
+# (journal sequence number, future, result) of applied writes waiting for their fsync, in order
+_unsynced: Deque[Tuple[int, asyncio.Future, Any]] = deque()
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_listening = False
+
+
+async def _read(name: str, *args, **kwargs) -> Any:
+        return await _run(_read_executor, name, *args, **kwargs)
+
+
+async def _run(executor: ThreadPoolExecutor, name: str, *args, **kwargs) -> Any:
+        loop = asyncio.get_running_loop()
+        call = profiler.timed(name, partial(getattr(storage, name), *args, **kwargs))
+        return await loop.run_in_executor(executor, call)
+
+
+async def _write(name: str, *args, **kwargs) -> Any:
+        start()
+        future = asyncio.get_running_loop().create_future()
+        call = profiler.timed(name, partial(getattr(storage, name), *args, **kwargs))
+        await _write_queue.put((call, future))
+        return await future
+
+
+async def _writer_loop() -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+                call, future = await _write_queue.get()
+                try:
+                        result = await loop.run_in_executor(_write_executor, call)
+                except Exception as exc:
+                        if not future.done():
+                                future.set_exception(exc)
+                else:
+                        seq = storage.journal_position()
+                        if seq > storage.journal_synced():
+                                _unsynced.append((seq, future, result))
+                        elif not future.done():
+                                future.set_result(result)
+                finally:
+                        _write_queue.task_done()
+
+
+def _release_synced() -> None:
+        """Complete the writes whose journal records are on disk now."""
+        synced = storage.journal_synced()
+        while _unsynced and _unsynced[0][0] <= synced:
+                _, future, result = _unsynced.popleft()
+                if not future.done():
+                        future.set_result(result)
+
+
+def _on_journal_sync(seq: int) -> None:
+        # Runs on the journal thread
+        try:
+                _loop.call_soon_threadsafe(_release_synced)
+        except (AttributeError, RuntimeError):  # no loop yet, or it is closed
+                pass
+
+
+def start() -> None:
+        """Start the writer task on the running loop (idempotent)."""
+        global _write_queue, _writer_task, _loop, _listening
+        if _writer_task is not None and not _writer_task.done():
+                return
+        if _write_queue is None:
+                _write_queue = asyncio.Queue()
+        _loop = asyncio.get_running_loop()
+        if not _listening:
+                storage.on_journal_sync(_on_journal_sync)
+                _listening = True
+        _writer_task = _loop.create_task(_writer_loop())
+
+
+async def stop() -> None:
+        """Apply every queued write, then stop the writer task."""
+        global _writer_task
+        if _writer_task is None:
+                return
+        await _write_queue.join()
+        if _unsynced:
+                await asyncio.gather(*(future for _, future, _ in list(_unsynced)), return_exceptions=True)
+        _writer_task.cancel()
+        try:
+                await _writer_task
+        except asyncio.CancelledError:
+                pass
+        _writer_task = None
+
+
+# Reads
+
+async def list_numbers(category: Optional[str] = None, status: Optional[str] = None) -> List[Dict]:
+        return await _read("list_numbers", category, status)
+
+
+async def page_numbers(category: str, limit: int, after: Optional[storage.Cursor] = None,
+                       before: Optional[storage.Cursor] = None, only_free: bool = False) -> Dict:
+        return await _read("page_numbers", category, limit, after, before, only_free)
+
+
+async def inventory_version() -> int:
+        return await _read("inventory_version")
+
+
+async def inventory_counts() -> Dict[Tuple[str, str], int]:
+        return await _read("inventory_counts")
+
+
+async def get_number(number: str) -> Optional[Dict]:
+        return await _read("get_number", number)
+
+
+async def list_rentals(user_id: int) -> List[Dict]:
+        return await _read("list_rentals", user_id)
+
+
+async def next_expiry() -> Optional[datetime]:
+        return await _read("next_expiry")
+
+
+async def get_hold(number: str) -> Optional[Dict]:
+        return await _read("get_hold", number)
+
+
+async def next_hold_expiry() -> Optional[datetime]:
+        return await _read("next_hold_expiry")
+
+
+async def get_payment(payment_id: str) -> Optional[Dict]:
+        return await _read("get_payment", payment_id)
+
+
+async def list_pending_payments() -> Dict[str, Dict]:
+        return await _read("list_pending_payments")
+
+
+async def scan_numbers(after: int = -1, limit: int = 1000) -> Tuple[List[Dict], Optional[int]]:
+        return await _read("scan_numbers", after, limit)
+
+
+async def pending_payment_count() -> int:
+        return await _read("pending_payment_count")
+
+
+async def list_promocodes() -> List[Dict]:
+        return await _read("list_promocodes")
+
+
+async def get_promocode(code: str) -> Optional[Dict]:
+        return await _read("get_promocode", code)
+
+
+async def get_user(user_id: int) -> Optional[Dict]:
+        return await _read("get_user", user_id)
+
+
+# Writes
+
+async def set_number_status(number: str, status: str) -> None:
+        return await _write("set_number_status", number, status)
+
+
+async def add_rental(user_id: int, number: str, months: int) -> Optional[Dict]:
+        return await _write("add_rental", user_id, number, months)
+
+
+async def extend_rental(user_id: int, number: str, months: int) -> Optional[Dict]:
+        return await _write("extend_rental", user_id, number, months)
+
+
+async def release_if_expired() -> int:
+        return await _write("release_if_expired")
+
+
+async def hold_number(number: str, payment_id: str, user_id: int, ttl: int) -> bool:
+        return await _write("hold_number", number, payment_id, user_id, ttl)
+
+
+async def release_hold(number: str, payment_id: str) -> bool:
+        return await _write("release_hold", number, payment_id)
+
+
+async def claim_number(number: str, user_id: int) -> bool:
+        return await _write("claim_number", number, user_id)
+
+
+async def release_expired_holds() -> int:
+        return await _write("release_expired_holds")
+
+
+async def create_pending_payment(payment_id: str, payload: Dict) -> None:
+        return await _write("create_pending_payment", payment_id, payload)
+
+
+async def set_payment_status(payment_id: str, status: str, invoice_id: int = None, expected_status: Optional[str] = None) -> bool:
+        return await _write("set_payment_status", payment_id, status, invoice_id, expected_status)
+
+
+async def archive_payments(before: datetime, limit: int = 1000) -> int:
+        # Not on the writer queue: a batch spends most of its time on archive I/O, which
+        # would hold up every hold, rental and lease renewal queued behind it
+        return await _run(_maintenance_executor, "archive_payments", before, limit)
+
+
+async def force_rental(user_id: int, number: str, months: int) -> Optional[Dict]:
+        return await _write("force_rental", user_id, number, months)
+
+
+async def upsert_numbers(records: List[Dict]) -> Dict[str, int]:
+        return await _write("upsert_numbers", records)
+
+
+async def add_promocode(code: str, percent: int, created_by: int) -> Optional[Dict]:
+        return await _write("add_promocode", code, percent, created_by)
+
+
+async def deactivate_promocode(code: str) -> bool:
+        return await _write("deactivate_promocode", code)
+
+
+async def register_user(user_id: int, username: str = None) -> Dict:
+        return await _write("register_user", user_id, username)
+
+
+async def acquire_lease(name: str, owner: str, ttl: float) -> bool:
+        return await _write("acquire_lease", name, owner, ttl)
+
+
+async def release_lease(name: str, owner: str) -> bool:
+        return await _write("release_lease", name, owner)
+
+
+async def load_session(key: str) -> Optional[Tuple[Optional[str], Dict[str, Any]]]:
+        return await _read("load_session", key)
+
+
+async def save_session(key: str, state: Optional[str], data: Dict[str, Any], ttl: float) -> None:
+        return await _write("save_session", key, state, data, ttl)
+
+
+async def purge_sessions() -> int:
+        return await _write("purge_sessions")
@@ -0,0 +1,531 @@
+"""Compact resident number catalogue for the JSON storage backend.
+
+A number used to be a five-key dict with its own copies of "free",
+"anonymous", "rent" and so on, plus entries in several index dicts: about
+half a kilobyte each. Here the catalogue is a struct of arrays instead:
+
+- number strings packed back to back in one bytearray, with an offsets array
+  and an open-addressing hash table (an int array) mapping number -> position,
+  hashed with CRC-32 so the table stays valid in a snapshot;
+- status, category, type and price as small integer codes into interned value
+  tables;
+- one bitmap per (category, status) and per category, so counts are O(1) and
+  "the next K free numbers of a category" skips empty stretches at C speed.
+
+That is a few dozen bytes per number. Records are exposed as
+:class:`NumberRecord` views that behave like the old dicts: reading, ``dict()``
+and item assignment all work, and assigning a status or category keeps the
+bitmaps in sync. Positions are catalogue order and only ever grow; numbers are
+never removed (retiring one is a status).
+"""
+import json
+import re
+import sys
+import zlib
+from array import array
+from collections.abc import Mapping
+from itertools import accumulate, islice
+from json.encoder import encode_basestring
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Fields stored as columns, in the key order of a record
+FIELDS = ("number", "status", "category", "type", "price")
+# Columns and their array typecodes; every column is a code into a _Values table
+COLUMNS = (("status", "B"), ("category", "B"), ("type", "B"), ("price", "H"))
+
+# A field absent from a record (code 0 in every column)
+_MISSING = object()
+_EMPTY = -1
+_NONZERO_BYTE = re.compile(b"[^\x00]")
+_NONZERO_RUN = re.compile(b"[^\x00]+")
+# Bit offsets set in each byte value
+_BYTE_BITS = [tuple(bit for bit in range(8) if value >> bit & 1) for value in range(256)]
+
+
+class _Values:
+        """Interned values of one column: code <-> value, plus the value's JSON text."""
+
+        __slots__ = ("values", "json", "_codes")
+
+        def __init__(self) -> None:
+                self.values: List[Any] = [_MISSING]
+                self.json: List[str] = [""]
+                self._codes: Dict[Tuple[type, Any], int] = {}
+
+        def code(self, value: Any) -> int:
+                if value is _MISSING:
+                        return 0
+                # Keyed with the type too, so 25 and 25.0 (equal and same hash) stay distinct
+                key = (type(value), value)
+                code = self._codes.get(key)
+                if code is None:
+                        code = self._codes[key] = len(self.values)
+                        self.values.append(value)
+                        self.json.append(_to_json(value))
+                return code
+
+        def find(self, value: Any) -> Optional[int]:
+                """Code of value if it was ever stored, else None."""
+                try:
+                        return self._codes.get((type(value), value))
+                except TypeError:
+                        return None
+
+
+def _to_json(value: Any) -> str:
+        if isinstance(value, str):
+                return encode_basestring(value)
+        return json.dumps(value, ensure_ascii=False)
+
+
+def _set_bit(bitmap: bytearray, position: int) -> None:
+        byte = position >> 3
+        if byte >= len(bitmap):
+                # Grow in steps so appending numbers one by one stays amortized O(1)
+                bitmap.extend(bytes(max(byte + 1 - len(bitmap), len(bitmap) // 4, 64)))
+        bitmap[byte] |= 1 << (position & 7)
+
+
+def _clear_bit(bitmap: bytearray, position: int) -> None:
+        byte = position >> 3
+        if byte < len(bitmap):
+                bitmap[byte] &= ~(1 << (position & 7)) & 0xFF
+
+
+def _bitmap_from_int(value: int, size: int) -> bytearray:
+        return bytearray(value.to_bytes((size + 7) // 8 or 1, "little"))
+
+
+def _code_masks(codes: bytes) -> Dict[int, int]:
+        """code -> int whose bit i is set where codes[i] == code, for a byte-per-position column.
+
+        The column is translated to a string of '0'/'1' digits and parsed in
+        base 2, which CPython does in linear time without a Python-level loop.
+        """
+        masks = {}
+        for code in set(codes):
+                table = bytes(0x31 if i == code else 0x30 for i in range(256))
+                masks[code] = int(codes.translate(table)[::-1], 2)
+        return masks
+
+
+def bit_positions(bitmap: bytearray) -> List[int]:
+        """All set positions in ascending order (faster than iter_bits when every one is needed)."""
+        positions: List[int] = []
+        for match in _NONZERO_RUN.finditer(bitmap):
+                for byte in range(match.start(), match.end()):
+                        base = byte << 3
+                        positions.extend([base + bit for bit in _BYTE_BITS[bitmap[byte]]])
+        return positions
+
+
+def iter_bits(bitmap: bytearray, start: int = 0) -> Iterator[int]:
+        """Set positions >= start in ascending order; runs of zero bytes are skipped by the regex engine."""
+        byte = start >> 3
+        if byte >= len(bitmap):
+                return
+        value = bitmap[byte] & (0xFF << (start & 7)) & 0xFF
+        while True:
+                while value:
+                        low = value & -value
+                        yield (byte << 3) + low.bit_length() - 1
+                        value ^= low
+                byte += 1
+                if byte < len(bitmap) and bitmap[byte]:
+                        # Dense stretch: the next byte has bits too, no need to search
+                        value = bitmap[byte]
+                        continue
+                match = _NONZERO_BYTE.search(bitmap, byte)
+                if match is None:
+                        return
+                byte = match.start()
+                value = bitmap[byte]
+
+
+def _last_nonzero_byte(bitmap: bytearray, end: int) -> int:
+        """Index of the last non-zero byte before `end`, or -1.
+
+        Probes windows of doubling width backwards from end with count(),
+        which reads the bitmap in place, then halves the window holding the
+        byte; the cost follows the length of the zero run skipped, not the
+        bitmap's size.
+        """
+        # Short gaps are cheaper to step over byte by byte
+        hi = max(0, end - 8)
+        for byte in range(end - 1, hi - 1, -1):
+                if bitmap[byte]:
+                        return byte
+        width = 256
+        while hi > 0:
+                lo = max(0, hi - width)
+                if bitmap.count(0, lo, hi) < hi - lo:
+                        while hi - lo > 32:
+                                mid = (lo + hi) // 2
+                                if bitmap.count(0, mid, hi) < hi - mid:
+                                        lo = mid
+                                else:
+                                        hi = mid
+                        byte = hi - 1
+                        while not bitmap[byte]:
+                                byte -= 1
+                        return byte
+                hi = lo
+                width *= 2
+        return -1
+
+
+def iter_bits_reverse(bitmap: bytearray, end: int) -> Iterator[int]:
+        """Set positions < end in descending order."""
+        if end <= 0 or not bitmap:
+                return
+        byte = min((end - 1) >> 3, len(bitmap) - 1)
+        value = bitmap[byte]
+        if byte == (end - 1) >> 3:
+                value &= (1 << (((end - 1) & 7) + 1)) - 1
+        while True:
+                while value:
+                        high = value.bit_length() - 1
+                        yield (byte << 3) + high
+                        value ^= 1 << high
+                if byte > 0 and bitmap[byte - 1]:
+                        # Dense stretch: the previous byte has bits too, no need to search
+                        byte -= 1
+                else:
+                        byte = _last_nonzero_byte(bitmap, byte)
+                if byte < 0:
+                        return
+                value = bitmap[byte]
+
+
+class NumberRecord(Mapping):
+        """Live dict-like view of the number at one catalogue position."""
+
+        __slots__ = ("catalogue", "position")
+
+        def __init__(self, catalogue: "NumberCatalogue", position: int):
+                self.catalogue = catalogue
+                self.position = position
+
+        def __getitem__(self, key: str) -> Any:
+                value = self.catalogue.field(self.position, key)
+                if value is _MISSING:
+                        raise KeyError(key)
+                return value
+
+        def get(self, key: str, default: Any = None) -> Any:
+                value = self.catalogue.field(self.position, key)
+                return default if value is _MISSING else value
+
+        def __setitem__(self, key: str, value: Any) -> None:
+                self.catalogue.set_field(self.position, key, value)
+
+        def __iter__(self) -> Iterator[str]:
+                return iter(self.catalogue.keys(self.position))
+
+        def __len__(self) -> int:
+                return len(self.catalogue.keys(self.position))
+
+        def __repr__(self) -> str:
+                return f"NumberRecord({dict(self)!r})"
+
+
+class NumberCatalogue:
+        """All numbers of the JSON state; state["numbers"] holds one of these while the bot runs.
+
+        Supports len(), iteration and indexing by position (slices give lists of
+        records) like the list it replaces.
+        """
+
+        def __init__(self, records: Iterable[Dict] = ()):
+                # 32-bit offsets and positions: up to 4 GB of number text and 2**31 numbers
+                self._blob = bytearray()
+                self._offsets = array("I", [0])
+                self._values = {name: _Values() for name, _ in COLUMNS}
+                self._columns = {name: array(typecode) for name, typecode in COLUMNS}
+                # Fields outside FIELDS, for the rare record that has them
+                self._extras: Dict[int, Dict[str, Any]] = {}
+                self._by_category: Dict[int, bytearray] = {}
+                self._by_category_status: Dict[Tuple[int, int], bytearray] = {}
+                self._counts: Dict[Tuple[int, int], int] = {}
+                self._load(records if isinstance(records, list) else list(records))
+
+        def _load(self, records: List[Dict]) -> None:
+                """Build every column and index in bulk; much faster than appending one record at a time."""
+                encoded = [str(record["number"]).encode("utf-8") for record in records]
+                self._blob = bytearray(b"".join(encoded))
+                self._offsets = array("I", accumulate(map(len, encoded), initial=0))
+                for name, typecode in COLUMNS:
+                        code = self._values[name].code
+                        self._columns[name] = array(typecode, [code(record.get(name, _MISSING)) for record in records])
+                for position, record in enumerate(records):
+                        if len(record) > len(FIELDS) or any(key not in FIELDS for key in record):
+                                extras = {k: v for k, v in record.items() if k not in FIELDS}
+                                if extras:
+                                        self._extras[position] = extras
+                size = max(16, 1 << (len(records) * 2).bit_length())
+                slots = array("i", [_EMPTY]) * size
+                mask = size - 1
+                for position, key in enumerate(encoded):
+                        i = zlib.crc32(key) & mask
+                        while True:
+                                found = slots[i]
+                                # A duplicated number resolves to its last record, as it always has
+                                if found == _EMPTY or encoded[found] == key:
+                                        slots[i] = position
+                                        break
+                                i = (i + 1) & mask
+                self._slots = slots
+                self._build_bitmaps()
+
+        def _build_bitmaps(self) -> None:
+                count = len(self)
+                self._by_category, self._by_category_status, self._counts = {}, {}, {}
+                categories = _code_masks(self._columns["category"].tobytes())
+                statuses = _code_masks(self._columns["status"].tobytes())
+                for category, category_mask in categories.items():
+                        self._by_category[category] = _bitmap_from_int(category_mask, count)
+                        for status, status_mask in statuses.items():
+                                both = category_mask & status_mask
+                                if both:
+                                        self._by_category_status[(category, status)] = _bitmap_from_int(both, count)
+                                        self._counts[(category, status)] = both.bit_count()
+
+        # Snapshots (see bot/snapshot.py)
+
+        def export_arrays(self) -> Tuple[Dict[str, Any], Dict[str, bytes]]:
+                """(tables, buffers): value tables and extras as plain data, and a copy of every array's bytes."""
+                tables = {
+                        "values": {name: values.values[1:] for name, values in self._values.items()},
+                        "extras": [[position, extras] for position, extras in self._extras.items()],
+                        "itemsizes": {name: column.itemsize for name, column in self._arrays().items()},
+                        "byteorder": sys.byteorder,
+                }
+                buffers = {"blob": bytes(self._blob)}
+                buffers.update((name, column.tobytes()) for name, column in self._arrays().items())
+                return tables, buffers
+
+        @classmethod
+        def from_arrays(cls, tables: Dict[str, Any], buffers: Dict[str, Any]) -> "NumberCatalogue":
+                """Inverse of export_arrays; the bitmaps are rebuilt from the status and category columns."""
+                catalogue = cls()
+                for name, values in tables["values"].items():
+                        for value in values:
+                                catalogue._values[name].code(value)
+                catalogue._blob = bytearray(buffers["blob"])
+                for name, column in catalogue._arrays().items():
+                        if tables["itemsizes"][name] != column.itemsize:
+                                raise ValueError(f"catalogue column '{name}' was written with {tables['itemsizes'][name]}-byte items, "
+                                                 f"this platform uses {column.itemsize}; export it to JSON on the old machine")
+                        del column[:]
+                        column.frombytes(buffers[name])
+                        if tables["byteorder"] != sys.byteorder:
+                                column.byteswap()
+                catalogue._extras = {position: extras for position, extras in tables["extras"]}
+                catalogue._build_bitmaps()
+                return catalogue
+
+        def _arrays(self) -> Dict[str, array]:
+                """Every array-backed column, by section name."""
+                arrays = {"offsets": self._offsets, "slots": self._slots}
+                arrays.update((f"column.{name}", column) for name, column in self._columns.items())
+                return arrays
+
+        # Number -> position hash table (linear probing, at most half full)
+
+        def _probe(self, key: bytes) -> int:
+                """Slot holding key, or the empty slot where it belongs."""
+                slots, blob, offsets = self._slots, self._blob, self._offsets
+                mask = len(slots) - 1
+                i = zlib.crc32(key) & mask
+                while True:
+                        position = slots[i]
+                        if position == _EMPTY or blob[offsets[position]:offsets[position + 1]] == key:
+                                return i
+                        i = (i + 1) & mask
+
+        def _resize(self, size: int) -> None:
+                self._slots = array("i", [_EMPTY]) * size
+                blob, offsets = self._blob, self._offsets
+                for position in range(len(self)):
+                        key = bytes(blob[offsets[position]:offsets[position + 1]])
+                        self._slots[self._probe(key)] = position
+
+        def position(self, number: str) -> Optional[int]:
+                position = self._slots[self._probe(number.encode("utf-8"))]
+                return None if position == _EMPTY else position
+
+        # Sequence protocol
+
+        def __len__(self) -> int:
+                return len(self._offsets) - 1
+
+        def __getitem__(self, index):
+                if isinstance(index, slice):
+                        return [NumberRecord(self, p) for p in range(len(self))[index]]
+                size = len(self._offsets) - 1
+                if index < 0:
+                        index += size
+                if not 0 <= index < size:
+                        raise IndexError("catalogue index out of range")
+                return NumberRecord(self, index)
+
+        def __iter__(self) -> Iterator[NumberRecord]:
+                return (NumberRecord(self, p) for p in range(len(self)))
+
+        def get(self, number: str) -> Optional[NumberRecord]:
+                position = self.position(number)
+                return None if position is None else NumberRecord(self, position)
+
+        # Fields
+
+        def number(self, position: int) -> str:
+                return self._blob[self._offsets[position]:self._offsets[position + 1]].decode("utf-8")
+
+        def field(self, position: int, key: str) -> Any:
+                if key == "number":
+                        return self.number(position)
+                column = self._columns.get(key)
+                if column is None:
+                        return self._extras.get(position, {}).get(key, _MISSING) if self._extras else _MISSING
+                return self._values[key].values[column[position]]
+
+        def keys(self, position: int) -> List[str]:
+                keys = ["number"] + [name for name, _ in COLUMNS if self._columns[name][position]]
+                return keys + list(self._extras.get(position, ()))
+
+        def set_field(self, position: int, key: str, value: Any) -> None:
+                if key == "number":
+                        if value != self.number(position):
+                                raise ValueError("a number cannot be renamed")
+                        return
+                column = self._columns.get(key)
+                if column is None:
+                        self._extras.setdefault(position, {})[key] = value
+                        return
+                old = column[position]
+                code = self._values[key].code(value)
+                if code == old:
+                        return
+                if key in ("status", "category"):
+                        self._unindex(position)
+                        column[position] = code
+                        self._index(position)
+                else:
+                        column[position] = code
+
+        def append(self, record: Dict) -> NumberRecord:
+                """Add a number at the end of the catalogue and return its record."""
+                key = str(record["number"]).encode("utf-8")
+                if (len(self) + 1) * 2 > len(self._slots):
+                        self._resize(len(self._slots) * 2)
+                slot = self._probe(key)
+                if self._slots[slot] != _EMPTY:
+                        raise ValueError(f"duplicate number {record['number']}")
+                position = len(self)
+                self._blob += key
+                self._offsets.append(len(self._blob))
+                self._slots[slot] = position
+                for name, _ in COLUMNS:
+                        self._columns[name].append(self._values[name].code(record.get(name, _MISSING)))
+                extras = {k: v for k, v in record.items() if k not in FIELDS}
+                if extras:
+                        self._extras[position] = extras
+                self._index(position)
+                return NumberRecord(self, position)
+
+        # Bitmap indexes
+
+        def _index(self, position: int) -> None:
+                category = self._columns["category"][position]
+                key = (category, self._columns["status"][position])
+                _set_bit(self._by_category.setdefault(category, bytearray()), position)
+                _set_bit(self._by_category_status.setdefault(key, bytearray()), position)
+                self._counts[key] = self._counts.get(key, 0) + 1
+
+        def _unindex(self, position: int) -> None:
+                category = self._columns["category"][position]
+                key = (category, self._columns["status"][position])
+                _clear_bit(self._by_category[category], position)
+                _clear_bit(self._by_category_status[key], position)
+                self._counts[key] -= 1
+
+        def _bitmap(self, category: str, status: Optional[str] = None) -> Optional[bytearray]:
+                category_code = self._values["category"].find(category)
+                if category_code is None:
+                        return None
+                if status is None:
+                        return self._by_category.get(category_code)
+                status_code = self._values["status"].find(status)
+                if status_code is None:
+                        return None
+                return self._by_category_status.get((category_code, status_code))
+
+        def positions(self, category: str, status: Optional[str] = None, start: int = 0) -> Iterator[int]:
+                """Positions in a category (and status), ascending from start."""
+                bitmap = self._bitmap(category, status)
+                return iter_bits(bitmap, start) if bitmap else iter(())
+
+        def positions_before(self, category: str, status: Optional[str], end: int) -> Iterator[int]:
+                """Positions in a category and status below end, descending."""
+                bitmap = self._bitmap(category, status)
+                return iter_bits_reverse(bitmap, end) if bitmap else iter(())
+
+        def first(self, category: str, status: str, count: int) -> List[NumberRecord]:
+                """The first count numbers of a category with the given status, in catalogue order."""
+                return [NumberRecord(self, p) for p in islice(self.positions(category, status), count)]
+
+        def select(self, category: Optional[str] = None, status: Optional[str] = None) -> List[NumberRecord]:
+                """Records filtered by category and/or status, in catalogue order."""
+                if category is not None:
+                        bitmap = self._bitmap(category, status)
+                        return [NumberRecord(self, p) for p in bit_positions(bitmap)] if bitmap else []
+                if status is None:
+                        return list(self)
+                code = self._values["status"].find(status)
+                # Union of the status's bitmaps across categories, as one big-int OR each
+                union = 0
+                for (_, s), bitmap in self._by_category_status.items():
+                        if s == code:
+                                union |= int.from_bytes(bitmap, "little")
+                return [NumberRecord(self, p) for p in bit_positions(union.to_bytes((union.bit_length() + 7) // 8, "little"))]
+
+        def counts(self) -> Dict[Tuple[Any, Any], int]:
+                """(category, status) -> how many numbers have it."""
+                categories, statuses = self._values["category"].values, self._values["status"].values
+                return {
+                        (categories[c] if c else None, statuses[s] if s else None): n
+                        for (c, s), n in self._counts.items()
+                }
+
+        # Serialization
+
+        def iter_json(self, indent: str = "    ") -> Iterator[str]:
+                """JSON text of every record, one object per item, without separators.
+
+                Column values come from the interned tables' cached JSON, so only
+                the number string is encoded per record.
+                """
+                blob, offsets = self._blob, self._offsets
+                columns = [(f', "{name}": ', self._columns[name], self._values[name].json) for name, _ in COLUMNS]
+                for position in range(len(self)):
+                        number = blob[offsets[position]:offsets[position + 1]].decode("utf-8")
+                        parts = [indent, '{"number": ', encode_basestring(number)]
+                        for prefix, column, texts in columns:
+                                code = column[position]
+                                if code:
+                                        parts.append(prefix)
+                                        parts.append(texts[code])
+                        extras = self._extras.get(position)
+                        if extras:
+                                for key, value in extras.items():
+                                        parts.append(f", {encode_basestring(key)}: {_to_json(value)}")
+                        parts.append("}")
+                        yield "".join(parts)
+
+        def to_json(self, indent: int = 2, level: int = 1) -> str:
+                """The catalogue as a JSON array, indented like json.dumps(indent=indent) at nesting level."""
+                if not len(self):
+                        return "[]"
+                inner = " " * (indent * (level + 1))
+                outer = " " * (indent * level)
+                return "[\n" + ",\n".join(self.iter_json(inner)) + "\n" + outer + "]"
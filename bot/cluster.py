@@ -0,0 +1,131 @@
+"""Several bot processes on one SQLite database.
+
+``BOT_WORKERS=N`` turns ``python -m bot.main`` into a supervisor that starts N
+worker processes and restarts any that crash. The workers share the webhook
+port (SO_REUSEPORT), so the kernel spreads Telegram's connections between
+them, and they share the state through the database: every read-modify-write
+is a single IMMEDIATE transaction and checkout sessions are stored there too.
+
+Background jobs (expiry, payment reconciliation, retention) run in one process
+only, the holder of the "background" lease. The leader renews it every ttl/3
+seconds; if it dies, another process takes over once the lease runs out. The
+jobs are idempotent (payments settle by compare-and-set, releases are
+transactional), so a stalled leader resuming next to its successor does no
+harm.
+"""
+import asyncio
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from typing import Awaitable, Callable, List
+from . import async_storage, metrics, storage
+
+# Worker processes started by python -m bot.main (webhook mode with SQLite storage only)
+BOT_WORKERS = max(1, int(os.getenv("BOT_WORKERS", "1")))
+# Set by the supervisor for each worker it starts
+IS_WORKER = "BOT_WORKER_INDEX" in os.environ
+WORKER_INDEX = int(os.getenv("BOT_WORKER_INDEX", "0"))
+# Seconds a leader keeps the background jobs without renewing its lease
+LEADER_LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", "15"))
+# Longest a background job sleeps when other processes may have changed the state
+SHARED_POLL_INTERVAL = float(os.getenv("SHARED_POLL_INTERVAL", "30"))
+# Seconds before a crashed worker is started again
+RESTART_DELAY = 1
+# Seconds workers get to drain on shutdown before they are killed
+STOP_TIMEOUT = 60
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def shared_storage() -> bool:
+        """True if other processes may change the state behind this one's back."""
+        return storage.STORAGE_BACKEND == "sqlite"
+
+
+class LeaderElection:
+        """Runs the registered jobs while this process holds the lease."""
+
+        def __init__(self, name: str = "background", ttl: float = LEADER_LEASE_TTL, owner: str = WORKER_ID):
+                self.name = name
+                self.ttl = ttl
+                self.owner = owner
+                self.is_leader = False
+                self._jobs: List[Callable[[], Awaitable[None]]] = []
+                self._tasks: List[asyncio.Task] = []
+
+        def add_job(self, job: Callable[[], Awaitable[None]]) -> None:
+                """Register a coroutine function to run while this process leads."""
+                self._jobs.append(job)
+
+        def _start_jobs(self) -> None:
+                self._tasks = [asyncio.create_task(job()) for job in self._jobs]
+
+        def _stop_jobs(self) -> None:
+                for task in self._tasks:
+                        task.cancel()
+                self._tasks = []
+
+        async def run(self) -> None:
+                metrics.leader.set(0)
+                while True:
+                        try:
+                                leader = await async_storage.acquire_lease(self.name, self.owner, self.ttl)
+                        except Exception:
+                                metrics.background_errors.inc(task="leader")
+                                leader = False
+                        if leader != self.is_leader:
+                                self.is_leader = leader
+                                metrics.leader.set(int(leader))
+                                if leader:
+                                        self._start_jobs()
+                                else:
+                                        self._stop_jobs()
+                        await asyncio.sleep(self.ttl / 3)
+
+        async def stop(self) -> None:
+                """Stop the jobs and hand the lease over without waiting for it to run out."""
+                self._stop_jobs()
+                if self.is_leader:
+                        self.is_leader = False
+                        try:
+                                await async_storage.release_lease(self.name, self.owner)
+                        except Exception:
+                                pass
+
+
+def supervise(workers: int = BOT_WORKERS) -> int:
+        """Run `workers` bot processes until SIGINT/SIGTERM, restarting crashed ones."""
+        stopping = False
+        procs: List[subprocess.Popen] = []
+
+        def spawn(index: int) -> subprocess.Popen:
+                env = dict(os.environ, BOT_WORKER_INDEX=str(index))
+                return subprocess.Popen([sys.executable, "-m", "bot.main"], env=env)
+
+        def stop(signum, frame) -> None:
+                nonlocal stopping
+                stopping = True
+                for proc in procs:
+                        if proc.poll() is None:
+                                proc.send_signal(signal.SIGTERM)
+
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+        procs.extend(spawn(index) for index in range(workers))
+        while not stopping:
+                for index, proc in enumerate(procs):
+                        if proc.poll() is not None and not stopping:
+                                print(f"worker {index} exited with {proc.returncode}, restarting", file=sys.stderr)
+                                time.sleep(RESTART_DELAY)
+                                procs[index] = spawn(index)
+                time.sleep(0.5)
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for proc in procs:
+                try:
+                        proc.wait(max(0.0, deadline - time.monotonic()))
+                except subprocess.TimeoutExpired:
+                        proc.kill()
+        return 0
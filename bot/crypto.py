@@ -1,33 +1,101 @@
+import asyncio
+import hashlib
+import hmac
+import time
 import aiohttp
-from typing import Optional, Dict
+from typing import Optional, Dict, List
+from . import metrics
+from .throttling import RateBudget
 
 API_URL = "https://pay.crypt.bot/api/"
 
+# Connection pool and timeouts for the shared session (seconds)
+POOL_LIMIT = 20
+KEEPALIVE_TIMEOUT = 60
+DNS_CACHE_TTL = 300
+REQUEST_TIMEOUT = 15
+CONNECT_TIMEOUT = 5
+
 class CryptoPay:
-	def __init__(self, token: str):
+	def __init__(self, token: str, api_url: str = API_URL, budget: Optional[RateBudget] = None):
 		self.token = token
+		self.api_url = api_url
+		# Shared limit on outbound requests; calls over budget fail like an API error
+		self.budget = budget
+		self._session: Optional[aiohttp.ClientSession] = None
+
+	def _get_session(self) -> aiohttp.ClientSession:
+		# One session per client: connections, DNS lookups and TLS sessions are reused
+		if self._session is None or self._session.closed:
+			connector = aiohttp.TCPConnector(
+				limit=POOL_LIMIT,
+				keepalive_timeout=KEEPALIVE_TIMEOUT,
+				ttl_dns_cache=DNS_CACHE_TTL,
+			)
+			self._session = aiohttp.ClientSession(
+				connector=connector,
+				headers={"Crypto-Pay-API-Token": self.token},
+				timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT, connect=CONNECT_TIMEOUT),
+			)
+		return self._session
+
+	async def close(self) -> None:
+		if self._session is not None and not self._session.closed:
+			await self._session.close()
+		self._session = None
+
+	def verify_webhook(self, body: bytes, signature: str) -> bool:
+		"""Check the crypto-pay-api-signature header: HMAC-SHA256 of the raw body keyed with SHA256(token)."""
+		secret = hashlib.sha256(self.token.encode()).digest()
+		expected = hmac.new(secret, body, hashlib.sha256).hexdigest()
+		return hmac.compare_digest(expected, signature or "")
 
 	async def _post(self, method: str, data: Dict) -> Dict:
-		headers = {"Crypto-Pay-API-Token": self.token}
-		async with aiohttp.ClientSession() as session:
-			async with session.post(API_URL + method, json=data, headers=headers) as resp:
+		if self.budget is not None and not await self.budget.acquire():
+			metrics.crypto_pay_errors.inc(method=method, kind="rate_limited")
+			return {"ok": False, "error": {"code": 429, "name": "RATE_LIMITED"}}
+		started = time.perf_counter()
+		try:
+			async with self._get_session().post(self.api_url + method, json=data) as resp:
 				resp.raise_for_status()
-				return await resp.json()
+				res = await resp.json()
+		except aiohttp.ClientResponseError:
+			metrics.crypto_pay_errors.inc(method=method, kind="http")
+			raise
+		except (aiohttp.ClientError, asyncio.TimeoutError):
+			metrics.crypto_pay_errors.inc(method=method, kind="network")
+			raise
+		finally:
+			metrics.crypto_pay_latency.observe(time.perf_counter() - started, method=method)
+		if not res.get("ok"):
+			metrics.crypto_pay_errors.inc(method=method, kind="api")
+		return res
 
-	async def create_invoice(self, amount: float, asset: str, description: str, payload: str) -> Optional[Dict]:
+	async def create_invoice(self, amount: float, asset: str, description: str, payload: str, expires_in: Optional[int] = None) -> Optional[Dict]:
 		data = {
 			"asset": asset,
 			"amount": str(amount),
 			"description": description,
 			"payload": payload,
 		}
+		if expires_in:
+			data["expires_in"] = expires_in
 		res = await self._post("createInvoice", data)
 		if res.get("ok"):
 			return res["result"]
 		return None
 
 	async def get_invoice(self, invoice_id: int) -> Optional[Dict]:
-		res = await self._post("getInvoices", {"invoice_ids": [invoice_id]})
-		if res.get("ok") and res["result"]["items"]:
-			return res["result"]["items"][0]
+		items = await self.get_invoices([invoice_id])
+		if items:
+			return items[0]
 		return None
+
+	async def get_invoices(self, invoice_ids: List[int]) -> List[Dict]:
+		"""Fetch several invoices in one request (Crypto Pay returns at most 1000 per call)."""
+		if not invoice_ids:
+			return []
+		res = await self._post("getInvoices", {"invoice_ids": list(invoice_ids), "count": len(invoice_ids)})
+		if res.get("ok"):
+			return res["result"]["items"]
+		return []
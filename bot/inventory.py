@@ -0,0 +1,216 @@
+"""Bulk inventory import and export.
+
+Supplier batches are CSV or JSON Lines files with one number per row::
+
+        number,category,type,price,status
+        +888 741 0385,anonymous,rent,25,free
+
+Only ``number`` and ``category`` are required; ``type`` and ``price`` default
+per category and ``status`` defaults to ``free``. Status ``retired`` takes a
+number off sale. Files are streamed: rows are validated and de-duplicated in
+chunks and every chunk is written with a single storage call.
+
+        python -m bot.inventory import numbers.csv
+        python -m bot.inventory export numbers.jsonl
+
+With the JSON backend run the CLI while the bot is stopped (or use the
+/inventory_import and /inventory_export admin commands); the SQLite backend
+accepts it at any time.
+"""
+import csv
+import json
+import math
+import os
+import sys
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from . import storage
+
+FIELDS = ("number", "category", "type", "price", "status")
+# category -> (type, price) used when a row leaves them empty
+CATEGORY_DEFAULTS = {
+        "anonymous": ("rent", 25),
+        "esim": ("sale", 15),
+        "physical": ("sale", 8),
+}
+STATUSES = ("free", "busy", "retired")
+# Numbers end up in callback data, which Telegram caps at 64 bytes; the longest,
+# "paid:{user_id}:{number}:{months}:{ts}", leaves about 34 bytes for the number.
+# Callback data is split on ":", so a number must not contain one.
+MAX_NUMBER_BYTES = 32
+
+IMPORT_CHUNK_SIZE = int(os.getenv("INVENTORY_IMPORT_CHUNK_SIZE", "1000"))
+# Invalid rows listed in a report; the rest are only counted
+MAX_REPORTED_ERRORS = 20
+
+
+def _file_format(path: str) -> str:
+        ext = os.path.splitext(path)[1].lower()
+        if ext == ".csv":
+                return "csv"
+        if ext in (".jsonl", ".ndjson"):
+                return "jsonl"
+        raise ValueError(f"Unsupported file type '{ext}'. Use .csv or .jsonl")
+
+
+def read_rows(path: str) -> Iterator[Tuple[int, Dict]]:
+        """Yield (line number, raw row) from a CSV or JSON Lines file without loading it whole."""
+        fmt = _file_format(path)
+        with open(path, "r", encoding="utf-8-sig", newline="") as f:
+                if fmt == "csv":
+                        reader = csv.DictReader(f)
+                        for row in reader:
+                                yield reader.line_num, row
+                        return
+                for line_no, line in enumerate(f, 1):
+                        line = line.strip()
+                        if not line:
+                                continue
+                        try:
+                                row = json.loads(line)
+                        except ValueError:
+                                row = None
+                        yield line_no, row if isinstance(row, dict) else {"_invalid": "not a JSON object"}
+
+
+def validate_row(row: Dict) -> Dict:
+        """Normalize a raw row into a number record. Raises ValueError on bad input."""
+        if "_invalid" in row:
+                raise ValueError(row["_invalid"])
+        number = str(row.get("number") or "").strip()
+        if not number:
+                raise ValueError("number is empty")
+        if ":" in number:
+                raise ValueError("number must not contain ':'")
+        if len(number.encode("utf-8")) > MAX_NUMBER_BYTES:
+                raise ValueError(f"number is longer than {MAX_NUMBER_BYTES} bytes")
+        category = str(row.get("category") or "").strip().lower()
+        if category not in CATEGORY_DEFAULTS:
+                raise ValueError(f"unknown category '{category}'")
+        default_type, default_price = CATEGORY_DEFAULTS[category]
+        num_type = str(row.get("type") or default_type).strip().lower()
+        if num_type not in ("rent", "sale"):
+                raise ValueError(f"unknown type '{num_type}'")
+        price = row.get("price")
+        if price in (None, ""):
+                price = default_price
+        else:
+                try:
+                        price = float(price)
+                except (TypeError, ValueError):
+                        raise ValueError(f"price '{price}' is not a number")
+                if not math.isfinite(price) or price <= 0:
+                        raise ValueError("price must be a positive finite number")
+                if price.is_integer():
+                        price = int(price)
+        status = str(row.get("status") or "free").strip().lower()
+        if status not in STATUSES:
+                raise ValueError(f"unknown status '{status}'")
+        return {"number": number, "status": status, "category": category, "type": num_type, "price": price}
+
+
+def _new_report() -> Dict:
+        return {
+                "rows": 0, "invalid": 0, "duplicates": 0,
+                "added": 0, "updated": 0, "retired": 0, "unchanged": 0, "in_use": 0,
+                "errors": [], "seconds": 0.0,
+        }
+
+
+def iter_chunks(path: str, report: Dict, chunk_size: int = IMPORT_CHUNK_SIZE) -> Iterator[List[Dict]]:
+        """Validated records in chunks; the first row for a number wins, later ones count as duplicates."""
+        seen = set()
+        chunk: List[Dict] = []
+        for line_no, row in read_rows(path):
+                report["rows"] += 1
+                try:
+                        record = validate_row(row)
+                except ValueError as exc:
+                        report["invalid"] += 1
+                        if len(report["errors"]) < MAX_REPORTED_ERRORS:
+                                report["errors"].append(f"line {line_no}: {exc}")
+                        continue
+                if record["number"] in seen:
+                        report["duplicates"] += 1
+                        continue
+                seen.add(record["number"])
+                chunk.append(record)
+                if len(chunk) >= chunk_size:
+                        yield chunk
+                        chunk = []
+        if chunk:
+                yield chunk
+
+
+def import_file(path: str, chunk_size: int = IMPORT_CHUNK_SIZE,
+                apply: Optional[Callable[[List[Dict]], Dict[str, int]]] = None) -> Dict:
+        """Stream a CSV/JSONL file into the inventory. Returns a report of counts and timing.
+
+        apply writes one chunk and returns its counts (storage.upsert_numbers by default).
+        """
+        apply = apply or storage.upsert_numbers
+        report = _new_report()
+        started = time.perf_counter()
+        for chunk in iter_chunks(path, report, chunk_size):
+                for key, value in apply(chunk).items():
+                        report[key] += value
+        report["seconds"] = time.perf_counter() - started
+        return report
+
+
+def export_file(path: str, chunk_size: int = IMPORT_CHUNK_SIZE) -> Dict:
+        """Write the whole inventory to a CSV/JSONL file chunk by chunk."""
+        fmt = _file_format(path)
+        started = time.perf_counter()
+        rows = 0
+        with open(path, "w", encoding="utf-8", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=FIELDS, extrasaction="ignore") if fmt == "csv" else None
+                if writer:
+                        writer.writeheader()
+                cursor: Optional[int] = -1
+                while cursor is not None:
+                        records, cursor = storage.scan_numbers(cursor, chunk_size)
+                        if writer:
+                                writer.writerows(records)
+                        else:
+                                f.writelines(json.dumps({k: r.get(k) for k in FIELDS}, ensure_ascii=False) + "\n" for r in records)
+                        rows += len(records)
+        return {"rows": rows, "seconds": time.perf_counter() - started}
+
+
+def _rate(report: Dict) -> str:
+        seconds = report["seconds"]
+        return f"{report['rows'] / seconds:,.0f} rows/s" if seconds > 0 else "n/a"
+
+
+def format_import_report(report: Dict) -> str:
+        lines = [
+                f"Rows: {report['rows']} in {report['seconds']:.2f}s ({_rate(report)})",
+                f"Added: {report['added']}, updated: {report['updated']}, retired: {report['retired']}, unchanged: {report['unchanged']}",
+                f"Skipped: {report['invalid']} invalid, {report['duplicates']} duplicate, {report['in_use']} rented or reserved (not retired)",
+        ]
+        lines.extend(report["errors"])
+        if report["invalid"] > len(report["errors"]):
+                lines.append(f"... and {report['invalid'] - len(report['errors'])} more invalid rows")
+        return "\n".join(lines)
+
+
+def format_export_report(report: Dict) -> str:
+        return f"Exported {report['rows']} numbers in {report['seconds']:.2f}s ({_rate(report)})"
+
+
+if __name__ == "__main__":
+        if len(sys.argv) != 3 or sys.argv[1] not in ("import", "export"):
+                print("Usage: python -m bot.inventory import|export <file.csv|file.jsonl>")
+                sys.exit(2)
+        try:
+                if sys.argv[1] == "import":
+                        print(format_import_report(import_file(sys.argv[2])))
+                else:
+                        print(format_export_report(export_file(sys.argv[2])))
+        except (OSError, ValueError) as exc:
+                print(f"Error: {exc}")
+                sys.exit(1)
+        finally:
+                # Write the JSON state out before exiting
+                storage.close()
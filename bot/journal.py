@@ -0,0 +1,225 @@
+"""Append-only journal of the JSON backend's state changes.
+
+Every mutation appends one small record, the new value of the entry it
+touched:
+
+        frame    length (u32) | crc32 (u32) | JSON [collection, key, value]
+
+A value of null removes the entry. Records are buffered in memory and a
+background thread writes whatever has accumulated with one write() and one
+fsync() (group commit): while one batch is being synced the next one
+fills up, so a burst of writes costs a few fsyncs instead of one each.
+
+The journal is split into generations, ``<STATE_JOURNAL_FILE>.<n>``. The
+state file records the first generation it does not contain; compaction
+(see storage.flush) starts a new generation, writes the state and removes
+the older files. Replaying a record twice is harmless, so a crash at any
+point leaves the state file plus the remaining generations consistent. A
+torn record at the end of a file (a crash mid-write) ends that file's
+replay.
+"""
+import glob
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+from typing import Any, Callable, Iterator, List, Optional, Tuple, Union
+from . import metrics
+
+_FRAME = struct.Struct("<II")
+
+# Pause before retrying a failed write; the records stay buffered meanwhile
+RETRY_DELAY = 1.0
+
+
+def encode(collection: str, key: str, value: Any) -> bytes:
+        payload = json.dumps([collection, key, value], ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        return _FRAME.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def read(path: str) -> Iterator[Tuple[str, str, Any]]:
+        """Records of one journal file in order, up to the first torn or corrupt one."""
+        with open(path, "rb") as f:
+                data = f.read()
+        offset = 0
+        while offset + _FRAME.size <= len(data):
+                length, crc = _FRAME.unpack_from(data, offset)
+                payload = data[offset + _FRAME.size:offset + _FRAME.size + length]
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                        return
+                collection, key, value = json.loads(payload)
+                yield collection, key, value
+                offset += _FRAME.size + length
+
+
+def generations(prefix: str) -> List[Tuple[int, str]]:
+        """(generation, path) of every journal file for prefix, oldest first."""
+        found = []
+        for path in glob.glob(glob.escape(prefix) + ".*"):
+                suffix = path[len(prefix) + 1:]
+                if suffix.isdigit():
+                        found.append((int(suffix), path))
+        return sorted(found)
+
+
+def remove_before(prefix: str, generation: int) -> None:
+        """Delete the journal files older than generation (they are in the state file)."""
+        for number, path in generations(prefix):
+                if number < generation:
+                        try:
+                                os.remove(path)
+                        except FileNotFoundError:
+                                pass
+
+
+def _fsync_dir(path: str) -> None:
+        try:
+                fd = os.open(os.path.dirname(path), os.O_RDONLY)
+        except OSError:  # not supported on this platform
+                return
+        try:
+                os.fsync(fd)
+        finally:
+                os.close(fd)
+
+
+class Journal:
+        """The open journal: append() buffers a record, a writer thread makes it durable."""
+
+        def __init__(self, prefix: str, generation: int):
+                self.prefix = prefix
+                self.generation = generation
+                # Bytes appended to the current generation, written or not
+                self.size = 0
+                self._cond = threading.Condition()
+                # Encoded records, and ints marking the start of a new generation
+                self._buffer: List[Union[bytes, int]] = []
+                self._appended = 0
+                self._synced = 0
+                self._file = None
+                self._stop = False
+                self._listeners: List[Callable[[int], None]] = []
+                self._thread = threading.Thread(target=self._run, name="state-journal", daemon=True)
+                self._open(generation)
+                self._thread.start()
+
+        @property
+        def appended(self) -> int:
+                """Sequence number of the last appended record."""
+                return self._appended
+
+        @property
+        def synced(self) -> int:
+                """Sequence number of the last record known to be on disk."""
+                return self._synced
+
+        def on_sync(self, callback: Callable[[int], None]) -> None:
+                """Register a callback fired with the synced sequence number after every fsync.
+
+                Callbacks run on the journal thread; they must only schedule work.
+                """
+                self._listeners.append(callback)
+
+        def append(self, collection: str, key: str, value: Any) -> int:
+                """Buffer a record; returns its sequence number (see wait)."""
+                frame = encode(collection, key, value)
+                with self._cond:
+                        self._buffer.append(frame)
+                        self.size += len(frame)
+                        self._appended += 1
+                        self._cond.notify_all()
+                        return self._appended
+
+        def rotate(self) -> int:
+                """Send later records to the next generation. Returns the new generation."""
+                with self._cond:
+                        self.generation += 1
+                        self.size = 0
+                        self._buffer.append(self.generation)
+                        self._cond.notify_all()
+                        return self.generation
+
+        def wait(self, seq: Optional[int] = None, timeout: Optional[float] = None) -> bool:
+                """Block until record seq (the last appended by default) is on disk."""
+                with self._cond:
+                        seq = self._appended if seq is None else seq
+                        return self._cond.wait_for(lambda: self._synced >= seq, timeout)
+
+        def close(self) -> None:
+                """Write out everything buffered and stop the writer thread."""
+                with self._cond:
+                        self._stop = True
+                        self._cond.notify_all()
+                self._thread.join()
+                if self._file is not None:
+                        empty = os.fstat(self._file.fileno()).st_size == 0
+                        self._file.close()
+                        if empty:
+                                # Nothing to replay; a clean shutdown leaves no journal behind
+                                os.remove(self._file.name)
+                        self._file = None
+
+        def _open(self, generation: int) -> None:
+                if self._file is not None:
+                        self._file.close()
+                path = f"{self.prefix}.{generation}"
+                # Unbuffered: a failed write can be cut back to the last whole record
+                self._file = open(path, "ab", buffering=0)
+                _fsync_dir(path)
+
+        def _run(self) -> None:
+                while True:
+                        with self._cond:
+                                while not self._buffer and not self._stop:
+                                        self._cond.wait()
+                                if not self._buffer:
+                                        return
+                                batch, self._buffer = self._buffer, []
+                                seq = self._appended
+                        started = time.perf_counter()
+                        try:
+                                written = self._write(batch)
+                        except OSError:
+                                # Put the batch back in front of anything appended since and retry
+                                with self._cond:
+                                        self._buffer[:0] = batch
+                                time.sleep(RETRY_DELAY)
+                                continue
+                        metrics.storage_seconds.observe(time.perf_counter() - started, op="journal")
+                        metrics.storage_bytes.inc(written, op="journal")
+                        with self._cond:
+                                self._synced = seq
+                                self._cond.notify_all()
+                        for callback in self._listeners:
+                                callback(seq)
+
+        def _write(self, batch: List[Union[bytes, int]]) -> int:
+                written = 0
+                chunk: List[bytes] = []
+                for item in batch:
+                        if isinstance(item, int):
+                                written += self._flush(chunk)
+                                chunk = []
+                                self._open(item)
+                        else:
+                                chunk.append(item)
+                return written + self._flush(chunk)
+
+        def _flush(self, chunk: List[bytes]) -> int:
+                if not chunk:
+                        return 0
+                data = b"".join(chunk)
+                fd = self._file.fileno()
+                start = os.fstat(fd).st_size
+                try:
+                        view = memoryview(data)
+                        while view:
+                                view = view[self._file.write(view):]
+                        os.fsync(fd)
+                except OSError:
+                        # Drop a partial write, so a retry does not leave a torn record mid-file
+                        os.ftruncate(fd, start)
+                        raise
+                return len(data)
@@ -1,5 +1,5 @@
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
-from typing import List, Dict
+from typing import Dict, Hashable, List, Optional, Tuple
 from .prices import get_price
 
 MAIN_KB = ReplyKeyboardMarkup(
@@ -14,15 +14,46 @@ RED_CIRCLE = "🔴"
 GREEN_CIRCLE = "🟢"
 
 
+CATEGORY_KB = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🎭 Анонимные номера", callback_data="cat:anonymous")],
+        [InlineKeyboardButton(text="📱 eSIM (Продажа)", callback_data="cat:esim")],
+        [InlineKeyboardButton(text="📞 Физические SIM (Продажа)", callback_data="cat:physical")],
+])
+
+
 def category_keyboard() -> InlineKeyboardMarkup:
-        return InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🎭 Анонимные номера", callback_data="cat:anonymous")],
-                [InlineKeyboardButton(text="📱 eSIM (Продажа)", callback_data="cat:esim")],
-                [InlineKeyboardButton(text="📞 Физические SIM (Продажа)", callback_data="cat:physical")],
-        ])
+        return CATEGORY_KB
 
 
-def numbers_inline_keyboard(numbers: List[Dict]) -> InlineKeyboardMarkup:
+class KeyboardCache:
+        """Rendered markups keyed by view, each valid for a single inventory version.
+
+        Only the latest version of a view is kept, and at most max_entries views
+        (the oldest is dropped first), so paging through a large category cannot
+        grow the cache without bound.
+        """
+
+        def __init__(self, max_entries: int = 1024) -> None:
+                self.max_entries = max_entries
+                self._entries: Dict[Hashable, Tuple[int, InlineKeyboardMarkup]] = {}
+
+        def get(self, key: Hashable, version: int) -> Optional[InlineKeyboardMarkup]:
+                entry = self._entries.get(key)
+                if entry and entry[0] == version:
+                        return entry[1]
+                return None
+
+        def put(self, key: Hashable, version: int, markup: InlineKeyboardMarkup) -> None:
+                self._entries.pop(key, None)
+                if len(self._entries) >= self.max_entries:
+                        del self._entries[next(iter(self._entries))]
+                self._entries[key] = (version, markup)
+
+
+numbers_keyboard_cache = KeyboardCache()
+
+
+def _number_rows(numbers: List[Dict]) -> List[List[InlineKeyboardButton]]:
         rows = []
         for item in numbers:
                 num_type = item.get('type', 'rent')
@@ -37,6 +68,51 @@ def numbers_inline_keyboard(numbers: List[Dict]) -> InlineKeyboardMarkup:
                 rows.append([
                         InlineKeyboardButton(text=label, callback_data=f"num:{item['number']}")
                 ])
+        return rows
+
+
+def numbers_inline_keyboard(numbers: List[Dict]) -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup(inline_keyboard=_number_rows(numbers))
+
+
+def page_callback(category: str, only_free: bool, direction: str = "", cursor: Optional[Tuple[int, int]] = None) -> str:
+        """callback_data for a numbers page: pg:<category>:<a|f>[:<n|p>:<rank>:<position>].
+
+        Without a cursor it opens the first page. "n" pages forward from the
+        cursor, "p" pages back; either way it stays far below Telegram's 64 bytes.
+        """
+        data = f"pg:{category}:{'f' if only_free else 'a'}"
+        if cursor is not None:
+                data += f":{direction}:{cursor[0]}:{cursor[1]}"
+        return data
+
+
+def parse_page_callback(data: str) -> Tuple[str, bool, Optional[Tuple[int, int]], Optional[Tuple[int, int]]]:
+        """Inverse of page_callback: (category, only_free, after, before)."""
+        parts = data.split(":")
+        category, only_free = parts[1], parts[2] == "f"
+        after = before = None
+        if len(parts) == 6:
+                cursor = (int(parts[4]), int(parts[5]))
+                if parts[3] == "p":
+                        before = cursor
+                else:
+                        after = cursor
+        return category, only_free, after, before
+
+
+def numbers_page_keyboard(category: str, page: Dict, only_free: bool) -> InlineKeyboardMarkup:
+        """One page of numbers with prev/next arrows and the "only free" toggle."""
+        rows = _number_rows(page["items"])
+        nav = []
+        if page["prev"] is not None:
+                nav.append(InlineKeyboardButton(text="◀️ Назад", callback_data=page_callback(category, only_free, "p", page["prev"])))
+        if page["next"] is not None:
+                nav.append(InlineKeyboardButton(text="Далее ▶️", callback_data=page_callback(category, only_free, "n", page["next"])))
+        if nav:
+                rows.append(nav)
+        toggle = "📋 Показать все" if only_free else f"{GREEN_CIRCLE} Только свободные"
+        rows.append([InlineKeyboardButton(text=toggle, callback_data=page_callback(category, not only_free))])
         return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
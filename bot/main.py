@@ -1,47 +1,182 @@
 import os
 import asyncio
+import signal
 from datetime import datetime
+from typing import Optional
+from aiohttp import web
 from aiogram import Bot, Dispatcher, Router, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import CommandStart, Command
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.types import Message, CallbackQuery, FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton
 # removed config import to avoid .env RuntimeError
-from .keyboards import MAIN_KB, numbers_inline_keyboard, durations_keyboard, RED_CIRCLE, GREEN_CIRCLE, payment_keyboard, promo_choice_keyboard, profile_keyboard, category_keyboard
-from . import storage
+from .keyboards import MAIN_KB, numbers_page_keyboard, numbers_keyboard_cache, parse_page_callback, durations_keyboard, RED_CIRCLE, GREEN_CIRCLE, payment_keyboard, promo_choice_keyboard, profile_keyboard, category_keyboard
+from . import inventory, metrics, storage, async_storage
+from .cluster import BOT_WORKERS, IS_WORKER, SHARED_POLL_INTERVAL, WORKER_INDEX, LeaderElection, shared_storage, supervise
 from .prices import PRICES
-from .crypto import CryptoPay
+from .profiling import MODES as PROFILING_MODES, PROFILING, ProfilingMiddleware, profiler
+from .sessions import checkout_sessions
+from .throttling import ThrottlingMiddleware, crypto_pay_budget
+from .crypto import CryptoPay, API_URL
+from .payments import PaymentReconciler, RECONCILE_MAX_INTERVAL, RECONCILE_MIN_INTERVAL, crypto_pay_webhook_handler, format_until, retention_worker, settle_payment
+from .storage import ISO_FORMAT
+from .webhook import TelegramWebhookHandler, default_secret_token
+import tempfile
 import time
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not BOT_TOKEN:
         raise RuntimeError("BOT_TOKEN is not set. Please add it to your environment variables.")
 
+# Bot API server, e.g. a self-hosted telegram-bot-api or the load-test stand-in; empty means api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").rstrip("/")
 CRYPTO_PAY_TOKEN = os.getenv("CRYPTO_PAY_TOKEN", "")
+CRYPTO_PAY_API_URL = os.getenv("CRYPTO_PAY_API_URL", API_URL)
+# Path for Crypto Pay "invoice_paid" webhooks; empty disables the receiver
+CRYPTO_PAY_WEBHOOK_PATH = os.getenv("CRYPTO_PAY_WEBHOOK_PATH", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+
+# Update transport: "polling" (default) or "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+# Public base URL Telegram delivers to, e.g. https://bot.example.com
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL", "").rstrip("/")
+TELEGRAM_WEBHOOK_PATH = os.getenv("TELEGRAM_WEBHOOK_PATH", "/telegram")
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET", "") or default_secret_token(BOT_TOKEN)
+# Updates processed at once in webhook mode (also Telegram's max_connections, capped at 100)
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "40"))
+# Seconds to wait for in-flight updates on shutdown
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "30"))
+
+if BOT_MODE not in ("polling", "webhook"):
+        raise RuntimeError(f"Unknown BOT_MODE '{BOT_MODE}'. Use 'polling' or 'webhook'.")
+if BOT_MODE == "webhook" and not TELEGRAM_WEBHOOK_URL:
+        raise RuntimeError("TELEGRAM_WEBHOOK_URL is not set. It is required when BOT_MODE=webhook.")
+if BOT_WORKERS > 1 and BOT_MODE != "webhook":
+        raise RuntimeError("BOT_WORKERS > 1 requires BOT_MODE=webhook: Telegram allows only one getUpdates poller.")
+if PROFILING and PROFILING not in PROFILING_MODES:
+        raise RuntimeError(f"Unknown PROFILING '{PROFILING}'. Use 'sample' or 'cprofile'.")
+if BOT_WORKERS > 1 and not shared_storage():
+        raise RuntimeError("BOT_WORKERS > 1 requires STORAGE_BACKEND=sqlite: the JSON state belongs to one process.")
 try:
         ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
 except Exception:
         ADMIN_ID = 0
 
+# How long a number stays reserved for an unpaid invoice (seconds); invoices expire at the same time
+RESERVATION_TTL = int(os.getenv("RESERVATION_TTL", "900"))
+# Numbers shown per page when browsing a category
+NUMBERS_PAGE_SIZE = int(os.getenv("NUMBERS_PAGE_SIZE", "10"))
+# Local endpoint serving /metrics in the Prometheus text format; port 0 disables it
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+
 router = Router()
+handler_metrics = metrics.HandlerMetricsMiddleware()
+router.message.middleware(handler_metrics)
+router.callback_query.middleware(handler_metrics)
+# Handler timings for /perf; a no-op while profiling is off
+handler_profiling = ProfilingMiddleware()
+router.message.middleware(handler_profiling)
+router.callback_query.middleware(handler_profiling)
+
+crypto_client = CryptoPay(CRYPTO_PAY_TOKEN, CRYPTO_PAY_API_URL, budget=crypto_pay_budget) if CRYPTO_PAY_TOKEN else None
+crypto_webhook_enabled = bool(crypto_client and CRYPTO_PAY_WEBHOOK_PATH)
+reconciler = None
+if crypto_client:
+        # With webhooks the reconciler only backstops missed deliveries, so it polls at the slowest rate.
+        # Invoices issued by other processes cannot poke it, so with shared storage it never sleeps indefinitely.
+        reconciler = PaymentReconciler(
+                crypto_client,
+                min_interval=RECONCILE_MAX_INTERVAL if crypto_webhook_enabled else RECONCILE_MIN_INTERVAL,
+                idle_interval=SHARED_POLL_INTERVAL if shared_storage() else None,
+        )
+
+
+async def _collect_storage_metrics() -> None:
+        metrics.pending_payments.set(await async_storage.pending_payment_count())
+        metrics.inventory_numbers.clear()
+        for (category, status), count in (await async_storage.inventory_counts()).items():
+                metrics.inventory_numbers.set(count, category=category, status=status)
+
+
+async def _collect_throttling_metrics() -> None:
+        for outcome, counts in (("passed", throttling.passed), ("deferred", throttling.deferred), ("dropped", throttling.dropped)):
+                for kind, count in counts.items():
+                        metrics.throttled_updates.set_total(count, outcome=outcome, **{"class": kind})
+        for outcome in ("granted", "deferred", "rejected"):
+                metrics.crypto_pay_budget.set_total(getattr(crypto_pay_budget, outcome), outcome=outcome)
+
+
+metrics.add_collector(_collect_storage_metrics)
+metrics.add_collector(_collect_throttling_metrics)
+
+
+class Checkout(StatesGroup):
+        # Duration chosen, waiting for a promo code or "skip"
+        # Data: {"number": str, "months": int, "price": float}
+        promo = State()
+
 
-crypto_client = CryptoPay(CRYPTO_PAY_TOKEN) if CRYPTO_PAY_TOKEN else None
+# Per-user rate limits; the owner is never throttled. A promo code answer creates an invoice
+throttling = ThrottlingMiddleware(exempt=[ADMIN_ID] if ADMIN_ID else (), payment_states=[Checkout.promo.state])
 
-# Temporary storage for users waiting to enter promo code
-# Format: {user_id: {"number": str, "months": int, "price": float}}
-pending_promo_state = {}
 
+async def _save_pending_payment(payment_id: str, payment_data: dict) -> None:
+        payment_data.setdefault("created_at", datetime.utcnow().strftime(ISO_FORMAT))
+        await async_storage.create_pending_payment(payment_id, payment_data)
+        # Let the reconciler pick the new invoice up without waiting for its back-off
+        if reconciler:
+                reconciler.poke()
 
-def _format_until(until_iso: str) -> str:
+
+async def _create_held_invoice(number: str, payment_id: str, amount: float, description: str) -> Optional[dict]:
+        """Create the Crypto Pay invoice for a held number; releases the hold unless it succeeds.
+
+        Returns None when the invoice could not be created.
+        """
+        invoice = None
         try:
-                return datetime.strptime(until_iso, "%Y-%m-%dT%H:%M:%S").strftime("%d.%m.%Y %H:%M UTC")
+                invoice = await crypto_client.create_invoice(amount=amount, asset="USDT", description=description, payload=payment_id, expires_in=RESERVATION_TTL)
         except Exception:
-                return until_iso
+                # Network or HTTP error; counted in crypto_pay_errors
+                pass
+        finally:
+                if not invoice:
+                        await async_storage.release_hold(number, payment_id)
+        return invoice
+
+
+async def _numbers_page_markup(category: str, only_free: bool = False, after=None, before=None) -> Optional[InlineKeyboardMarkup]:
+        """Keyboard for one page of a category, rebuilt only when the inventory version changes.
+
+        Returns None when the page is empty.
+        """
+        key = (category, only_free, after, before)
+        version = await async_storage.inventory_version()
+        markup = numbers_keyboard_cache.get(key, version)
+        if markup is None:
+                page = await async_storage.page_numbers(category, NUMBERS_PAGE_SIZE, after, before, only_free)
+                if not page["items"]:
+                        return None
+                markup = numbers_page_keyboard(category, page, only_free)
+                numbers_keyboard_cache.put(key, version, markup)
+        return markup
+
+
+async def _reserved_by_other(number: str, user_id: int) -> bool:
+        """True if another user holds an open invoice for the number."""
+        hold = await async_storage.get_hold(number)
+        return bool(hold) and hold["user_id"] != user_id
 
 
 @router.message(CommandStart())
 async def start(message: Message):
         # Register user
         username = message.from_user.username
-        storage.register_user(message.from_user.id, username)
+        await async_storage.register_user(message.from_user.id, username)
         
         await message.answer(
                 "Добро пожаловать в Shadow Numbers!\nВыберите действие ниже.",
@@ -84,7 +219,7 @@ async def list_numbers(message: Message):
 @router.callback_query(F.data.startswith("cat:"))
 async def select_category(callback: CallbackQuery):
         category = callback.data.split(":", 1)[1]
-        numbers = storage.list_numbers(category=category)
+        markup = await _numbers_page_markup(category)
         
         category_names = {
                 "anonymous": "🎭 Анонимные номера (Аренда)",
@@ -93,28 +228,42 @@ async def select_category(callback: CallbackQuery):
         }
         category_name = category_names.get(category, category)
         
-        if not numbers:
+        if markup is None:
                 await callback.answer(f"В категории '{category_name}' пока нет номеров", show_alert=True)
                 return
         
         await callback.message.edit_text(
                 f"{category_name}\n\nВыберите номер:",
-                reply_markup=numbers_inline_keyboard(numbers)
+                reply_markup=markup
         )
         await callback.answer()
 
 
+@router.callback_query(F.data.startswith("pg:"))
+async def page_numbers(callback: CallbackQuery):
+        category, only_free, after, before = parse_page_callback(callback.data)
+        markup = await _numbers_page_markup(category, only_free, after, before)
+        if markup is None and (after or before):
+                # The numbers around the cursor changed status; start over from the first page
+                markup = await _numbers_page_markup(category, only_free)
+        if markup is None:
+                await callback.answer("Свободных номеров сейчас нет" if only_free else "В категории пока нет номеров", show_alert=True)
+                return
+        await callback.message.edit_reply_markup(reply_markup=markup)
+        await callback.answer()
+
+
 @router.callback_query(F.data.startswith("num:"))
 async def pick_number(callback: CallbackQuery):
         number = callback.data.split(":", 1)[1]
-        item = storage.get_number(number)
-        if not item:
+        item = await async_storage.get_number(number)
+        if not item or item["status"] == "retired":
                 await callback.answer("Номер не найден", show_alert=True)
                 return
-        if item["status"] == "busy":
+        if item["status"] == "busy" or await _reserved_by_other(number, callback.from_user.id):
                 await callback.message.edit_text(
                         f"{RED_CIRCLE} {number} — занят. Выберите другой номер.",
-                        reply_markup=numbers_inline_keyboard(storage.list_numbers()),
+                        reply_markup=await _numbers_page_markup(item.get("category")),
                 )
                 await callback.answer()
                 return
@@ -147,20 +296,25 @@ async def pick_number(callback: CallbackQuery):
 @router.callback_query(F.data.startswith("buy:"))
 async def buy_number(callback: CallbackQuery):
         number = callback.data.split(":", 1)[1]
-        item = storage.get_number(number)
-        if not item:
+        item = await async_storage.get_number(number)
+        if not item or item["status"] == "retired":
                 await callback.answer("Номер не найден", show_alert=True)
                 return
         if item["status"] == "busy":
                 await callback.answer("Номер уже продан", show_alert=True)
                 return
+        if await _reserved_by_other(number, callback.from_user.id):
+                await callback.answer("Номер забронирован другим покупателем. Попробуйте позже.", show_alert=True)
+                return
         
         price = item.get("price", 15)
         
         # For sale, we don't need promo codes - just process payment directly
         if not crypto_client:
                 # Fallback without crypto: mark as sold
-                storage.set_number_status(number, "busy")
+                if not await async_storage.claim_number(number, callback.from_user.id):
+                        await callback.answer("Номер уже продан", show_alert=True)
+                        return
                 await callback.message.edit_text(
                         f"✅ Номер {number} успешно куплен!\n"
                         f"Цена: ${price}\n\n"
@@ -173,7 +327,11 @@ async def buy_number(callback: CallbackQuery):
         payment_id = f"{callback.from_user.id}:{number}:sale:{int(time.time())}"
         description = f"Покупка номера {number}"
         
-        invoice = await crypto_client.create_invoice(amount=price, asset="USDT", description=description, payload=payment_id)
+        # Reserve the number for the lifetime of the invoice
+        if not await async_storage.hold_number(number, payment_id, callback.from_user.id, RESERVATION_TTL):
+                await callback.answer("Номер уже продан", show_alert=True)
+                return
+        invoice = await _create_held_invoice(number, payment_id, price, description)
         if not invoice:
                 await callback.answer("Не удалось создать счёт. Повторите позже.", show_alert=True)
                 return
@@ -188,7 +346,7 @@ async def buy_number(callback: CallbackQuery):
                 "type": "sale"
         }
         
-        storage.create_pending_payment(payment_id, payment_data)
+        await _save_pending_payment(payment_id, payment_data)
         pay_url = invoice.get("pay_url") or invoice.get("bot_invoice_url")
         
         await callback.message.edit_text(
@@ -202,13 +360,13 @@ async def buy_number(callback: CallbackQuery):
 
 
 @router.callback_query(F.data.startswith("dur:"))
-async def rent_duration(callback: CallbackQuery):
+async def rent_duration(callback: CallbackQuery, state: FSMContext):
         _, months_str, number = callback.data.split(":", 2)
         months = int(months_str)
         
         # Get number info to retrieve individual price
-        num_info = storage.get_number(number)
-        if not num_info:
+        num_info = await async_storage.get_number(number)
+        if not num_info or num_info["status"] == "retired":
                 await callback.answer("Номер не найден", show_alert=True)
                 return
         
@@ -216,12 +374,13 @@ async def rent_duration(callback: CallbackQuery):
         monthly_price = num_info.get("price", PRICES.get(1, 25))
         total_price = monthly_price * months
         
-        # Save pending state for promo code entry
-        pending_promo_state[callback.from_user.id] = {
+        # Save the checkout for promo code entry
+        await state.set_state(Checkout.promo)
+        await state.set_data({
                 "number": number,
                 "months": months,
                 "price": total_price,
-        }
+        })
         
         # Ask for promo code
         await callback.message.edit_text(
@@ -234,44 +393,42 @@ async def rent_duration(callback: CallbackQuery):
 
 
 @router.callback_query(F.data == "enter_promo")
-async def enter_promo(callback: CallbackQuery):
-        user_id = callback.from_user.id
-        if user_id not in pending_promo_state:
+async def enter_promo(callback: CallbackQuery, state: FSMContext):
+        checkout = await state.get_data()
+        if await state.get_state() != Checkout.promo.state or not checkout:
                 await callback.answer("Сессия истекла. Начните заново.", show_alert=True)
                 return
         
-        state = pending_promo_state[user_id]
         await callback.message.edit_text(
                 f"🎁 Введите промокод для получения скидки:\n\n"
-                f"Номер: {state['number']}\n"
-                f"Срок: {state['months']} мес\n"
-                f"Цена: ${state['price']}"
+                f"Номер: {checkout['number']}\n"
+                f"Срок: {checkout['months']} мес\n"
+                f"Цена: ${checkout['price']}"
         )
         await callback.answer()
 
 
 @router.callback_query(F.data == "skip_promo")
-async def skip_promo(callback: CallbackQuery):
-        user_id = callback.from_user.id
-        if user_id not in pending_promo_state:
+async def skip_promo(callback: CallbackQuery, state: FSMContext):
+        checkout = await state.get_data()
+        if await state.get_state() != Checkout.promo.state or not checkout:
                 await callback.answer("Сессия истекла. Начните заново.", show_alert=True)
                 return
         
-        state = pending_promo_state.pop(user_id)
-        await process_payment(callback, state["number"], state["months"], state["price"], None, None)
+        await state.clear()
+        await process_payment(callback, checkout["number"], checkout["months"], checkout["price"], None, None)
 
 
-@router.message(F.text)
-async def handle_promo_code(message: Message):
-        user_id = message.from_user.id
-        if user_id not in pending_promo_state:
+@router.message(Checkout.promo, F.text)
+async def handle_promo_code(message: Message, state: FSMContext):
+        checkout = await state.get_data()
+        if not checkout:
                 return
         
         promo_code = message.text.strip()
-        state = pending_promo_state[user_id]
         
         # Validate promo code
-        promo = storage.get_promocode(promo_code)
+        promo = await async_storage.get_promocode(promo_code)
         if not promo:
                 await message.answer(
                         f"❌ Промокод '{promo_code}' не найден или неактивен.\n"
@@ -281,12 +438,12 @@ async def handle_promo_code(message: Message):
                 return
         
         # Calculate discount
-        original_price = state["price"]
+        original_price = checkout["price"]
         discount_percent = promo["percent"]
         final_price = max(1, round(original_price * (100 - discount_percent) / 100, 2))
         
-        # Remove from pending state
-        pending_promo_state.pop(user_id)
+        # Checkout is complete
+        await state.clear()
         
         await message.answer(
                 f"✅ Промокод {promo['code']} применён!\n"
@@ -296,18 +453,18 @@ async def handle_promo_code(message: Message):
                 "Создаю счёт для оплаты..."
         )
         
-        await process_payment_from_message(message, state["number"], state["months"], final_price, promo_code, discount_percent)
+        await process_payment_from_message(message, checkout["number"], checkout["months"], final_price, promo_code, discount_percent)
 
 
 async def process_payment(callback, number: str, months: int, final_price: float, promo_code: str = None, discount_percent: int = None):
         """Create invoice and process payment from callback with optional promo code."""
         if not crypto_client:
                 # Fallback without crypto: instantly rent (dev/test)
-                rental = storage.add_rental(callback.from_user.id, number, months)
+                rental = await async_storage.add_rental(callback.from_user.id, number, months)
                 if rental is None:
                         await callback.answer("Номер уже занят", show_alert=True)
                         return
-                until_h = _format_until(rental["until"])
+                until_h = format_until(rental["until"])
                 msg_text = f"Готово! {number} арендован до {until_h}."
                 if promo_code:
                         msg_text = f"✅ Промокод {promo_code} применён (-{discount_percent}%)!\n\n" + msg_text
@@ -322,7 +479,11 @@ async def process_payment(callback, number: str, months: int, final_price: float
         if promo_code:
                 description += f" (промокод {promo_code})"
         
-        invoice = await crypto_client.create_invoice(amount=final_price, asset="USDT", description=description, payload=payment_id)
+        # Reserve the number for the lifetime of the invoice
+        if not await async_storage.hold_number(number, payment_id, callback.from_user.id, RESERVATION_TTL):
+                await callback.answer("Номер уже занят", show_alert=True)
+                return
+        invoice = await _create_held_invoice(number, payment_id, final_price, description)
         if not invoice:
                 await callback.answer("Не удалось создать счёт. Повторите позже.", show_alert=True)
                 return
@@ -339,7 +500,7 @@ async def process_payment(callback, number: str, months: int, final_price: float
                 payment_data["promo_code"] = promo_code
                 payment_data["discount_percent"] = discount_percent
         
-        storage.create_pending_payment(payment_id, payment_data)
+        await _save_pending_payment(payment_id, payment_data)
         pay_url = invoice.get("pay_url") or invoice.get("bot_invoice_url")
         
         msg_text = f"Оплатите {final_price}$ USDT за {months} мес аренды номера {number}.\n\n"
@@ -358,11 +519,11 @@ async def process_payment_from_message(message: Message, number: str, months: in
         
         if not crypto_client:
                 # Fallback without crypto: instantly rent (dev/test)
-                rental = storage.add_rental(user_id, number, months)
+                rental = await async_storage.add_rental(user_id, number, months)
                 if rental is None:
                         await message.answer("❌ Номер уже занят")
                         return
-                until_h = _format_until(rental["until"])
+                until_h = format_until(rental["until"])
                 msg_text = f"✅ Готово! {number} арендован до {until_h}."
                 await message.answer(msg_text)
                 return
@@ -371,7 +532,11 @@ async def process_payment_from_message(message: Message, number: str, months: in
         payment_id = f"{user_id}:{number}:{months}:{int(time.time())}"
         description = f"Аренда {number} на {months} мес (промокод {promo_code})"
         
-        invoice = await crypto_client.create_invoice(amount=final_price, asset="USDT", description=description, payload=payment_id)
+        # Reserve the number for the lifetime of the invoice
+        if not await async_storage.hold_number(number, payment_id, user_id, RESERVATION_TTL):
+                await message.answer("❌ Номер уже занят")
+                return
+        invoice = await _create_held_invoice(number, payment_id, final_price, description)
         if not invoice:
                 await message.answer("❌ Не удалось создать счёт. Повторите позже.")
                 return
@@ -387,7 +552,7 @@ async def process_payment_from_message(message: Message, number: str, months: in
                 "discount_percent": discount_percent,
         }
         
-        storage.create_pending_payment(payment_id, payment_data)
+        await _save_pending_payment(payment_id, payment_data)
         pay_url = invoice.get("pay_url") or invoice.get("bot_invoice_url")
         
         msg_text = f"💳 Оплатите {final_price}$ USDT за {months} мес аренды номера {number}.\n\n"
@@ -403,10 +568,20 @@ async def paid_check(callback: CallbackQuery):
                 await callback.answer("Крипто-оплата не настроена", show_alert=True)
                 return
         payment_id = callback.data.split(":", 1)[1]
-        p = storage.get_payment(payment_id)
+        p = await async_storage.get_payment(payment_id)
         if not p or not p.get("invoice_id"):
                 await callback.answer("Платёж не найден", show_alert=True)
                 return
+        if p.get("status") == "paid":
+                await callback.answer("✅ Оплата уже подтверждена", show_alert=True)
+                return
+        if p.get("status") != "pending":
+                await callback.answer("Платёж уже обработан", show_alert=True)
+                return
+        if crypto_webhook_enabled:
+                # Paid invoices are pushed by the webhook, no need to ask Crypto Pay
+                await callback.answer("Платёж ещё не подтверждён", show_alert=True)
+                return
         invoice = await crypto_client.get_invoice(int(p["invoice_id"]))
         if not invoice:
                 await callback.answer("Счёт не найден", show_alert=True)
@@ -416,29 +591,12 @@ async def paid_check(callback: CallbackQuery):
                 await callback.answer("Платёж ещё не подтверждён", show_alert=True)
                 return
         
-        # Check if it's a sale or rent
-        payment_type = p.get("type", "rent")
-        
-        if payment_type == "sale":
-                # For sale - mark number as sold
-                storage.set_number_status(p["number"], "busy")
-                storage.set_payment_status(payment_id, "paid")
-                await callback.message.edit_text(
-                        f"✅ Оплата подтверждена!\n"
-                        f"Номер {p['number']} успешно куплен.\n\n"
-                        "Ожидайте получения доступа к номеру."
-                )
-        else:
-                # For rent - activate rental
-                rental = storage.add_rental(callback.from_user.id, p["number"], int(p["months"]))
-                if rental is None:
-                        await callback.answer("Номер уже занят", show_alert=True)
-                        return
-                storage.set_payment_status(payment_id, "paid")
-                until_h = _format_until(rental["until"])
-                await callback.message.edit_text(
-                        f"Оплата подтверждена. {p['number']} арендован до {until_h}.")
-        
+        # Activate the rental or sale; the background reconciler may have done it already
+        outcome, text = await settle_payment(payment_id, p)
+        if outcome == "already":
+                await callback.answer("Платёж уже обработан", show_alert=True)
+                return
+        await callback.message.edit_text(text)
         await callback.answer()
 
 
@@ -448,9 +606,9 @@ async def profile(message: Message):
         username = message.from_user.username or "Не указан"
         
         # Get or register user
-        user_data = storage.get_user(user_id)
+        user_data = await async_storage.get_user(user_id)
         if not user_data:
-                user_data = storage.register_user(user_id, message.from_user.username)
+                user_data = await async_storage.register_user(user_id, message.from_user.username)
         
         # Calculate days in bot
         first_seen = datetime.strptime(user_data["first_seen"], "%Y-%m-%dT%H:%M:%S")
@@ -474,14 +632,14 @@ async def profile(message: Message):
 
 @router.callback_query(F.data == "my_rentals")
 async def my_rentals_callback(callback: CallbackQuery):
-        rentals = storage.list_rentals(callback.from_user.id)
+        rentals = await async_storage.list_rentals(callback.from_user.id)
         if not rentals:
                 await callback.answer("У вас нет активных аренд", show_alert=True)
                 return
         
         lines = ["📋 Ваши аренды:\n"]
         for r in rentals:
-                lines.append(f"• {r['number']} — до {_format_until(r['until'])}")
+                lines.append(f"• {r['number']} — до {format_until(r['until'])}")
         lines.append("\n💡 Чтобы продлить: /extend <номер> <месяцев>")
         
         await callback.message.edit_text("\n".join(lines))
@@ -501,11 +659,11 @@ async def extend_cmd(message: Message):
         except ValueError:
                 await message.answer("Месяцы должны быть числом (1/3/6/12)")
                 return
-        updated = storage.extend_rental(message.from_user.id, number, months)
+        updated = await async_storage.extend_rental(message.from_user.id, number, months)
         if not updated:
                 await message.answer("Аренда не найдена для указанного номера.")
                 return
-        await message.answer(f"Продлено до {_format_until(updated['until'])}.")
+        await message.answer(f"Продлено до {format_until(updated['until'])}.")
 
 
 @router.message(Command("admin_rent"))
@@ -523,11 +681,11 @@ async def admin_rent_cmd(message: Message):
         except ValueError:
                 await message.answer("Месяцы должны быть числом.")
                 return
-        rental = storage.force_rental(message.from_user.id, number, months)
+        rental = await async_storage.force_rental(message.from_user.id, number, months)
         if not rental:
                 await message.answer("Номер не найден.")
                 return
-        await message.answer(f"Оформлено владельцем. Аренда {number} до {_format_until(rental['until'])}.")
+        await message.answer(f"Оформлено владельцем. Аренда {number} до {format_until(rental['until'])}.")
 
 
 @router.message(Command("promo_add"))
@@ -546,7 +704,7 @@ async def promo_add_cmd(message: Message):
                 await message.answer("Процент должен быть числом от 1 до 100.")
                 return
         
-        promo = storage.add_promocode(code, percent, message.from_user.id)
+        promo = await async_storage.add_promocode(code, percent, message.from_user.id)
         if not promo:
                 await message.answer("Ошибка: промокод уже существует или процент указан неверно (1-100).")
                 return
@@ -560,7 +718,7 @@ async def promo_list_cmd(message: Message):
                 await message.answer("Команда доступна только владельцу.")
                 return
         
-        promos = storage.list_promocodes()
+        promos = await async_storage.list_promocodes()
         if not promos:
                 await message.answer("Промокодов пока нет.")
                 return
@@ -584,30 +742,270 @@ async def promo_disable_cmd(message: Message):
                 return
         
         code = parts[1]
-        if storage.deactivate_promocode(code):
+        if await async_storage.deactivate_promocode(code):
                 await message.answer(f"✅ Промокод {code.upper()} отключен.")
         else:
                 await message.answer(f"❌ Промокод {code.upper()} не найден.")
 
 
+@router.message(Command("inventory_import"))
+async def inventory_import_cmd(message: Message, bot: Bot):
+        # Send a .csv/.jsonl file with the caption /inventory_import (or reply to one with the command)
+        if message.from_user.id != ADMIN_ID:
+                await message.answer("Команда доступна только владельцу.")
+                return
+        document = message.document or (message.reply_to_message and message.reply_to_message.document)
+        if not document:
+                await message.answer(
+                        "Пришлите файл .csv или .jsonl с подписью /inventory_import\n"
+                        "Колонки: number, category, type, price, status (free/busy/retired)"
+                )
+                return
+        suffix = os.path.splitext(document.file_name or "")[1].lower()
+        if suffix not in (".csv", ".jsonl", ".ndjson"):
+                await message.answer("Поддерживаются только файлы .csv и .jsonl")
+                return
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        os.close(fd)
+        try:
+                await bot.download(document, destination=path)
+                await message.answer("⏳ Импорт начат...")
+                # Parsing runs off the event loop; each chunk goes through the ordered writer
+                # and waits for its journal fsync, so the report is sent once the import is durable
+                loop = asyncio.get_running_loop()
+
+                def apply(chunk):
+                        return asyncio.run_coroutine_threadsafe(async_storage.upsert_numbers(chunk), loop).result()
+
+                report = await asyncio.to_thread(inventory.import_file, path, apply=apply)
+        finally:
+                os.remove(path)
+        await message.answer("✅ Импорт завершён\n" + inventory.format_import_report(report))
+
+
+@router.message(Command("inventory_export"))
+async def inventory_export_cmd(message: Message):
+        # Format: /inventory_export [csv|jsonl]
+        if message.from_user.id != ADMIN_ID:
+                await message.answer("Команда доступна только владельцу.")
+                return
+        parts = message.text.strip().split()
+        fmt = parts[1].lower() if len(parts) > 1 else "csv"
+        if fmt not in ("csv", "jsonl"):
+                await message.answer("Использование: /inventory_export [csv|jsonl]")
+                return
+        fd, path = tempfile.mkstemp(suffix=f".{fmt}")
+        os.close(fd)
+        try:
+                report = await asyncio.to_thread(inventory.export_file, path)
+                await message.answer_document(
+                        FSInputFile(path, filename=f"numbers.{fmt}"),
+                        caption=inventory.format_export_report(report),
+                )
+        finally:
+                os.remove(path)
+
+
+PERF_USAGE = (
+        "Использование:\n"
+        "/perf — сводка\n"
+        "/perf on [sample|cprofile] — включить профилирование\n"
+        "/perf off — выключить (собранные данные сохраняются)\n"
+        "/perf reset — очистить собранные данные\n"
+        "/perf dump — файл профиля (collapsed stacks или pstats)\n"
+        "/perf mem [stop] — прирост памяти по tracemalloc"
+)
+# Telegram's message length limit
+MESSAGE_LIMIT = 4096
+
+
+@router.message(Command("perf"))
+async def perf_cmd(message: Message):
+        # Format: /perf [on [sample|cprofile]|off|reset|dump|mem [stop]]
+        if message.from_user.id != ADMIN_ID:
+                await message.answer("Команда доступна только владельцу.")
+                return
+        parts = message.text.strip().split()
+        action = parts[1].lower() if len(parts) > 1 else ""
+        arg = parts[2].lower() if len(parts) > 2 else ""
+        if action == "":
+                text = profiler.summary()
+                if len(text) > MESSAGE_LIMIT:
+                        text = text[:MESSAGE_LIMIT - 1] + "…"
+                await message.answer(text)
+        elif action == "on":
+                mode = arg or "sample"
+                if mode not in PROFILING_MODES:
+                        await message.answer(PERF_USAGE)
+                        return
+                profiler.start(mode)
+                await message.answer(f"✅ Профилирование включено ({mode})")
+        elif action == "off":
+                profiler.stop()
+                await message.answer("Профилирование выключено. Сводка и файл профиля доступны до следующего включения.")
+        elif action == "reset":
+                profiler.reset()
+                await message.answer("Данные профилирования очищены")
+        elif action == "dump":
+                fd, path = tempfile.mkstemp(suffix=".prof")
+                os.close(fd)
+                try:
+                        fmt = profiler.dump(path)
+                        if fmt is None:
+                                await message.answer("Профиль пуст. Включите его: /perf on")
+                                return
+                        filename = "profile.pstats" if fmt == "pstats" else "profile.collapsed.txt"
+                        await message.answer_document(FSInputFile(path, filename=filename), caption=f"Профиль ({fmt})")
+                finally:
+                        os.remove(path)
+        elif action == "mem":
+                if arg == "stop":
+                        profiler.memory_stop()
+                        await message.answer("tracemalloc остановлен")
+                        return
+                await message.answer(await asyncio.to_thread(profiler.memory))
+        else:
+                await message.answer(PERF_USAGE)
+
+
+# Upper bound for one expiry sleep, so the worker re-syncs with the wall clock
+EXPIRY_MAX_SLEEP = 3600
+# Retry delay after a failed expiry pass
+EXPIRY_RETRY_DELAY = 60
+
+
 async def expiry_worker():
+        """Release rentals and invoice reservations exactly at their deadlines.
+
+        Sleeps until the earliest deadline from the storage expiry indexes and
+        wakes up early when a rental or reservation is added or moved.
+        """
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+        storage.on_expiry_change(lambda: loop.call_soon_threadsafe(wakeup.set))
         while True:
+                wakeup.clear()
+                timeout = EXPIRY_RETRY_DELAY
                 try:
-                        released = storage.release_if_expired()
-                        # Optionally, could log released count
+                        metrics.expiry_released.inc(await async_storage.release_if_expired(), kind="rental")
+                        metrics.expiry_released.inc(await async_storage.release_expired_holds(), kind="hold")
+                        deadlines = [d for d in (await async_storage.next_expiry(), await async_storage.next_hold_expiry()) if d]
+                        if not deadlines:
+                                timeout = None
+                        else:
+                                timeout = min(max((min(deadlines) - datetime.utcnow()).total_seconds(), 0), EXPIRY_MAX_SLEEP)
+                        if shared_storage():
+                                # Rentals added by other processes do not wake this worker
+                                timeout = min(timeout if timeout is not None else SHARED_POLL_INTERVAL, SHARED_POLL_INTERVAL)
                 except Exception:
+                        metrics.background_errors.inc(task="expiry")
+                try:
+                        await asyncio.wait_for(wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                        pass
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot) -> None:
+        """Register the webhook and serve until SIGINT/SIGTERM.
+
+        Pending updates are kept: Telegram queues them while no instance is up
+        and delivers them once the webhook answers again.
+        """
+        if WORKER_INDEX == 0:
+                # One registration is enough when several workers share the port
+                await bot.set_webhook(
+                        TELEGRAM_WEBHOOK_URL + TELEGRAM_WEBHOOK_PATH,
+                        secret_token=TELEGRAM_WEBHOOK_SECRET,
+                        max_connections=min(WEBHOOK_MAX_CONCURRENCY * BOT_WORKERS, 100),
+                        allowed_updates=dp.resolve_used_update_types(),
+                        drop_pending_updates=False,
+                )
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+                try:
+                        loop.add_signal_handler(sig, stop.set)
+                except (NotImplementedError, RuntimeError):
+                        # Windows: Ctrl+C cancels the main task instead
                         pass
-                await asyncio.sleep(60)
+        await dp.emit_startup(bot=bot)
+        try:
+                await stop.wait()
+        finally:
+                await dp.emit_shutdown(bot=bot)
 
 
 async def main():
-        bot = Bot(token=BOT_TOKEN)
-        dp = Dispatcher()
+        session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+        bot = Bot(token=BOT_TOKEN, session=session)
+        dp = Dispatcher(storage=checkout_sessions)
+        # One instance for both update types, so a user's budget is shared between them
+        dp.message.outer_middleware(throttling)
+        dp.callback_query.outer_middleware(throttling)
         dp.include_router(router)
-        asyncio.create_task(expiry_worker())
-        # Drop pending updates to avoid conflicts with other instances
-        await dp.start_polling(bot, drop_pending_updates=True)
+        storage.start_writer()
+        async_storage.start()
+        if PROFILING:
+                # Started here so cProfile covers the event-loop thread
+                profiler.start(PROFILING)
+        # Expiry, reconciliation and retention run in one process only
+        leader = LeaderElection()
+        leader.add_job(expiry_worker)
+        leader.add_job(retention_worker)
+        if reconciler:
+                leader.add_job(lambda: reconciler.run(bot))
+        leader_task = asyncio.create_task(leader.run())
+        app = web.Application()
+        if crypto_webhook_enabled:
+                app.router.add_post(CRYPTO_PAY_WEBHOOK_PATH, crypto_pay_webhook_handler(crypto_client, bot))
+        telegram_handler = None
+        if BOT_MODE == "webhook":
+                telegram_handler = TelegramWebhookHandler(dp, bot, TELEGRAM_WEBHOOK_SECRET, WEBHOOK_MAX_CONCURRENCY)
+                app.router.add_post(TELEGRAM_WEBHOOK_PATH, telegram_handler.handle)
+        web_runner = None
+        if len(app.router.routes()):
+                web_runner = web.AppRunner(app)
+                await web_runner.setup()
+                # Workers share the port; the kernel balances connections between them
+                await web.TCPSite(web_runner, WEBHOOK_HOST, WEBHOOK_PORT, reuse_port=BOT_WORKERS > 1).start()
+        metrics_runner = None
+        if METRICS_PORT:
+                # Separate listener so the metrics stay off the public webhook port
+                metrics_app = web.Application()
+                metrics_app.router.add_get("/metrics", metrics.metrics_handler)
+                metrics_runner = web.AppRunner(metrics_app)
+                await metrics_runner.setup()
+                # One port per worker, so each can be scraped on its own
+                await web.TCPSite(metrics_runner, METRICS_HOST, METRICS_PORT + WORKER_INDEX).start()
+        try:
+                if telegram_handler:
+                        await run_webhook(dp, bot)
+                else:
+                        # Drop pending updates to avoid conflicts with other instances
+                        await dp.start_polling(bot, drop_pending_updates=True)
+        finally:
+                if telegram_handler:
+                        # Let in-flight updates finish; new deliveries get 503 and are retried by Telegram
+                        await telegram_handler.drain(WEBHOOK_DRAIN_TIMEOUT)
+                if web_runner:
+                        await web_runner.cleanup()
+                if metrics_runner:
+                        await metrics_runner.cleanup()
+                leader_task.cancel()
+                await leader.stop()
+                profiler.stop()
+                # Apply queued writes, then persist everything the write-behind cache has not flushed yet
+                await async_storage.stop()
+                storage.close()
+                # Keep in-flight checkouts across the restart
+                await checkout_sessions.close()
+                if crypto_client:
+                        await crypto_client.close()
+                if telegram_handler:
+                        await bot.session.close()
 
 
 if __name__ == "__main__":
+        if BOT_WORKERS > 1 and not IS_WORKER:
+                raise SystemExit(supervise())
         asyncio.run(main())
@@ -0,0 +1,212 @@
+"""In-process metrics in the Prometheus text exposition format.
+
+Counters, gauges and histograms are plain thread-safe objects (the storage
+writer updates them from its own thread). Values that are cheaper to read at
+scrape time than to track, like pending payments, are filled in by async
+collectors registered with :func:`add_collector`.
+
+        curl http://127.0.0.1:9100/metrics
+"""
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Sequence, Tuple
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+from aiohttp import web
+
+# Latency buckets in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+        return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+        pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+        if extra:
+                pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+        if value == float("inf"):
+                return "+Inf"
+        return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+        kind = ""
+
+        def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+                self.name = name
+                self.documentation = documentation
+                self.labelnames = tuple(labelnames)
+                self._lock = threading.Lock()
+                REGISTRY.append(self)
+
+        def _key(self, labels: Dict[str, str]) -> LabelValues:
+                return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+        def render(self) -> List[str]:
+                lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+                with self._lock:
+                        lines.extend(self._samples())
+                return lines
+
+        def _samples(self) -> List[str]:
+                raise NotImplementedError
+
+
+class Counter(_Metric):
+        kind = "counter"
+
+        def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+                super().__init__(name, documentation, labelnames)
+                self._values: Dict[LabelValues, float] = {}
+
+        def inc(self, amount: float = 1, **labels: str) -> None:
+                key = self._key(labels)
+                with self._lock:
+                        self._values[key] = self._values.get(key, 0) + amount
+
+        def set_total(self, value: float, **labels: str) -> None:
+                """Mirror a total that is counted elsewhere (e.g. by the throttling middleware)."""
+                with self._lock:
+                        self._values[self._key(labels)] = value
+
+        def value(self, **labels: str) -> float:
+                with self._lock:
+                        return self._values.get(self._key(labels), 0)
+
+        def _samples(self) -> List[str]:
+                return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}" for key, v in self._values.items()]
+
+
+class Gauge(Counter):
+        kind = "gauge"
+
+        def set(self, value: float, **labels: str) -> None:
+                self.set_total(value, **labels)
+
+        def clear(self) -> None:
+                with self._lock:
+                        self._values.clear()
+
+
+class Histogram(_Metric):
+        kind = "histogram"
+
+        def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+                super().__init__(name, documentation, labelnames)
+                self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+                # labels -> [per-bucket counts..., sum, count]
+                self._values: Dict[LabelValues, List[float]] = {}
+
+        def observe(self, value: float, **labels: str) -> None:
+                key = self._key(labels)
+                with self._lock:
+                        series = self._values.get(key)
+                        if series is None:
+                                series = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+                        for i, bound in enumerate(self.buckets):
+                                if value <= bound:
+                                        series[i] += 1
+                                        break
+                        series[-2] += value
+                        series[-1] += 1
+
+        @contextmanager
+        def time(self, **labels: str) -> Iterator[None]:
+                started = time.perf_counter()
+                try:
+                        yield
+                finally:
+                        self.observe(time.perf_counter() - started, **labels)
+
+        def _samples(self) -> List[str]:
+                lines = []
+                for key, series in self._values.items():
+                        cumulative = 0
+                        for bound, count in zip(self.buckets, series):
+                                cumulative += count
+                                le = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                                lines.append(f"{self.name}_bucket{le} {cumulative}")
+                        labels = _format_labels(self.labelnames, key)
+                        lines.append(f"{self.name}_sum{labels} {_format_value(series[-2])}")
+                        lines.append(f"{self.name}_count{labels} {series[-1]}")
+                return lines
+
+
+REGISTRY: List[_Metric] = []
+_collectors: List[Callable[[], Awaitable[None]]] = []
+
+
+def add_collector(collector: Callable[[], Awaitable[None]]) -> None:
+        """Register a coroutine function that refreshes gauges right before each scrape."""
+        _collectors.append(collector)
+
+
+async def render() -> str:
+        for collector in _collectors:
+                try:
+                        await collector()
+                except Exception:
+                        collector_errors.inc(collector=getattr(collector, "__name__", "collector"))
+        lines: List[str] = []
+        for metric in REGISTRY:
+                lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+        return web.Response(body=(await render()).encode("utf-8"), headers={"Content-Type": CONTENT_TYPE})
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+        """Inner router middleware: latency and errors per handler function."""
+
+        async def __call__(
+                self,
+                handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                event: TelegramObject,
+                data: Dict[str, Any],
+        ) -> Any:
+                name = getattr(getattr(data.get("handler"), "callback", None), "__name__", "unknown")
+                started = time.perf_counter()
+                try:
+                        return await handler(event, data)
+                except Exception:
+                        handler_errors.inc(handler=name)
+                        raise
+                finally:
+                        handler_latency.observe(time.perf_counter() - started, handler=name)
+
+
+# Metric definitions shared across modules
+
+handler_latency = Histogram("bot_handler_duration_seconds", "Time spent in a router handler.", ["handler"])
+handler_errors = Counter("bot_handler_errors_total", "Router handlers that raised.", ["handler"])
+
+storage_seconds = Histogram("bot_storage_seconds", "JSON state load/save duration (save includes serialization).", ["op"])
+storage_bytes = Counter("bot_storage_bytes_total", "Bytes read from or written to the JSON state file.", ["op"])
+
+crypto_pay_latency = Histogram("bot_crypto_pay_request_seconds", "Crypto Pay API request duration.", ["method"])
+crypto_pay_errors = Counter("bot_crypto_pay_errors_total", "Failed Crypto Pay API calls by kind (http, network, api, rate_limited).", ["method", "kind"])
+
+pending_payments = Gauge("bot_pending_payments", "Payments waiting for their invoice to be paid.")
+inventory_numbers = Gauge("bot_inventory_numbers", "Numbers by category and status.", ["category", "status"])
+
+expiry_released = Counter("bot_expiry_released_total", "Rentals and reservations released by the expiry worker.", ["kind"])
+background_errors = Counter("bot_background_errors_total", "Exceptions caught in background workers.", ["task"])
+leader = Gauge("bot_leader", "1 while this process holds the lease for the background jobs.")
+
+throttled_updates = Counter("bot_throttled_updates_total", "Updates by throttling outcome and handler class.", ["outcome", "class"])
+crypto_pay_budget = Counter("bot_crypto_pay_budget_total", "Crypto Pay budget decisions (granted, deferred, rejected).", ["outcome"])
+
+collector_errors = Counter("bot_metrics_collector_errors_total", "Collectors that failed during a scrape.", ["collector"])
@@ -0,0 +1,222 @@
+"""Payment settlement and background reconciliation of pending Crypto Pay invoices."""
+import asyncio
+import json
+import os
+from aiohttp import web
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+from . import async_storage, metrics
+from .archive import payment_time
+from .crypto import CryptoPay
+from .storage import ISO_FORMAT
+
+# Polling interval bounds (seconds): the reconciler polls at the minimum while
+# invoices keep changing and backs off exponentially up to the maximum.
+RECONCILE_MIN_INTERVAL = float(os.getenv("RECONCILE_MIN_INTERVAL", "5"))
+RECONCILE_MAX_INTERVAL = float(os.getenv("RECONCILE_MAX_INTERVAL", "120"))
+# Invoice ids per getInvoices request
+RECONCILE_BATCH_SIZE = int(os.getenv("RECONCILE_BATCH_SIZE", "100"))
+# Pending payments older than this are expired locally even if Crypto Pay never reports them expired
+PENDING_PAYMENT_TTL = int(os.getenv("PENDING_PAYMENT_TTL", "86400"))
+# Settled payments older than this many days move from the hot state to the archive
+PAYMENT_ARCHIVE_DAYS = int(os.getenv("PAYMENT_ARCHIVE_DAYS", "30"))
+# Seconds between retention passes
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "3600"))
+# Payments moved per archive write
+ARCHIVE_BATCH_SIZE = 1000
+
+
+def format_until(until_iso: str) -> str:
+        try:
+                return datetime.strptime(until_iso, ISO_FORMAT).strftime("%d.%m.%Y %H:%M UTC")
+        except Exception:
+                return until_iso
+
+
+async def settle_payment(payment_id: str, payment: Dict) -> Tuple[str, Optional[str]]:
+        """Activate a paid payment exactly once.
+
+        Returns (outcome, message) where outcome is "settled", "conflict" (paid,
+        but the number could not be assigned) or "already" (settled before).
+        """
+        # Compare-and-set pending -> paid: only one caller gets to activate
+        if not await async_storage.set_payment_status(payment_id, "paid", expected_status="pending"):
+                return "already", None
+        number = payment["number"]
+        user_id = int(payment["user_id"])
+        if payment.get("type", "rent") == "sale":
+                if await async_storage.claim_number(number, user_id):
+                        return "settled", (
+                                f"✅ Оплата подтверждена!\n"
+                                f"Номер {number} успешно куплен.\n\n"
+                                "Ожидайте получения доступа к номеру."
+                        )
+        else:
+                rental = await async_storage.add_rental(user_id, number, int(payment["months"]))
+                if rental is not None:
+                        return "settled", f"Оплата подтверждена. {number} арендован до {format_until(rental['until'])}."
+        await async_storage.set_payment_status(payment_id, "conflict")
+        return "conflict", (
+                f"⚠️ Оплата получена, но номер {number} уже занят.\n"
+                "Ответьте на это сообщение — оператор вернёт средства или подберёт другой номер."
+        )
+
+
+async def expire_payment(payment_id: str, payment: Dict) -> bool:
+        """Mark a pending payment expired and drop its reservation."""
+        if not await async_storage.set_payment_status(payment_id, "expired", expected_status="pending"):
+                return False
+        await async_storage.release_hold(payment["number"], payment_id)
+        return True
+
+
+async def notify_user(bot, payment: Dict, text: Optional[str]) -> None:
+        if bot is None or not text:
+                return
+        try:
+                await bot.send_message(int(payment["user_id"]), text)
+        except Exception:
+                # The user may have blocked the bot; the payment is settled regardless
+                pass
+
+
+def _is_stale(payment_id: str, payment: Dict, now: datetime) -> bool:
+        created = payment_time(payment_id, payment)
+        if created is None:
+                return False
+        return created + timedelta(seconds=PENDING_PAYMENT_TTL) <= now
+
+
+class PaymentReconciler:
+        """Settles pending payments by polling Crypto Pay in batches.
+
+        Users are notified when their payment is activated, so pressing
+        "Я оплатил" becomes optional.
+        """
+
+        def __init__(self, client: CryptoPay, batch_size: int = RECONCILE_BATCH_SIZE,
+                     min_interval: float = RECONCILE_MIN_INTERVAL, max_interval: float = RECONCILE_MAX_INTERVAL,
+                     idle_interval: Optional[float] = None):
+                self.client = client
+                self.batch_size = batch_size
+                self.min_interval = min_interval
+                self.max_interval = max_interval
+                # Sleep with nothing pending; None waits for poke(), which other processes cannot call
+                self.idle_interval = idle_interval
+                self._wakeup = asyncio.Event()
+
+        def poke(self) -> None:
+                """Poll soon: a new invoice was issued."""
+                self._wakeup.set()
+
+        async def reconcile_once(self, bot=None) -> Tuple[int, int]:
+                """Poll every pending payment once. Returns (changed, still_pending)."""
+                pending = await async_storage.list_pending_payments()
+                by_invoice: Dict[int, Tuple[str, Dict]] = {
+                        int(p["invoice_id"]): (payment_id, p)
+                        for payment_id, p in pending.items()
+                        if p.get("invoice_id")
+                }
+                changed = 0
+                invoice_ids: List[int] = list(by_invoice)
+                for start in range(0, len(invoice_ids), self.batch_size):
+                        for invoice in await self.client.get_invoices(invoice_ids[start:start + self.batch_size]):
+                                invoice_id = int(invoice.get("invoice_id", 0))
+                                status = invoice.get("status")
+                                if invoice_id not in by_invoice or status not in ("paid", "expired"):
+                                        continue
+                                payment_id, p = by_invoice.pop(invoice_id)
+                                if status == "paid":
+                                        outcome, text = await settle_payment(payment_id, p)
+                                        if outcome != "already":
+                                                changed += 1
+                                                await notify_user(bot, p, text)
+                                elif await expire_payment(payment_id, p):
+                                        changed += 1
+                # Whatever Crypto Pay still reports as active is expired locally once it is too old
+                now = datetime.utcnow()
+                still_pending = 0
+                unresolved = [(pid, p) for pid, p in pending.items() if not p.get("invoice_id")]
+                unresolved.extend(by_invoice.values())
+                for payment_id, p in unresolved:
+                        if _is_stale(payment_id, p, now) and await expire_payment(payment_id, p):
+                                changed += 1
+                        else:
+                                still_pending += 1
+                return changed, still_pending
+
+        async def run(self, bot) -> None:
+                interval = self.min_interval
+                while True:
+                        self._wakeup.clear()
+                        changed, still_pending = 0, 1
+                        try:
+                                changed, still_pending = await self.reconcile_once(bot)
+                        except Exception:
+                                metrics.background_errors.inc(task="reconciler")
+                        interval = self.min_interval if changed else min(interval * 2, self.max_interval)
+                        # Nothing to poll: sleep until the next invoice is issued
+                        timeout = interval if still_pending else self.idle_interval
+                        try:
+                                await asyncio.wait_for(self._wakeup.wait(), timeout)
+                                interval = self.min_interval
+                        except asyncio.TimeoutError:
+                                pass
+
+
+async def enforce_retention() -> Tuple[int, int]:
+        """Expire abandoned pending payments and archive old settled ones.
+
+        Keeps the hot payment collection bounded by the TTL and the archive age
+        instead of growing with every invoice ever issued. Returns (expired, archived).
+        """
+        now = datetime.utcnow()
+        expired = 0
+        for payment_id, p in (await async_storage.list_pending_payments()).items():
+                if _is_stale(payment_id, p, now) and await expire_payment(payment_id, p):
+                        expired += 1
+        archived = 0
+        before = now - timedelta(days=PAYMENT_ARCHIVE_DAYS)
+        while True:
+                moved = await async_storage.archive_payments(before, ARCHIVE_BATCH_SIZE)
+                archived += moved
+                if moved < ARCHIVE_BATCH_SIZE:
+                        return expired, archived
+
+
+async def retention_worker(interval: float = RETENTION_INTERVAL) -> None:
+        while True:
+                try:
+                        await enforce_retention()
+                except Exception:
+                        metrics.background_errors.inc(task="retention")
+                await asyncio.sleep(interval)
+
+
+def crypto_pay_webhook_handler(client: CryptoPay, bot):
+        """aiohttp handler for Crypto Pay webhook updates.
+
+        Verifies the signature and settles the payment named in the invoice
+        payload. Redelivered updates are acknowledged without side effects.
+        """
+        async def handle(request: web.Request) -> web.Response:
+                body = await request.read()
+                if not client.verify_webhook(body, request.headers.get("crypto-pay-api-signature", "")):
+                        return web.Response(status=401, text="invalid signature")
+                try:
+                        update = json.loads(body)
+                except ValueError:
+                        return web.Response(status=400, text="invalid json")
+                if update.get("update_type") != "invoice_paid":
+                        return web.Response(text="ignored")
+                invoice = update.get("payload") or {}
+                payment_id = invoice.get("payload")
+                p = await async_storage.get_payment(payment_id) if payment_id else None
+                # Acknowledge unknown invoices so Crypto Pay stops retrying them
+                if not p or str(p.get("invoice_id")) != str(invoice.get("invoice_id")):
+                        return web.Response(text="unknown invoice")
+                outcome, text = await settle_payment(payment_id, p)
+                if outcome != "already":
+                        await notify_user(bot, p, text)
+                return web.Response(text="ok")
+        return handle
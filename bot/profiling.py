@@ -0,0 +1,333 @@
+"""Opt-in profiling of a running bot.
+
+Off by default and close to free while off. ``PROFILING=sample`` or
+``PROFILING=cprofile`` turns it on at startup, ``/perf on`` from the owner at
+runtime. Two modes:
+
+- ``sample``: a background thread records every thread's Python stack each
+  ``PROFILE_SAMPLE_INTERVAL`` seconds. Cheap enough for production; ``/perf
+  dump`` sends the stacks in the collapsed format (``flamegraph.pl``,
+  speedscope).
+- ``cprofile``: deterministic :mod:`cProfile` of the event-loop thread. Exact
+  call counts at a noticeable cost; ``/perf dump`` sends a pstats file
+  (``python -m pstats``, snakeviz).
+
+In both modes every router handler and storage call is timed into rolling
+top-N tables over the last ``PROFILE_WINDOW`` seconds. ``/perf mem`` diffs
+:mod:`tracemalloc` snapshots independently of the mode.
+"""
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+MODES = ("sample", "cprofile")
+
+# Mode enabled at startup: "sample", "cprofile" or empty (off)
+PROFILING = os.getenv("PROFILING", "").strip().lower()
+# Seconds between two stack samples in "sample" mode
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.01"))
+# Rows in each /perf table
+PROFILE_TOP_N = int(os.getenv("PROFILE_TOP_N", "15"))
+# Seconds of history behind the handler and storage tables
+PROFILE_WINDOW = float(os.getenv("PROFILE_WINDOW", "300"))
+# Distinct stacks kept by the sampler; rarer ones beyond this are counted as "[other]"
+MAX_STACKS = 20000
+# Stack frames recorded per tracemalloc allocation
+TRACEMALLOC_FRAMES = 5
+# Leaf frames of a thread that is waiting rather than working
+IDLE_LEAVES = {
+        ("selectors.py", "select"),
+        ("thread.py", "_worker"),
+        ("threading.py", "wait"),
+        ("queue.py", "get"),
+}
+
+
+class RollingStats:
+        """Count, total and max duration per name over a sliding time window.
+
+        The window is split into buckets; a bucket older than the window is
+        dropped whole, so memory stays bounded by names x buckets.
+        """
+
+        def __init__(self, window: float = PROFILE_WINDOW, buckets: int = 10):
+                self.window = window
+                self.span = window / buckets
+                self._buckets: Deque[Tuple[float, Dict[str, List[float]]]] = deque(maxlen=buckets)
+                self._lock = threading.Lock()
+
+        def add(self, name: str, seconds: float) -> None:
+                now = time.monotonic()
+                with self._lock:
+                        if not self._buckets or now - self._buckets[-1][0] >= self.span:
+                                self._buckets.append((now, {}))
+                        stats = self._buckets[-1][1]
+                        entry = stats.get(name)
+                        if entry is None:
+                                stats[name] = [1, seconds, seconds]
+                        else:
+                                entry[0] += 1
+                                entry[1] += seconds
+                                if seconds > entry[2]:
+                                        entry[2] = seconds
+
+        def top(self, n: int) -> List[Tuple[str, int, float, float]]:
+                """(name, count, total, max) for the n names with the most total time."""
+                oldest = time.monotonic() - self.window
+                merged: Dict[str, List[float]] = {}
+                with self._lock:
+                        for started, stats in self._buckets:
+                                if started < oldest:
+                                        continue
+                                for name, (count, total, slowest) in stats.items():
+                                        entry = merged.setdefault(name, [0, 0.0, 0.0])
+                                        entry[0] += count
+                                        entry[1] += total
+                                        entry[2] = max(entry[2], slowest)
+                rows = [(name, int(count), total, slowest) for name, (count, total, slowest) in merged.items()]
+                rows.sort(key=lambda row: row[2], reverse=True)
+                return rows[:n]
+
+        def clear(self) -> None:
+                with self._lock:
+                        self._buckets.clear()
+
+
+def _frame_name(code) -> str:
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+        """Samples the Python stacks of all other threads from a daemon thread."""
+
+        def __init__(self, interval: float = PROFILE_SAMPLE_INTERVAL):
+                self.interval = interval
+                self.stacks: Counter = Counter()
+                self.samples = 0
+                self.idle = 0
+                self._stop = threading.Event()
+                self._thread: Optional[threading.Thread] = None
+
+        def start(self) -> None:
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="profiler-sampler", daemon=True)
+                self._thread.start()
+
+        def stop(self) -> None:
+                self._stop.set()
+                if self._thread is not None:
+                        self._thread.join()
+                        self._thread = None
+
+        def _run(self) -> None:
+                own = threading.get_ident()
+                while not self._stop.wait(self.interval):
+                        names = {thread.ident: thread.name for thread in threading.enumerate()}
+                        for ident, frame in sys._current_frames().items():
+                                if ident == own:
+                                        continue
+                                code = frame.f_code
+                                self.samples += 1
+                                if (os.path.basename(code.co_filename), code.co_name) in IDLE_LEAVES:
+                                        self.idle += 1
+                                        continue
+                                stack = []
+                                while frame is not None:
+                                        stack.append(_frame_name(frame.f_code))
+                                        frame = frame.f_back
+                                stack.append(names.get(ident, str(ident)))
+                                key = ";".join(reversed(stack))
+                                if key in self.stacks or len(self.stacks) < MAX_STACKS:
+                                        self.stacks[key] += 1
+                                else:
+                                        self.stacks["[other]"] += 1
+
+        def top_functions(self, n: int) -> List[Tuple[str, int]]:
+                """Functions by samples spent in them (not in their callees)."""
+                leaves: Counter = Counter()
+                for stack, count in list(self.stacks.items()):
+                        leaves[stack.rsplit(";", 1)[-1]] += count
+                return leaves.most_common(n)
+
+        def write_collapsed(self, path: str) -> None:
+                with open(path, "w", encoding="utf-8") as f:
+                        for stack, count in sorted(list(self.stacks.items())):
+                                f.write(f"{stack} {count}\n")
+
+
+class Profiler:
+        """Profiling state of this process; ``profiler`` below is the instance."""
+
+        def __init__(self, top_n: int = PROFILE_TOP_N, window: float = PROFILE_WINDOW):
+                self.top_n = top_n
+                self.mode: Optional[str] = None
+                self.started_at = 0.0
+                self.handlers = RollingStats(window)
+                self.storage = RollingStats(window)
+                self._sampler: Optional[StackSampler] = None
+                self._cprofile: Optional[cProfile.Profile] = None
+                self._snapshot: Optional[tracemalloc.Snapshot] = None
+
+        @property
+        def enabled(self) -> bool:
+                return self.mode is not None
+
+        def start(self, mode: str = "sample") -> None:
+                """Start profiling; "cprofile" covers the calling thread, so call it on the event loop."""
+                if mode not in MODES:
+                        raise ValueError(f"Unknown profiling mode '{mode}'. Use one of: {', '.join(MODES)}.")
+                self.stop()
+                self._sampler = self._cprofile = None
+                self.reset()
+                if mode == "sample":
+                        self._sampler = StackSampler()
+                        self._sampler.start()
+                else:
+                        self._cprofile = cProfile.Profile()
+                        self._cprofile.enable()
+                self.mode = mode
+                self.started_at = time.time()
+
+        def stop(self) -> None:
+                """Stop collecting; the collected data stays available until the next start or reset."""
+                if self._sampler is not None:
+                        self._sampler.stop()
+                if self._cprofile is not None:
+                        self._cprofile.disable()
+                self.mode = None
+
+        def reset(self) -> None:
+                self.handlers.clear()
+                self.storage.clear()
+                if self._sampler is not None:
+                        self._sampler.stacks.clear()
+                        self._sampler.samples = self._sampler.idle = 0
+                if self._cprofile is not None:
+                        self._cprofile.clear()
+                self.started_at = time.time()
+
+        def timed(self, name: str, call: Callable[[], Any]) -> Callable[[], Any]:
+                """Wrap a storage call so its run time is recorded while profiling is on."""
+                if self.mode is None:
+                        return call
+
+                def run() -> Any:
+                        started = time.perf_counter()
+                        try:
+                                return call()
+                        finally:
+                                self.storage.add(name, time.perf_counter() - started)
+
+                return run
+
+        def _cprofile_stats(self) -> pstats.Stats:
+                # Taking stats disables the profiler; turn it back on for the (event-loop) thread it covers
+                stats = pstats.Stats(self._cprofile)
+                if self.mode == "cprofile":
+                        self._cprofile.enable()
+                return stats
+
+        def _top_functions(self) -> List[str]:
+                n = self.top_n
+                if self._cprofile is not None:
+                        stats = self._cprofile_stats().stats
+                        rows = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:n]
+                        return [
+                                f"{tottime * 1000:9.1f} мс {calls:>8} {func} ({os.path.basename(path)}:{line})"
+                                for (path, line, func), (_, calls, tottime, _, _) in rows
+                        ]
+                if self._sampler is not None:
+                        busy = max(1, self._sampler.samples - self._sampler.idle)
+                        return [
+                                f"{count * 100 / busy:5.1f}% {count:>8} {name}"
+                                for name, count in self._sampler.top_functions(n)
+                        ]
+                return []
+
+        def summary(self) -> str:
+                """Text for /perf; call it on the event loop, like dump()."""
+                state = f"включено ({self.mode})" if self.enabled else "выключено"
+                lines = [f"Профилирование: {state}"]
+                if self.started_at:
+                        lines.append(f"Данные за {int(time.time() - self.started_at)} с")
+                for title, stats in (("Обработчики", self.handlers), ("Хранилище", self.storage)):
+                        rows = stats.top(self.top_n)
+                        if not rows:
+                                continue
+                        lines.append(f"\n{title} (всего / среднее / макс, мс):")
+                        for name, count, total, slowest in rows:
+                                lines.append(f"{total * 1000:9.1f} {total * 1000 / count:8.2f} {slowest * 1000:8.1f}  {name} ×{count}")
+                functions = self._top_functions()
+                if functions:
+                        if self._sampler is not None:
+                                lines.append(f"\nФункции (доля рабочих выборок, {self._sampler.samples} выборок, {self._sampler.idle} в ожидании):")
+                        else:
+                                lines.append("\nФункции (собственное время, вызовы):")
+                        lines.extend(functions)
+                return "\n".join(lines)
+
+        def dump(self, path: str) -> Optional[str]:
+                """Write the profile to path; returns its format ("pstats" or "collapsed"), None if there is none.
+
+                Call it on the event loop: in "cprofile" mode it briefly pauses the profiler.
+                """
+                if self._cprofile is not None:
+                        self._cprofile_stats().dump_stats(path)
+                        return "pstats"
+                if self._sampler is not None:
+                        self._sampler.write_collapsed(path)
+                        return "collapsed"
+                return None
+
+        def memory(self) -> str:
+                """Allocation growth since the previous call; the first call starts tracing."""
+                if not tracemalloc.is_tracing():
+                        tracemalloc.start(TRACEMALLOC_FRAMES)
+                        self._snapshot = tracemalloc.take_snapshot()
+                        return "tracemalloc запущен. Повторите /perf mem позже, чтобы увидеть прирост памяти."
+                snapshot = tracemalloc.take_snapshot().filter_traces((
+                        tracemalloc.Filter(False, tracemalloc.__file__),
+                        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                ))
+                diff = snapshot.compare_to(self._snapshot, "lineno") if self._snapshot else []
+                self._snapshot = snapshot
+                current, peak = tracemalloc.get_traced_memory()
+                lines = [f"Память под трассировкой: {current / 2**20:.1f} МБ (пик {peak / 2**20:.1f} МБ)", "Прирост с прошлого снимка:"]
+                for stat in diff[:self.top_n]:
+                        frame = stat.traceback[0]
+                        lines.append(f"{stat.size_diff / 1024:+10.1f} КБ {stat.count_diff:+8}  {os.path.basename(frame.filename)}:{frame.lineno}")
+                return "\n".join(lines)
+
+        def memory_stop(self) -> None:
+                self._snapshot = None
+                tracemalloc.stop()
+
+
+profiler = Profiler()
+
+
+class ProfilingMiddleware(BaseMiddleware):
+        """Inner router middleware: handler run times for the /perf tables."""
+
+        async def __call__(
+                self,
+                handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                event: TelegramObject,
+                data: Dict[str, Any],
+        ) -> Any:
+                if not profiler.enabled:
+                        return await handler(event, data)
+                name = getattr(getattr(data.get("handler"), "callback", None), "__name__", "unknown")
+                started = time.perf_counter()
+                try:
+                        return await handler(event, data)
+                finally:
+                        profiler.handlers.add(name, time.perf_counter() - started)
@@ -0,0 +1,209 @@
+"""Checkout sessions: aiogram FSM storage with TTL, LRU cap and disk persistence.
+
+Users who pick a number and walk away no longer pin memory: every session
+expires TTL seconds after it was last touched, and the least recently used
+one is dropped once ``max_entries`` are live. With a ``path`` the sessions
+are written to disk (atomically, at most every ``save_interval`` seconds and
+on close) and loaded back on start, so a deploy does not lose checkouts.
+
+With ``STORAGE_BACKEND=sqlite`` several bot processes may serve the same
+user, so sessions are kept in the database instead (:class:`SharedSessionStorage`).
+"""
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+from dataclasses import asdict
+from typing import Any, Dict, List, Optional, Tuple
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from . import async_storage, storage
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+
+# Seconds an untouched checkout stays alive
+CHECKOUT_SESSION_TTL = int(os.getenv("CHECKOUT_SESSION_TTL", "1800"))
+# Live checkouts kept at most; the least recently used is dropped first
+CHECKOUT_SESSION_MAX = int(os.getenv("CHECKOUT_SESSION_MAX", "10000"))
+# Where sessions survive restarts; empty keeps them in memory only
+CHECKOUT_SESSION_FILE = os.getenv("CHECKOUT_SESSION_FILE", os.path.join(DATA_DIR, "checkout_sessions.json"))
+CHECKOUT_SESSION_SAVE_INTERVAL = float(os.getenv("CHECKOUT_SESSION_SAVE_INTERVAL", "5"))
+# How often expired sessions are deleted from the database (seconds)
+SESSION_PURGE_INTERVAL = 60
+
+
+class CheckoutSessionStorage(BaseStorage):
+        """FSM storage for checkout sessions, bounded in time and in size.
+
+        Every read or write renews a session's deadline and moves it to the end
+        of the LRU order, so the order is also deadline order and expired
+        sessions are purged from the front in O(expired).
+        """
+
+        def __init__(self, ttl: float = CHECKOUT_SESSION_TTL, max_entries: int = CHECKOUT_SESSION_MAX,
+                     path: Optional[str] = None, save_interval: float = CHECKOUT_SESSION_SAVE_INTERVAL):
+                self.ttl = ttl
+                self.max_entries = max_entries
+                self.path = os.path.abspath(path) if path else None
+                self.save_interval = save_interval
+                # key -> [deadline (unix time), state, data]
+                self._entries: "OrderedDict[StorageKey, List[Any]]" = OrderedDict()
+                self._dirty = False
+                self._saver: Optional[asyncio.Task] = None
+                if self.path:
+                        self._load()
+
+        def __len__(self) -> int:
+                self._purge(time.time())
+                return len(self._entries)
+
+        def _purge(self, now: float) -> None:
+                while self._entries:
+                        key, entry = next(iter(self._entries.items()))
+                        if entry[0] > now:
+                                break
+                        del self._entries[key]
+                        self._dirty = True
+
+        def _entry(self, key: StorageKey) -> Optional[List[Any]]:
+                now = time.time()
+                self._purge(now)
+                entry = self._entries.get(key)
+                if entry is not None:
+                        entry[0] = now + self.ttl
+                        self._entries.move_to_end(key)
+                return entry
+
+        def _put(self, key: StorageKey, state: Optional[str], data: Dict[str, Any]) -> None:
+                self._dirty = True
+                self._schedule_save()
+                if state is None and not data:
+                        self._entries.pop(key, None)
+                        return
+                self._entries[key] = [time.time() + self.ttl, state, data]
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+
+        async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+                entry = self._entry(key)
+                value = state.state if isinstance(state, State) else state
+                self._put(key, value, entry[2] if entry else {})
+
+        async def get_state(self, key: StorageKey) -> Optional[str]:
+                entry = self._entry(key)
+                return entry[1] if entry else None
+
+        async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+                entry = self._entry(key)
+                self._put(key, entry[1] if entry else None, dict(data))
+
+        async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+                entry = self._entry(key)
+                return dict(entry[2]) if entry else {}
+
+        # Persistence
+
+        def _load(self) -> None:
+                try:
+                        with open(self.path, "r", encoding="utf-8") as f:
+                                rows = json.load(f)
+                except (OSError, ValueError):
+                        return
+                now = time.time()
+                for row in sorted(rows, key=lambda r: r["deadline"]):
+                        if row["deadline"] > now:
+                                self._entries[StorageKey(**row["key"])] = [row["deadline"], row["state"], row["data"]]
+                while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+
+        def _snapshot(self) -> str:
+                self._purge(time.time())
+                return json.dumps(
+                        [{"key": asdict(key), "deadline": e[0], "state": e[1], "data": e[2]} for key, e in self._entries.items()],
+                        ensure_ascii=False,
+                )
+
+        def _write(self, payload: str) -> None:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                tmp_path = self.path + ".tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                        f.write(payload)
+                os.replace(tmp_path, self.path)
+
+        def _schedule_save(self) -> None:
+                if not self.path or (self._saver and not self._saver.done()):
+                        return
+                try:
+                        self._saver = asyncio.get_running_loop().create_task(self._save_later())
+                except RuntimeError:
+                        # No running loop: close() still writes the sessions out
+                        pass
+
+        async def _save_later(self) -> None:
+                await asyncio.sleep(self.save_interval)
+                await self.save()
+
+        async def save(self) -> None:
+                """Write the live sessions to disk if anything changed."""
+                if not self.path or not self._dirty:
+                        return
+                self._dirty = False
+                # Serialize on the loop (entries are not thread-safe), write the file off it
+                await asyncio.to_thread(self._write, self._snapshot())
+
+        async def close(self) -> None:
+                if self._saver and not self._saver.done():
+                        self._saver.cancel()
+                await self.save()
+
+
+class SharedSessionStorage(BaseStorage):
+        """FSM storage in the SQLite database, shared by every bot process.
+
+        A user's next update may be handled by another worker, so the session
+        cannot live in one process's memory. A session expires ttl seconds
+        after it was last written.
+        """
+
+        def __init__(self, ttl: float = CHECKOUT_SESSION_TTL):
+                self.ttl = ttl
+                self._purged = 0.0
+
+        @staticmethod
+        def _key(key: StorageKey) -> str:
+                return ":".join(str(value) for value in asdict(key).values())
+
+        async def _load(self, key: StorageKey) -> Tuple[Optional[str], Dict[str, Any]]:
+                return await async_storage.load_session(self._key(key)) or (None, {})
+
+        async def _save(self, key: StorageKey, state: Optional[str], data: Dict[str, Any]) -> None:
+                await async_storage.save_session(self._key(key), state, data, self.ttl)
+                now = time.time()
+                if now - self._purged > SESSION_PURGE_INTERVAL:
+                        self._purged = now
+                        await async_storage.purge_sessions()
+
+        async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+                _, data = await self._load(key)
+                await self._save(key, state.state if isinstance(state, State) else state, data)
+
+        async def get_state(self, key: StorageKey) -> Optional[str]:
+                return (await self._load(key))[0]
+
+        async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+                state, _ = await self._load(key)
+                await self._save(key, state, dict(data))
+
+        async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+                return (await self._load(key))[1]
+
+        async def close(self) -> None:
+                pass
+
+
+if storage.STORAGE_BACKEND == "sqlite":
+        checkout_sessions: BaseStorage = SharedSessionStorage()
+else:
+        checkout_sessions = CheckoutSessionStorage(path=CHECKOUT_SESSION_FILE or None)
@@ -0,0 +1,270 @@
+"""Binary snapshots of the JSON backend's state.
+
+Parsing pretty-printed JSON makes a cold start take seconds once payments and
+users pile up. A snapshot is a small header, a section table and the
+sections themselves:
+
+        header   magic (8 bytes) | format version (u16) | section count (u16)
+        table    per section: name (32 bytes) | codec (u8) | offset (u64) | length (u64) | crc32 (u32)
+        payload  sections back to back, each starting on an 8-byte boundary
+
+The number catalogue is stored as the raw bytes of its arrays, so loading it
+is a memory copy instead of a parse. Every other collection is one section
+encoded with a pluggable serializer: msgpack or orjson when installed, pickle
+otherwise (``SNAPSHOT_SERIALIZER`` picks one explicitly). The codec is
+recorded per section, so changing the serializer only affects new writes.
+
+The file is memory-mapped and the settled payment history is a cold section:
+its pages are not even read until something needs an old payment, so the bot
+answers as soon as the hot sections are decoded. Snapshots are trusted local
+files (pickle may be in use); never load one from elsewhere.
+
+JSON remains the interchange format:
+
+        python -m bot.snapshot export state.json    # current state -> JSON
+        python -m bot.snapshot import state.json    # JSON -> snapshot (bot stopped)
+        python -m bot.snapshot info                 # sections and sizes
+"""
+import mmap
+import os
+import pickle
+import struct
+import sys
+import threading
+import zlib
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from .catalogue import NumberCatalogue
+
+try:
+        import msgpack
+except ImportError:  # optional, faster than pickle
+        msgpack = None
+try:
+        import orjson
+except ImportError:  # optional, faster than pickle
+        orjson = None
+
+MAGIC = b"NUMSNAP\x00"
+FORMAT_VERSION = 1
+
+_HEADER = struct.Struct("<8sHH")
+_ENTRY = struct.Struct("<32sB3xQQI")
+_ALIGN = 8
+
+# Codec ids as stored in the section table; never renumber
+CODEC_RAW = 0
+CODEC_PICKLE = 1
+CODEC_MSGPACK = 2
+CODEC_ORJSON = 3
+
+# Top-level collections with a section of their own; every other key goes to "meta"
+COLLECTIONS = ("rentals", "holds", "promocodes", "users")
+
+
+class SnapshotError(ValueError):
+        """The file is not a snapshot this version can read."""
+
+
+def _pickle_dumps(obj: Any) -> bytes:
+        return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+# name -> (codec id, dumps, loads); None when the library is not installed
+SERIALIZERS: Dict[str, Optional[Tuple[int, Callable[[Any], bytes], Callable[[Any], Any]]]] = {
+        "msgpack": (
+                CODEC_MSGPACK,
+                lambda obj: msgpack.packb(obj, use_bin_type=True),
+                lambda data: msgpack.unpackb(data, raw=False, strict_map_key=False),
+        ) if msgpack else None,
+        "orjson": (
+                CODEC_ORJSON,
+                lambda obj: orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS),
+                orjson.loads,
+        ) if orjson else None,
+        "pickle": (CODEC_PICKLE, _pickle_dumps, pickle.loads),
+}
+
+# Serializer for new snapshots: "auto" takes the first installed of msgpack, orjson, pickle
+SNAPSHOT_SERIALIZER = os.getenv("SNAPSHOT_SERIALIZER", "auto").strip().lower()
+
+
+def _serializer(name: str = SNAPSHOT_SERIALIZER) -> Tuple[int, Callable[[Any], bytes], Callable[[Any], Any]]:
+        if name == "auto":
+                return next(s for s in SERIALIZERS.values() if s is not None)
+        if name not in SERIALIZERS:
+                raise RuntimeError(f"Unknown SNAPSHOT_SERIALIZER '{name}'. Use auto, {', '.join(SERIALIZERS)}.")
+        if SERIALIZERS[name] is None:
+                raise RuntimeError(f"SNAPSHOT_SERIALIZER={name} but the {name} package is not installed.")
+        return SERIALIZERS[name]
+
+
+def _loader(codec: int) -> Callable[[Any], Any]:
+        for name, serializer in SERIALIZERS.items():
+                if serializer is not None and serializer[0] == codec:
+                        return serializer[2]
+        names = {CODEC_MSGPACK: "msgpack", CODEC_ORJSON: "orjson"}
+        raise SnapshotError(f"the snapshot was written with {names.get(codec, f'codec {codec}')}, which is not installed")
+
+
+def is_snapshot(path: str) -> bool:
+        try:
+                with open(path, "rb") as f:
+                        return f.read(len(MAGIC)) == MAGIC
+        except OSError:
+                return False
+
+
+class Snapshot:
+        """A snapshot file mapped into memory; sections are decoded on request."""
+
+        def __init__(self, path: str):
+                self.path = path
+                with open(path, "rb") as f:
+                        # The map keeps its own handle; the file may be replaced while it is open
+                        self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.size = len(self._map)
+                magic, version, count = _HEADER.unpack_from(self._map, 0)
+                if magic != MAGIC:
+                        raise SnapshotError(f"{path} is not a state snapshot")
+                if version > FORMAT_VERSION:
+                        raise SnapshotError(f"{path} has snapshot format {version}; this bot reads up to {FORMAT_VERSION}")
+                self.sections: Dict[str, Tuple[int, int, int, int]] = {}
+                for i in range(count):
+                        name, codec, offset, length, crc = _ENTRY.unpack_from(self._map, _HEADER.size + i * _ENTRY.size)
+                        self.sections[name.rstrip(b"\x00").decode("ascii")] = (codec, offset, length, crc)
+
+        def raw(self, name: str) -> Tuple[int, memoryview]:
+                """(codec, bytes) of a section, checked against its CRC."""
+                codec, offset, length, crc = self.sections[name]
+                data = memoryview(self._map)[offset:offset + length]
+                if zlib.crc32(data) != crc:
+                        raise SnapshotError(f"section '{name}' of {self.path} is corrupt")
+                return codec, data
+
+        def read(self, name: str, default: Any = None) -> Any:
+                if name not in self.sections:
+                        return default
+                codec, data = self.raw(name)
+                return data if codec == CODEC_RAW else _loader(codec)(data)
+
+
+class ColdSection:
+        """A section left encoded until first use; load() decodes it once, from any thread."""
+
+        def __init__(self, snapshot: Snapshot, name: str):
+                self.snapshot = snapshot
+                self.name = name
+                self._lock = threading.Lock()
+                self._value: Any = None
+
+        def raw(self) -> Tuple[int, memoryview]:
+                return self.snapshot.raw(self.name)
+
+        def load(self) -> Any:
+                with self._lock:
+                        if self._value is None:
+                                self._value = self.snapshot.read(self.name, {})
+                        return self._value
+
+
+def read_state(path: str, lazy: bool = False) -> Tuple[Dict, Optional[ColdSection]]:
+        """Load a snapshot into a state dict with a NumberCatalogue under "numbers".
+
+        With lazy=True, state["payments"] holds only the pending and recently
+        settled payments and the rest of the history is returned as a
+        ColdSection for the caller to merge in when it is needed.
+        """
+        snapshot = Snapshot(path)
+        state = snapshot.read("meta")
+        buffers = {
+                name[len("numbers."):]: snapshot.raw(name)[1]
+                for name in snapshot.sections if name.startswith("numbers.") and name != "numbers.tables"
+        }
+        state["numbers"] = NumberCatalogue.from_arrays(snapshot.read("numbers.tables"), buffers)
+        for key in COLLECTIONS:
+                state[key] = snapshot.read(key, {} if key != "promocodes" else [])
+        payments = snapshot.read("payments.recent", {})
+        payments.update(snapshot.read("payments.pending", {}))
+        history = ColdSection(snapshot, "payments")
+        if lazy:
+                state["payments"] = payments
+                return state, history
+        state["payments"] = history.load()
+        state["payments"].update(payments)
+        return state, None
+
+
+def encode_state(state: Dict, pending: Dict[str, Dict], history: Optional[ColdSection] = None) -> bytes:
+        """Snapshot bytes for a resident state.
+
+        pending: the pending payments (storage keeps this index anyway).
+        history: the still-encoded payment history, if it was never loaded; its
+        bytes are copied over as they are, and the settled payments in state
+        go to the "payments.recent" section next to it.
+        """
+        codec, dumps, _ = _serializer()
+        meta = {key: value for key, value in state.items() if key not in COLLECTIONS + ("numbers", "payments")}
+        sections: List[Tuple[str, int, Any]] = [("meta", codec, dumps(meta))]
+        tables, buffers = state["numbers"].export_arrays()
+        sections.append(("numbers.tables", codec, dumps(tables)))
+        sections.extend((f"numbers.{name}", CODEC_RAW, data) for name, data in buffers.items())
+        sections.extend((key, codec, dumps(state[key])) for key in COLLECTIONS)
+        sections.append(("payments.pending", codec, dumps(pending)))
+        settled = {payment_id: p for payment_id, p in state["payments"].items() if payment_id not in pending}
+        if history is not None:
+                history_codec, history_data = history.raw()
+                sections.append(("payments.recent", codec, dumps(settled)))
+                sections.append(("payments", history_codec, history_data))
+        else:
+                sections.append(("payments", codec, dumps(settled)))
+        return _pack(sections)
+
+
+def _pack(sections: List[Tuple[str, int, Any]]) -> bytes:
+        offset = _HEADER.size + _ENTRY.size * len(sections)
+        table, chunks = [], []
+        for name, codec, data in sections:
+                if len(name) > 32:
+                        raise ValueError(f"section name '{name}' is longer than 32 bytes")
+                padding = -offset % _ALIGN
+                chunks.append(b"\x00" * padding)
+                offset += padding
+                table.append(_ENTRY.pack(name.encode("ascii"), codec, offset, len(data), zlib.crc32(data)))
+                chunks.append(data)
+                offset += len(data)
+        return b"".join([_HEADER.pack(MAGIC, FORMAT_VERSION, len(sections))] + table + chunks)
+
+
+def info(path: str) -> List[Tuple[str, str, int]]:
+        """(section, codec name, bytes) for every section of a snapshot."""
+        names = {CODEC_RAW: "raw", CODEC_PICKLE: "pickle", CODEC_MSGPACK: "msgpack", CODEC_ORJSON: "orjson"}
+        snapshot = Snapshot(path)
+        return [(name, names.get(codec, str(codec)), length) for name, (codec, _, length, _) in snapshot.sections.items()]
+
+
+def _main(argv: List[str]) -> int:
+        from . import storage
+
+        if len(argv) < 2 or argv[1] not in ("export", "import", "info"):
+                print("Usage: python -m bot.snapshot export|import <state.json> | info [state.snap]")
+                return 2
+        command = argv[1]
+        if command == "info":
+                path = argv[2] if len(argv) > 2 else storage.STATE_SNAPSHOT_FILE
+                for name, codec, length in info(path):
+                        print(f"{name:18} {codec:8} {length:>14,} bytes")
+                return 0
+        if len(argv) != 3:
+                print(f"Usage: python -m bot.snapshot {command} <state.json>")
+                return 2
+        if command == "export":
+                count = storage.export_json(argv[2])
+                print(f"Exported {count} numbers to {argv[2]}")
+        else:
+                count = storage.import_json(argv[2])
+                print(f"Imported {count} numbers from {argv[2]} into {storage.STATE_SNAPSHOT_FILE}")
+        return 0
+
+
+if __name__ == "__main__":
+        sys.exit(_main(sys.argv))
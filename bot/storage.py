@@ -1,138 +1,746 @@
+import atexit
+import heapq
 import json
 import os
+import threading
+import time
+import zlib
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+from functools import wraps
+from itertools import islice
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from . import archive, journal, metrics, snapshot
+from .catalogue import NumberCatalogue, NumberRecord
 from .data import SEEDED_NUMBERS
 
+try:
+        import fcntl
+except ImportError:  # Windows
+        fcntl = None
+
 DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
-STATE_FILE = os.path.abspath(os.path.join(DATA_DIR, "state.json"))
+STATE_FILE = os.path.abspath(os.getenv("STATE_FILE", os.path.join(DATA_DIR, "state.json")))
+# "snapshot" (default) persists the state as a binary snapshot next to STATE_FILE and reads
+# STATE_FILE only to take it over; "json" keeps writing STATE_FILE as before
+STATE_FORMAT = os.getenv("STATE_FORMAT", "snapshot").strip().lower()
+STATE_SNAPSHOT_FILE = os.path.abspath(os.getenv("STATE_SNAPSHOT_FILE", os.path.splitext(STATE_FILE)[0] + ".snap"))
 
 ISO_FORMAT = "%Y-%m-%dT%H:%M:%S"
 
+# "json" keeps everything in data/state.json; "sqlite" switches the public API
+# below to bot/storage_sqlite.py (see the end of this module).
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").strip().lower()
+
+# Write-behind settings: a mutation is flushed once the state has been quiet
+# for STATE_FLUSH_DELAY seconds, but never later than STATE_FLUSH_MAX_DELAY
+# seconds after the first unsaved change.
+STATE_FLUSH_DELAY = float(os.getenv("STATE_FLUSH_DELAY", "0.5"))
+STATE_FLUSH_MAX_DELAY = float(os.getenv("STATE_FLUSH_MAX_DELAY", "5"))
+
+# Journal settings: with "fsync" every mutation is appended to a journal (see
+# bot/journal.py) and the whole state is only rewritten (compacted) every
+# STATE_COMPACT_INTERVAL seconds or once the journal reaches
+# STATE_JOURNAL_MAX_BYTES; the flush delays above then do not apply. "off"
+# rewrites the state after every burst of changes, as before.
+STATE_JOURNAL = os.getenv("STATE_JOURNAL", "fsync").strip().lower()
+STATE_JOURNAL_FILE = os.path.abspath(os.getenv("STATE_JOURNAL_FILE", os.path.splitext(STATE_FILE)[0] + ".journal"))
+STATE_COMPACT_INTERVAL = float(os.getenv("STATE_COMPACT_INTERVAL", "300"))
+STATE_JOURNAL_MAX_BYTES = int(os.getenv("STATE_JOURNAL_MAX_BYTES", str(64 * 2**20)))
+
+_lock = threading.RLock()
+_flush_lock = threading.Lock()
+_writer_cond = threading.Condition(_lock)
+_state: Optional[Dict] = None
+_dirty_since: Optional[float] = None
+_last_change = 0.0
+_writer: Optional[threading.Thread] = None
+_writer_stop = False
+
+# Expiry index: min-heap of (until, number, user_key). Entries are never removed
+# in place; extended or removed rentals leave stale entries that are skipped
+# when they reach the top.
+_expiry_heap: List[Tuple[str, str, str]] = []
+_expiry_listeners: List[Callable[[], None]] = []
+
+# Hash indexes over the resident state, kept in sync by every mutation.
+# Numbers index themselves: state["numbers"] is a NumberCatalogue (see bot/catalogue.py).
+_renters: Dict[str, str] = {}  # number -> user_key of the current holder
+_promocodes_by_code: Dict[str, Dict] = {}  # upper-cased code -> promocode
+_pending_payments: Dict[str, Dict] = {}  # payment_id -> payment with status "pending"
+
+# Bumped whenever a number's status or price changes; rendered keyboards are cached per version
+_inventory_version = 0
+
+# Reservation timer index: min-heap of (until, number, payment_id), lazily pruned like _expiry_heap
+_hold_heap: List[Tuple[str, str, str]] = []
+
+# Open lock file that marks data/state.json as owned by this process
+_process_lock = None
+# name -> (owner, expires); the JSON state has a single process, so leases never leave it
+_leases: Dict[str, Tuple[str, float]] = {}
+
+# Settled payment history still encoded in the loaded snapshot; merged into state["payments"] on first need
+_cold_payments: Optional[snapshot.ColdSection] = None
+
+# Open journal (STATE_JOURNAL=fsync); _compact_now asks the writer to compact without waiting
+_journal: Optional[journal.Journal] = None
+_journal_listeners: List[Callable[[int], None]] = []
+_compact_now = False
+
+# One archiving pass at a time, so two passes never archive the same batch
+_archive_lock = threading.Lock()
+
 
 def _ensure_dirs() -> None:
         os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
+        os.makedirs(os.path.dirname(STATE_SNAPSHOT_FILE), exist_ok=True)
+        os.makedirs(os.path.dirname(STATE_JOURNAL_FILE), exist_ok=True)
 
 
-def _load_state() -> Dict:
+def _lock_state_file() -> None:
+        """Claim data/state.json for this process for as long as it runs.
+
+        The state lives in memory and is written back whole, so a second
+        process on the same file would silently overwrite the first one's
+        changes. It fails here instead.
+        """
+        global _process_lock
+        if fcntl is None or _process_lock is not None:
+                return
         _ensure_dirs()
-        if not os.path.exists(STATE_FILE):
+        lock_file = open(STATE_FILE + ".lock", "a")
+        try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+                lock_file.close()
+                raise RuntimeError(
+                        f"{STATE_FILE} is in use by another process. The JSON storage supports one process; "
+                        "use STORAGE_BACKEND=sqlite to run several."
+                )
+        _process_lock = lock_file
+
+
+# Schema migrations
+
+def _stable_hash(value: str) -> int:
+        """Hash that is identical in every process (unlike hash(), which is salted per run)."""
+        return zlib.crc32(value.encode("utf-8"))
+
+
+def _migrate_collections(state: Dict) -> None:
+        """v1: promocodes and users collections."""
+        state.setdefault("promocodes", [])
+        state.setdefault("users", {})
+
+
+def _migrate_number_categories(state: Dict) -> None:
+        """v2: add category, price and type to numbers that predate categories."""
+        for num in state.get("numbers", []):
+                if "category" in num and "price" in num and "type" in num:
+                        continue
+                number_str = num.get("number", "")
+                
+                # Assign category and type based on number pattern
+                if "+888" in number_str:
+                        num["category"] = "anonymous"
+                        num["type"] = "rent"
+                        num["price"] = 25
+                elif "+7" in number_str or "+380" in number_str:
+                        # Russian/Ukrainian numbers - could be esim or physical
+                        if _stable_hash(number_str) % 2 == 0:
+                                num["category"] = "esim"
+                                num["price"] = 15
+                        else:
+                                num["category"] = "physical"
+                                num["price"] = 8
+                        num["type"] = "sale"
+                elif "eSIM" in number_str:
+                        num["category"] = "esim"
+                        num["type"] = "sale"
+                        num["price"] = 15
+                elif "PHYS" in number_str:
+                        num["category"] = "physical"
+                        num["type"] = "sale"
+                        num["price"] = 8
+                else:
+                        # Legacy numbers
+                        num_hash = _stable_hash(number_str)
+                        category = "anonymous" if num_hash % 3 == 0 else ("esim" if num_hash % 2 == 0 else "physical")
+                        num["category"] = category
+                        if category == "anonymous":
+                                num["type"] = "rent"
+                                num["price"] = 25
+                        else:
+                                num["type"] = "sale"
+                                num["price"] = 15 if category == "esim" else 8
+
+
+def _migrate_holds(state: Dict) -> None:
+        """v3: number reservations for open invoices."""
+        state.setdefault("holds", {})
+
+
+# Ordered registry: (version, migration). Append new steps; never reorder or edit released ones.
+MIGRATIONS: List[Tuple[int, Callable[[Dict], None]]] = [
+        (1, _migrate_collections),
+        (2, _migrate_number_categories),
+        (3, _migrate_holds),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def _migrate(state: Dict) -> bool:
+        """Apply every migration newer than the state's schema_version. Returns True if any ran."""
+        version = state.get("schema_version", 0)
+        for target, migration in MIGRATIONS:
+                if target > version:
+                        migration(state)
+                        state["schema_version"] = target
+        return state["schema_version"] != version
+
+
+def _read_state_file(path: Optional[str] = None) -> Tuple[Dict, bool]:
+        """Read and migrate a state file (data/state.json by default). Returns (state, migrated).
+
+        A binary snapshot is recognised by its header and read in full, with
+        its numbers already in a NumberCatalogue.
+        """
+        path = path or STATE_FILE
+        _ensure_dirs()
+        if not os.path.exists(path):
                 return {
-                        "numbers": SEEDED_NUMBERS,
+                        "schema_version": SCHEMA_VERSION,
+                        "numbers": [dict(n) for n in SEEDED_NUMBERS],
                         "rentals": {},  # user_id -> List[{number, until_iso}]
                         "payments": {},  # payment_id -> {user_id, number, months, price, invoice_id, status}
                         "promocodes": [],  # List[{code, percent, active, created_at, created_by}]
                         "users": {},  # user_id -> {username, first_seen, last_seen}
-                }
-        with open(STATE_FILE, "r", encoding="utf-8") as f:
-                state = json.load(f)
-                if "promocodes" not in state:
-                        state["promocodes"] = []
-                if "users" not in state:
-                        state["users"] = {}
-                
-                # Migration: add category, price, and type to existing numbers (deterministic and persistent)
-                migration_needed = False
-                for num in state.get("numbers", []):
-                        if "category" not in num or "price" not in num or "type" not in num:
-                                migration_needed = True
-                                number_str = num.get("number", "")
-                                
-                                # Assign category and type based on number pattern
-                                if "+888" in number_str:
-                                        num["category"] = "anonymous"
-                                        num["type"] = "rent"
-                                        num["price"] = 25
-                                elif "+7" in number_str or "+380" in number_str:
-                                        # Russian/Ukrainian numbers - could be esim or physical
-                                        # Use hash for deterministic assignment
-                                        num_hash = hash(number_str)
-                                        if num_hash % 2 == 0:
-                                                num["category"] = "esim"
-                                                num["price"] = 15
-                                        else:
-                                                num["category"] = "physical"
-                                                num["price"] = 8
-                                        num["type"] = "sale"
-                                elif "eSIM" in number_str:
-                                        num["category"] = "esim"
-                                        num["type"] = "sale"
-                                        num["price"] = 15
-                                elif "PHYS" in number_str:
-                                        num["category"] = "physical"
-                                        num["type"] = "sale"
-                                        num["price"] = 8
+                        "holds": {},  # number -> {payment_id, user_id, until}
+                }, False
+        if snapshot.is_snapshot(path):
+                with metrics.storage_seconds.time(op="load"):
+                        state, _ = snapshot.read_state(path)
+                        migrated = _migrate(state)
+                metrics.storage_bytes.inc(os.path.getsize(path), op="load")
+                return state, migrated
+        with metrics.storage_seconds.time(op="load"):
+                with open(path, "rb") as f:
+                        raw = f.read()
+                state = json.loads(raw)
+                migrated = _migrate(state)
+        metrics.storage_bytes.inc(len(raw), op="load")
+        return state, migrated
+
+
+def _read_snapshot() -> Tuple[Dict, bool]:
+        """Load the snapshot with the payment history left cold. Returns (state, migrated)."""
+        global _cold_payments
+        with metrics.storage_seconds.time(op="load"):
+                state, _cold_payments = snapshot.read_state(STATE_SNAPSHOT_FILE, lazy=True)
+                if state.get("schema_version", 0) < SCHEMA_VERSION:
+                        # Migrations may touch any payment, so they get the whole history
+                        _load_cold_payments(state)
+                migrated = _migrate(state)
+        metrics.storage_bytes.inc(os.path.getsize(STATE_SNAPSHOT_FILE), op="load")
+        return state, migrated
+
+
+def _apply_record(state: Dict, collection: str, key: str, value: Any) -> None:
+        """Redo one journal record: value is the entry's new contents, None removes it."""
+        if collection == "numbers":
+                item = state["numbers"].get(key)
+                if item is None:
+                        state["numbers"].append(value)
+                        return
+                for field, field_value in value.items():
+                        if item.get(field) != field_value:
+                                item[field] = field_value
+        elif collection == "promocodes":
+                promocodes = state["promocodes"]
+                for i, promo in enumerate(promocodes):
+                        if promo["code"] == key:
+                                promocodes[i] = value
+                                break
+                else:
+                        promocodes.append(value)
+        elif value is None:
+                state[collection].pop(key, None)
+        else:
+                state[collection][key] = value
+
+
+def _replay_journal(state: Dict) -> Tuple[int, int]:
+        """Apply the journal generations the state file does not contain.
+
+        Returns (records applied, next free generation).
+        """
+        generation = state.get("journal_generation", 0)
+        replayed = 0
+        for number, path in journal.generations(STATE_JOURNAL_FILE):
+                if number < generation:
+                        continue
+                for record in journal.read(path):
+                        _apply_record(state, *record)
+                        replayed += 1
+                generation = number + 1
+        return replayed, generation
+
+
+def _notify_journal_sync(seq: int) -> None:
+        for callback in _journal_listeners:
+                callback(seq)
+
+
+def _log(collection: str, key: str, value: Any) -> None:
+        """Journal the new value of an entry of state[collection] (None: removed). The caller holds the lock."""
+        global _compact_now
+        if _journal is None:
+                return
+        _journal.append(collection, key, value)
+        if _journal.size >= STATE_JOURNAL_MAX_BYTES and not _compact_now:
+                _compact_now = True
+                _writer_cond.notify()
+
+
+def _log_number(item: NumberRecord) -> None:
+        _log("numbers", item["number"], dict(item))
+
+
+def _load_state() -> Dict:
+        """Return the resident state, reading the snapshot (or data/state.json) and the journal on first use only."""
+        global _state, _journal, _compact_now
+        if _state is None:
+                with _lock:
+                        if _state is None:
+                                _lock_state_file()
+                                # Migrations run here, once per process; the read path never sees them
+                                if STATE_FORMAT == "snapshot" and os.path.exists(STATE_SNAPSHOT_FILE):
+                                        state, migrated = _read_snapshot()
                                 else:
-                                        # Legacy numbers: use hash for deterministic assignment
-                                        num_hash = hash(number_str)
-                                        category = "anonymous" if num_hash % 3 == 0 else ("esim" if num_hash % 2 == 0 else "physical")
-                                        num["category"] = category
-                                        if category == "anonymous":
-                                                num["type"] = "rent"
-                                                num["price"] = 25
-                                        else:
-                                                num["type"] = "sale"
-                                                num["price"] = 15 if category == "esim" else 8
-                
-                # Save state immediately after migration to persist changes
-                if migration_needed:
-                        _save_state(state)
-                
-                return state
+                                        state, migrated = _read_state_file()
+                                        # A JSON state (or the seed) is taken over by the first snapshot write
+                                        migrated = migrated or STATE_FORMAT == "snapshot"
+                                if not isinstance(state["numbers"], NumberCatalogue):
+                                        # The catalogue replaces the list of number dicts for as long as the state is resident
+                                        state["numbers"] = NumberCatalogue(state["numbers"])
+                                generation = state.get("journal_generation", 0)
+                                # Older generations are in the state file already (a compaction was cut short)
+                                journal.remove_before(STATE_JOURNAL_FILE, generation)
+                                if journal.generations(STATE_JOURNAL_FILE):
+                                        # Records replace whole payments, including ones in the cold history
+                                        _load_cold_payments(state)
+                                        replayed, generation = _replay_journal(state)
+                                        migrated = migrated or replayed > 0
+                                _rebuild_indexes(state)
+                                if STATE_JOURNAL == "fsync":
+                                        _journal = journal.Journal(STATE_JOURNAL_FILE, generation)
+                                        _journal.on_sync(_notify_journal_sync)
+                                else:
+                                        # The next flush makes the replayed generations obsolete
+                                        state["journal_generation"] = generation
+                                _state = state
+                                # Persist the migrated (or replayed) state and its schema_version with the next flush
+                                if migrated:
+                                        _compact_now = True
+                                        _save_state(state)
+        return _state
+
+
+def _rebuild_indexes(state: Dict) -> None:
+        global _expiry_heap, _hold_heap
+        _renters.clear()
+        for user_key, rentals in state["rentals"].items():
+                for r in rentals:
+                        _renters[r["number"]] = user_key
+        _promocodes_by_code.clear()
+        for promo in state["promocodes"]:
+                _promocodes_by_code.setdefault(promo["code"].upper(), promo)
+        _pending_payments.clear()
+        for payment_id, p in state["payments"].items():
+                if p.get("status") == "pending":
+                        _pending_payments[payment_id] = p
+        _expiry_heap = [
+                (r["until"], r["number"], user_key)
+                for user_key, rentals in state["rentals"].items()
+                for r in rentals
+        ]
+        heapq.heapify(_expiry_heap)
+        _hold_heap = [(h["until"], number, h["payment_id"]) for number, h in state["holds"].items()]
+        heapq.heapify(_hold_heap)
+
+
+def _bump_inventory_version() -> None:
+        global _inventory_version
+        _inventory_version += 1
+
+
+def _set_number_status(item: NumberRecord, status: str) -> None:
+        """Change a number's status; the catalogue moves it to the matching (category, status) bitmap."""
+        if item.get("status") != status:
+                _bump_inventory_version()
+        item["status"] = status
+        _log_number(item)
+
+
+# Cursors for page_numbers: (status_rank, position), ordered like the pages themselves
+Cursor = Tuple[int, int]
+
+
+def _page_keys_after(numbers: NumberCatalogue, category: str, statuses: Tuple[str, ...],
+                     after: Optional[Cursor], count: int) -> List[Cursor]:
+        """Up to count keys following `after` (from the start if None), in ascending order."""
+        keys: List[Cursor] = []
+        rank, position = after if after is not None else (0, -1)
+        for r in range(rank, len(statuses)):
+                start = position + 1 if r == rank else 0
+                keys.extend((r, p) for p in islice(numbers.positions(category, statuses[r], start), count - len(keys)))
+                if len(keys) >= count:
+                        break
+        return keys
+
+
+def _page_keys_before(numbers: NumberCatalogue, category: str, statuses: Tuple[str, ...],
+                      before: Cursor, count: int) -> List[Cursor]:
+        """Up to count keys preceding `before`, nearest first."""
+        keys: List[Cursor] = []
+        rank, position = before
+        for r in range(min(rank, len(statuses) - 1), -1, -1):
+                end = position if r == rank else len(numbers)
+                keys.extend((r, p) for p in islice(numbers.positions_before(category, statuses[r], end), count - len(keys)))
+                if len(keys) >= count:
+                        break
+        return keys
+
+
+def _remove_rental(state: Dict, user_key: str, rental: Dict) -> None:
+        state["rentals"][user_key].remove(rental)
+        _log("rentals", user_key, state["rentals"][user_key])
+        if _renters.get(rental["number"]) == user_key:
+                del _renters[rental["number"]]
+
+
+def on_expiry_change(callback: Callable[[], None]) -> None:
+        """Register a callback fired whenever a rental deadline is added or moved.
+
+        Callbacks may run on any thread; they must only schedule work.
+        """
+        _expiry_listeners.append(callback)
+
+
+def _notify_expiry_change() -> None:
+        for callback in _expiry_listeners:
+                callback()
+
+
+def _track_expiry(user_key: str, rental: Dict) -> None:
+        heapq.heappush(_expiry_heap, (rental["until"], rental["number"], user_key))
+        _notify_expiry_change()
+
+
+def _live_rental(state: Dict, entry: Tuple[str, str, str]) -> Optional[Dict]:
+        """Return the rental an expiry heap entry refers to, or None if the entry is stale."""
+        until, number, user_key = entry
+        for r in state["rentals"].get(user_key, []):
+                if r["number"] == number and r["until"] == until:
+                        return r
+        return None
+
+
+def _live_hold(state: Dict, number: str) -> Optional[Dict]:
+        """Return the unexpired reservation on a number, if any."""
+        hold = state["holds"].get(number)
+        if hold and hold["until"] > datetime.utcnow().strftime(ISO_FORMAT):
+                return hold
+        return None
+
+
+def _claim(state: Dict, item: Optional[Dict], user_id: int) -> bool:
+        """Compare-and-set a number from free to busy for user_id.
+
+        Fails if the number is busy or reserved by another user; the caller's
+        own reservation is consumed.
+        """
+        if item is None:
+                return True
+        if item["status"] != "free":
+                return False
+        hold = _live_hold(state, item["number"])
+        if hold and hold["user_id"] != user_id:
+                return False
+        if state["holds"].pop(item["number"], None) is not None:
+                _log("holds", item["number"], None)
+        _set_number_status(item, "busy")
+        return True
 
 
 def _save_state(state: Dict) -> None:
+        """Mark the resident state dirty; the background writer persists it."""
+        global _dirty_since, _last_change
+        with _lock:
+                now = time.monotonic()
+                if _dirty_since is None:
+                        _dirty_since = now
+                _last_change = now
+                _writer_cond.notify()
+
+
+def _encode_state(state: Dict) -> bytes:
+        """data/state.json contents: the usual JSON, with the number catalogue written as an array of objects."""
+        rest = {key: value for key, value in state.items() if key != "numbers"}
+        text = json.dumps(rest, ensure_ascii=False, indent=2)
+        numbers = state["numbers"]
+        numbers = numbers.to_json() if isinstance(numbers, NumberCatalogue) else json.dumps(numbers, ensure_ascii=False, indent=2)
+        # Splice "numbers" in as the first key of the top-level object
+        return ('{\n  "numbers": ' + numbers + ("," + text[1:] if rest else "\n}")).encode("utf-8")
+
+
+def _write_state_file(payload: bytes, path: Optional[str] = None) -> None:
+        path = path or STATE_FILE
         _ensure_dirs()
-        with open(STATE_FILE, "w", encoding="utf-8") as f:
-                json.dump(state, f, ensure_ascii=False, indent=2)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+                f.write(payload)
+                # On disk before the journal generations it replaces are deleted
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        journal._fsync_dir(path)
+
+
+def _load_cold_payments(state: Dict) -> None:
+        """Merge the snapshot's payment history into state["payments"] (caller holds the lock)."""
+        global _cold_payments
+        if _cold_payments is None:
+                return
+        history = _cold_payments.load()
+        # Payments created or settled since the load are newer than the history
+        history.update(state["payments"])
+        state["payments"] = history
+        _cold_payments = None
+
+
+def _warm_cold_payments() -> None:
+        """Decode the payment history without holding the state lock, then merge it."""
+        cold = _cold_payments
+        if cold is None:
+                return
+        cold.load()
+        with _lock:
+                if _state is not None:
+                        _load_cold_payments(_state)
+
+
+def flush() -> bool:
+        """Write the whole state to disk now (compaction, with the journal on).
+
+        Returns True if anything was written.
+        """
+        global _dirty_since, _compact_now
+        with _flush_lock:
+                started = time.perf_counter()
+                with _lock:
+                        if _dirty_since is None or _state is None:
+                                return False
+                        if _journal is not None:
+                                # Records from here on go to a generation this state file does not contain
+                                _state["journal_generation"] = _journal.rotate()
+                        generation = _state.get("journal_generation", 0)
+                        _compact_now = False
+                        if STATE_FORMAT == "snapshot":
+                                payload = snapshot.encode_state(_state, _pending_payments, _cold_payments)
+                                path = STATE_SNAPSHOT_FILE
+                        else:
+                                _load_cold_payments(_state)
+                                payload = _encode_state(_state)
+                                path = STATE_FILE
+                        _dirty_since = None
+                _write_state_file(payload, path)
+                journal.remove_before(STATE_JOURNAL_FILE, generation)
+                metrics.storage_seconds.observe(time.perf_counter() - started, op="save")
+                metrics.storage_bytes.inc(len(payload), op="save")
+                return True
+
+
+def _writer_loop() -> None:
+        global _compact_now
+        while True:
+                with _lock:
+                        while not _writer_stop:
+                                if _dirty_since is None:
+                                        _writer_cond.wait()
+                                        continue
+                                if _compact_now:
+                                        break
+                                if _journal is not None:
+                                        # Changes are durable in the journal already; compaction only bounds its size
+                                        deadline = _dirty_since + STATE_COMPACT_INTERVAL
+                                else:
+                                        deadline = min(_last_change + STATE_FLUSH_DELAY, _dirty_since + STATE_FLUSH_MAX_DELAY)
+                                remaining = deadline - time.monotonic()
+                                if remaining <= 0:
+                                        break
+                                _writer_cond.wait(remaining)
+                        if _writer_stop:
+                                return
+                try:
+                        flush()
+                except OSError:
+                        # Keep the changes dirty and retry after the debounce delay
+                        with _lock:
+                                _compact_now = True
+                        _save_state(_state)
+                        time.sleep(STATE_FLUSH_DELAY)
+
+
+def start_writer() -> None:
+        """Load the state and start the debounced background writer."""
+        global _writer, _writer_stop
+        _load_state()
+        with _lock:
+                if _writer is not None and _writer.is_alive():
+                        return
+                _writer_stop = False
+                _writer = threading.Thread(target=_writer_loop, name="state-writer", daemon=True)
+                _writer.start()
+        if _cold_payments is not None:
+                # Requests are served meanwhile; only a lookup of an old payment waits for it
+                threading.Thread(target=_warm_cold_payments, name="state-history", daemon=True).start()
+
+
+def close() -> None:
+        """Stop the background writer, flush everything that is still pending and close the journal."""
+        global _writer, _writer_stop, _journal
+        with _lock:
+                _writer_stop = True
+                _writer_cond.notify_all()
+                writer = _writer
+                _writer = None
+        if writer is not None:
+                writer.join()
+        flush()
+        with _lock:
+                closing, _journal = _journal, None
+        if closing is not None:
+                closing.close()
+
 
+atexit.register(flush)
 
-def list_numbers(category: Optional[str] = None) -> List[Dict]:
+
+def journal_position() -> int:
+        """Sequence number of the last journaled change (0 without a journal)."""
+        return _journal.appended if _journal is not None else 0
+
+
+def journal_synced() -> int:
+        """Sequence number of the last journaled change that is on disk."""
+        return _journal.synced if _journal is not None else 0
+
+
+def on_journal_sync(callback: Callable[[int], None]) -> None:
+        """Register a callback fired with journal_synced() after every group commit.
+
+        Callbacks run on the journal thread; they must only schedule work.
+        """
+        _journal_listeners.append(callback)
+
+
+def _synchronized(func: Callable) -> Callable:
+        """Run a storage operation under the state lock so the writer never sees a half-applied change."""
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+                with _lock:
+                        return func(*args, **kwargs)
+        return wrapper
+
+
+@_synchronized
+def list_numbers(category: Optional[str] = None, status: Optional[str] = None) -> List[Dict]:
         state = _load_state()
-        numbers = state["numbers"]
-        if category:
-                return [n for n in numbers if n.get("category") == category]
-        return numbers
+        return state["numbers"].select(category or None, status or None)
+
+
+# Browsing order inside a category: free numbers first, then busy ones
+PAGE_STATUSES: Tuple[str, ...] = ("free", "busy")
+
+
+@_synchronized
+def page_numbers(category: str, limit: int, after: Optional[Cursor] = None,
+                 before: Optional[Cursor] = None, only_free: bool = False) -> Dict:
+        """One page of a category in free-first order, addressed by keyset cursors.
 
+        Pass a previous page's "next" as `after` to go forward or its "prev" as
+        `before` to go back. Returns {"items", "prev", "next"}; prev/next are
+        None at either end. Costs O(log n + limit) wherever the page starts.
+        """
+        numbers = _load_state()["numbers"]
+        statuses = PAGE_STATUSES[:1] if only_free else PAGE_STATUSES
+        # One extra key tells whether anything lies beyond the page
+        if before is not None:
+                keys = _page_keys_before(numbers, category, statuses, before, limit + 1)
+                has_prev, has_next = len(keys) > limit, True
+                keys = keys[:limit][::-1]
+        else:
+                keys = _page_keys_after(numbers, category, statuses, after, limit + 1)
+                has_prev, has_next = after is not None, len(keys) > limit
+                keys = keys[:limit]
+        return {
+                "items": [numbers[p] for _, p in keys],
+                "prev": keys[0] if keys and has_prev else None,
+                "next": keys[-1] if keys and has_next else None,
+        }
+
+
+@_synchronized
+def inventory_counts() -> Dict[Tuple[str, str], int]:
+        """(category, status) -> how many numbers are in it."""
+        return _load_state()["numbers"].counts()
 
+
+def inventory_version() -> int:
+        """Counter that changes whenever a number's status or price changes."""
+        return _inventory_version
+
+
+@_synchronized
 def get_number(number: str) -> Optional[Dict]:
-        for item in list_numbers():
-                if item["number"] == number:
-                        return item
-        return None
+        return _load_state()["numbers"].get(number)
 
 
+@_synchronized
 def set_number_status(number: str, status: str) -> None:
         state = _load_state()
-        for item in state["numbers"]:
-                if item["number"] == number:
-                        item["status"] = status
-                        break
+        item = state["numbers"].get(number)
+        if item:
+                _set_number_status(item, status)
         _save_state(state)
 
 
+@_synchronized
 def add_rental(user_id: int, number: str, months: int) -> Optional[Dict]:
+        """Rent a free number. Returns None if it is busy or reserved by another user."""
         state = _load_state()
-        for item in state["numbers"]:
-                if item["number"] == number:
-                        if item["status"] == "busy":
-                                return None
-                        item["status"] = "busy"
-                        break
+        if not _claim(state, state["numbers"].get(number), user_id):
+                return None
         until = datetime.utcnow() + timedelta(days=30 * months)
         rental = {"number": number, "until": until.strftime(ISO_FORMAT)}
         user_key = str(user_id)
         state["rentals"].setdefault(user_key, [])
         state["rentals"][user_key].append(rental)
+        _log("rentals", user_key, state["rentals"][user_key])
+        _renters[number] = user_key
+        _track_expiry(user_key, rental)
         _save_state(state)
         return rental
 
 
+@_synchronized
 def list_rentals(user_id: int) -> List[Dict]:
         state = _load_state()
         return state["rentals"].get(str(user_id), [])
 
 
+@_synchronized
 def extend_rental(user_id: int, number: str, months: int) -> Optional[Dict]:
         state = _load_state()
         user_key = str(user_id)
@@ -142,88 +750,364 @@ def extend_rental(user_id: int, number: str, months: int) -> Optional[Dict]:
                         until = datetime.strptime(r["until"], ISO_FORMAT)
                         until += timedelta(days=30 * months)
                         r["until"] = until.strftime(ISO_FORMAT)
+                        _log("rentals", user_key, rentals)
+                        _track_expiry(user_key, r)
                         _save_state(state)
                         return r
         return None
 
 
+@_synchronized
+def next_expiry() -> Optional[datetime]:
+        """Return the earliest rental deadline, or None if nothing is rented."""
+        state = _load_state()
+        while _expiry_heap and _live_rental(state, _expiry_heap[0]) is None:
+                heapq.heappop(_expiry_heap)
+        if not _expiry_heap:
+                return None
+        return datetime.strptime(_expiry_heap[0][0], ISO_FORMAT)
+
+
+@_synchronized
 def release_if_expired() -> int:
+        """Release rentals whose deadline has passed. Only due heap entries are visited."""
         state = _load_state()
-        now = datetime.utcnow()
-        released_count = 0
-        num_index = {n["number"]: n for n in state["numbers"]}
-        for user_key, rentals in list(state["rentals"].items()):
-                remaining: List[Dict] = []
-                for r in rentals:
-                        until = datetime.strptime(r["until"], ISO_FORMAT)
-                        if until <= now:
-                                released_count += 1
-                                num_index.get(r["number"], {"status": "busy"})["status"] = "free"
-                        else:
-                                remaining.append(r)
-                state["rentals"][user_key] = remaining
+        now = datetime.utcnow().strftime(ISO_FORMAT)
+        released = []
+        while _expiry_heap and _expiry_heap[0][0] <= now:
+                entry = heapq.heappop(_expiry_heap)
+                rental = _live_rental(state, entry)
+                if rental is None:
+                        continue
+                _remove_rental(state, entry[2], rental)
+                released.append(rental["number"])
+        if not released:
+                return 0
+        for number in released:
+                item = state["numbers"].get(number)
+                if item:
+                        _set_number_status(item, "free")
         _save_state(state)
-        return released_count
+        return len(released)
+
+
+# Reservations
+
+@_synchronized
+def hold_number(number: str, payment_id: str, user_id: int, ttl: int) -> bool:
+        """Reserve a free number for ttl seconds while its invoice is open.
+
+        Succeeds if the number is free and not reserved by another user; a
+        user's own earlier reservation is replaced.
+        """
+        state = _load_state()
+        item = state["numbers"].get(number)
+        if item is None or item["status"] != "free":
+                return False
+        hold = _live_hold(state, number)
+        if hold and hold["user_id"] != user_id:
+                return False
+        until = (datetime.utcnow() + timedelta(seconds=ttl)).strftime(ISO_FORMAT)
+        state["holds"][number] = {"payment_id": payment_id, "user_id": user_id, "until": until}
+        _log("holds", number, state["holds"][number])
+        heapq.heappush(_hold_heap, (until, number, payment_id))
+        _notify_expiry_change()
+        _save_state(state)
+        return True
+
+
+@_synchronized
+def get_hold(number: str) -> Optional[Dict]:
+        """Return the unexpired reservation on a number, if any."""
+        return _live_hold(_load_state(), number)
+
+
+@_synchronized
+def release_hold(number: str, payment_id: str) -> bool:
+        """Drop a reservation if it still belongs to payment_id."""
+        state = _load_state()
+        hold = state["holds"].get(number)
+        if not hold or hold["payment_id"] != payment_id:
+                return False
+        del state["holds"][number]
+        _log("holds", number, None)
+        _save_state(state)
+        return True
+
+
+@_synchronized
+def claim_number(number: str, user_id: int) -> bool:
+        """Mark a number sold to user_id. Fails if it is busy or reserved by another user."""
+        state = _load_state()
+        item = state["numbers"].get(number)
+        if item is None or not _claim(state, item, user_id):
+                return False
+        _save_state(state)
+        return True
+
+
+def _hold_entry_live(state: Dict, entry: Tuple[str, str, str]) -> bool:
+        hold = state["holds"].get(entry[1])
+        return bool(hold) and hold["payment_id"] == entry[2] and hold["until"] == entry[0]
+
+
+@_synchronized
+def next_hold_expiry() -> Optional[datetime]:
+        """Return the earliest reservation deadline, or None if nothing is reserved."""
+        state = _load_state()
+        while _hold_heap and not _hold_entry_live(state, _hold_heap[0]):
+                heapq.heappop(_hold_heap)
+        if not _hold_heap:
+                return None
+        return datetime.strptime(_hold_heap[0][0], ISO_FORMAT)
+
+
+@_synchronized
+def release_expired_holds() -> int:
+        """Drop reservations whose deadline has passed. Only due heap entries are visited."""
+        state = _load_state()
+        now = datetime.utcnow().strftime(ISO_FORMAT)
+        released = 0
+        while _hold_heap and _hold_heap[0][0] <= now:
+                entry = heapq.heappop(_hold_heap)
+                if _hold_entry_live(state, entry):
+                        del state["holds"][entry[1]]
+                        _log("holds", entry[1], None)
+                        released += 1
+        if released:
+                _save_state(state)
+        return released
 
 # Payments
 
+@_synchronized
 def create_pending_payment(payment_id: str, payload: Dict) -> None:
         state = _load_state()
         state["payments"][payment_id] = payload
+        _log("payments", payment_id, payload)
+        if payload.get("status") == "pending":
+                _pending_payments[payment_id] = payload
         _save_state(state)
 
 
-def get_payment(payment_id: str) -> Optional[Dict]:
+@_synchronized
+def _hot_payment(payment_id: str) -> Optional[Dict]:
         state = _load_state()
-        return state["payments"].get(payment_id)
+        payment = state["payments"].get(payment_id)
+        if payment is None and _cold_payments is not None:
+                _load_cold_payments(state)
+                payment = state["payments"].get(payment_id)
+        return payment
+
+
+def get_payment(payment_id: str) -> Optional[Dict]:
+        payment = _hot_payment(payment_id)
+        if payment is None:
+                # Old settled payments live in the archive (see archive_payments). It is
+                # written before the hot copy is dropped, and read outside _lock
+                return archive.get_payment(payment_id)
+        return payment
+
+
+@_synchronized
+def list_pending_payments() -> Dict[str, Dict]:
+        """Return payment_id -> payment for every payment still waiting for its invoice."""
+        _load_state()
+        return dict(_pending_payments)
+
 
+@_synchronized
+def pending_payment_count() -> int:
+        _load_state()
+        return len(_pending_payments)
 
-def set_payment_status(payment_id: str, status: str, invoice_id: int = None) -> None:
+
+@_synchronized
+def set_payment_status(payment_id: str, status: str, invoice_id: int = None, expected_status: Optional[str] = None) -> bool:
+        """Update a payment's status. With expected_status, only if the current status matches (compare-and-set)."""
         state = _load_state()
         p = state["payments"].get(payment_id)
+        if not p and _cold_payments is not None:
+                _load_cold_payments(state)
+                p = state["payments"].get(payment_id)
         if not p:
-                return
+                return False
+        if expected_status is not None and p.get("status") != expected_status:
+                return False
         p["status"] = status
         if invoice_id is not None:
                 p["invoice_id"] = invoice_id
+        _log("payments", payment_id, p)
+        if status == "pending":
+                _pending_payments[payment_id] = p
+        else:
+                _pending_payments.pop(payment_id, None)
         _save_state(state)
+        return True
+
+
+def archive_payments(before: datetime, limit: int = 1000) -> int:
+        """Move up to limit settled payments created before `before` to the archive.
+
+        Pending payments are never archived. Returns how many were moved; the
+        archive is durable before they leave the hot state. Compressing and
+        syncing the archive happens without the state lock, so the bot keeps
+        serving meanwhile.
+        """
+        _load_state()
+        # A cold payment history is decoded outside the state lock first
+        _warm_cold_payments()
+        with _archive_lock:
+                batch = _archivable_payments(before, limit)
+                if not batch:
+                        return 0
+                archive.append_payments(batch)
+                return _drop_archived(batch)
+
+
+@_synchronized
+def _archivable_payments(before: datetime, limit: int) -> List[Tuple[str, Dict]]:
+        """Copies of up to limit settled payments created before `before`."""
+        state = _load_state()
+        _load_cold_payments(state)
+        batch = []
+        for payment_id, p in state["payments"].items():
+                if p.get("status") == "pending":
+                        continue
+                created = archive.payment_time(payment_id, p)
+                # Payments from before creation times were recorded are archived too
+                if created is None or created < before:
+                        batch.append((payment_id, dict(p)))
+                        if len(batch) >= limit:
+                                break
+        return batch
+
+
+@_synchronized
+def _drop_archived(batch: List[Tuple[str, Dict]]) -> int:
+        """Remove archived payments from the hot state, except ones changed since they were copied."""
+        state = _load_state()
+        dropped = 0
+        for payment_id, archived in batch:
+                # A payment updated meanwhile stays hot; its newer copy wins over the archived one
+                if state["payments"].get(payment_id) != archived:
+                        continue
+                del state["payments"][payment_id]
+                _log("payments", payment_id, None)
+                dropped += 1
+        if dropped:
+                _save_state(state)
+        return dropped
+
+
+# Bulk inventory (see bot/inventory.py)
+
+@_synchronized
+def upsert_numbers(records: List[Dict]) -> Dict[str, int]:
+        """Apply one batch of validated inventory records with a single save.
+
+        Unknown numbers are added; known ones take the record's category, type
+        and price but keep their live status. Status "retired" takes a number
+        off sale unless it is rented or reserved, and importing a retired
+        number again puts it back. Returns counts per outcome.
+        """
+        state = _load_state()
+        counts = {"added": 0, "updated": 0, "retired": 0, "unchanged": 0, "in_use": 0}
+        for rec in records:
+                number = rec["number"]
+                item = state["numbers"].get(number)
+                if item is None:
+                        _log_number(state["numbers"].append(rec))
+                        _bump_inventory_version()
+                        counts["added"] += 1
+                        continue
+                if rec["status"] == "retired":
+                        if item["status"] == "retired":
+                                counts["unchanged"] += 1
+                        elif number in _renters or _live_hold(state, number):
+                                counts["in_use"] += 1
+                        else:
+                                _set_number_status(item, "retired")
+                                counts["retired"] += 1
+                        continue
+                changed = False
+                if item["status"] == "retired":
+                        _set_number_status(item, rec["status"])
+                        changed = True
+                if item.get("category") != rec["category"]:
+                        item["category"] = rec["category"]
+                        changed = True
+                for field in ("type", "price"):
+                        if item.get(field) != rec[field]:
+                                item[field] = rec[field]
+                                changed = True
+                if changed:
+                        _log_number(item)
+                        _bump_inventory_version()
+                        counts["updated"] += 1
+                else:
+                        counts["unchanged"] += 1
+        if counts["added"] or counts["updated"] or counts["retired"]:
+                _save_state(state)
+        return counts
+
+
+@_synchronized
+def scan_numbers(after: int = -1, limit: int = 1000) -> Tuple[List[Dict], Optional[int]]:
+        """Up to limit numbers in catalogue order following cursor `after`.
+
+        Returns (records, cursor); pass the cursor back for the next chunk, it
+        is None once the catalogue is exhausted. Records are copies, so a
+        caller can stream them out without holding the storage lock.
+        """
+        state = _load_state()
+        chunk = state["numbers"][after + 1:after + 1 + limit]
+        cursor = after + len(chunk) if after + 1 + limit < len(state["numbers"]) else None
+        return [dict(item) for item in chunk], cursor
+
 
 # Admin/owner operations
 
+@_synchronized
 def force_rental(user_id: int, number: str, months: int) -> Optional[Dict]:
         """Force-assign a number to a user. Replaces any existing holder and marks number busy."""
         state = _load_state()
         # Ensure number exists
-        n_item = None
-        for item in state["numbers"]:
-                if item["number"] == number:
-                        n_item = item
-                        break
+        n_item = state["numbers"].get(number)
         if not n_item:
                 return None
-        # Remove existing rentals for this number across all users
-        for ukey, rentals in list(state["rentals"].items()):
-                state["rentals"][ukey] = [r for r in rentals if r.get("number") != number]
-        # Mark busy
-        n_item["status"] = "busy"
+        # Remove the current holder's rentals for this number
+        holder = _renters.get(number)
+        if holder is not None:
+                state["rentals"][holder] = [r for r in state["rentals"][holder] if r.get("number") != number]
+                _log("rentals", holder, state["rentals"][holder])
+        # Mark busy, overriding any reservation
+        if state["holds"].pop(number, None) is not None:
+                _log("holds", number, None)
+        _set_number_status(n_item, "busy")
         # Add rental to target user
         until = datetime.utcnow() + timedelta(days=30 * months)
         rental = {"number": number, "until": until.strftime(ISO_FORMAT)}
         user_key = str(user_id)
         state["rentals"].setdefault(user_key, [])
         state["rentals"][user_key].append(rental)
+        _log("rentals", user_key, state["rentals"][user_key])
+        _renters[number] = user_key
+        _track_expiry(user_key, rental)
         _save_state(state)
         return rental
 
 
 # Promocodes
 
+@_synchronized
 def list_promocodes() -> List[Dict]:
         """Get all promocodes."""
         state = _load_state()
         return state.get("promocodes", [])
 
 
+@_synchronized
 def add_promocode(code: str, percent: int, created_by: int) -> Optional[Dict]:
         """Add new promocode. Returns None if code already exists or percent invalid."""
         if not (1 <= percent <= 100):
@@ -233,9 +1117,8 @@ def add_promocode(code: str, percent: int, created_by: int) -> Optional[Dict]:
         code_upper = code.upper()
         
         # Check if code already exists
-        for promo in state["promocodes"]:
-                if promo["code"].upper() == code_upper:
-                        return None
+        if code_upper in _promocodes_by_code:
+                return None
         
         promocode = {
                 "code": code_upper,
@@ -245,36 +1128,38 @@ def add_promocode(code: str, percent: int, created_by: int) -> Optional[Dict]:
                 "created_by": created_by,
         }
         state["promocodes"].append(promocode)
+        _log("promocodes", code_upper, promocode)
+        _promocodes_by_code[code_upper] = promocode
         _save_state(state)
         return promocode
 
 
+@_synchronized
 def get_promocode(code: str) -> Optional[Dict]:
         """Get promocode by code (case-insensitive). Returns None if not found or inactive."""
-        state = _load_state()
-        code_upper = code.upper()
-        for promo in state["promocodes"]:
-                if promo["code"].upper() == code_upper:
-                        if promo.get("active", True):
-                                return promo
-                        return None
+        _load_state()
+        promo = _promocodes_by_code.get(code.upper())
+        if promo and promo.get("active", True):
+                return promo
         return None
 
 
+@_synchronized
 def deactivate_promocode(code: str) -> bool:
         """Deactivate promocode. Returns True if successful."""
         state = _load_state()
-        code_upper = code.upper()
-        for promo in state["promocodes"]:
-                if promo["code"].upper() == code_upper:
-                        promo["active"] = False
-                        _save_state(state)
-                        return True
-        return False
+        promo = _promocodes_by_code.get(code.upper())
+        if not promo:
+                return False
+        promo["active"] = False
+        _log("promocodes", promo["code"], promo)
+        _save_state(state)
+        return True
 
 
 # Users
 
+@_synchronized
 def register_user(user_id: int, username: str = None) -> Dict:
         """Register or update user. Returns user data."""
         state = _load_state()
@@ -293,12 +1178,94 @@ def register_user(user_id: int, username: str = None) -> Dict:
                         "first_seen": now,
                         "last_seen": now,
                 }
+        _log("users", user_key, state["users"][user_key])
         
         _save_state(state)
         return state["users"][user_key]
 
 
+@_synchronized
 def get_user(user_id: int) -> Optional[Dict]:
         """Get user data."""
         state = _load_state()
         return state["users"].get(str(user_id))
+
+
+# JSON interchange (python -m bot.snapshot export|import)
+
+def _saved_state_file() -> str:
+        """The file the journal applies to: the snapshot, or data/state.json without one."""
+        return STATE_SNAPSHOT_FILE if STATE_FORMAT == "snapshot" and os.path.exists(STATE_SNAPSHOT_FILE) else STATE_FILE
+
+
+def _read_saved_state() -> Dict:
+        """The last saved state with the journal replayed on top, read from the files.
+
+        Reads the files, not the resident state, so it can run next to the bot.
+        """
+        state, _ = _read_state_file(_saved_state_file())
+        if not isinstance(state["numbers"], NumberCatalogue):
+                state["numbers"] = NumberCatalogue(state["numbers"])
+        # Changes since the last compaction are in the journal only
+        _replay_journal(state)
+        return state
+
+
+def export_json(path: str) -> int:
+        """Write the last saved state to path as state.json-style JSON. Returns the number count."""
+        state = _read_saved_state()
+        # The export carries no journal position
+        state.pop("journal_generation", None)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+                f.write(_encode_state(state))
+        os.replace(tmp_path, path)
+        return len(state["numbers"])
+
+
+def import_json(path: str) -> int:
+        """Replace the snapshot with the state in a JSON file. Returns the number count.
+
+        Holds the state lock file, so it refuses to run while the bot is up.
+        """
+        _lock_state_file()
+        state, _ = _read_state_file(path)
+        state["numbers"] = NumberCatalogue(state["numbers"])
+        # The imported state replaces whatever the journal still holds
+        generations = journal.generations(STATE_JOURNAL_FILE)
+        state["journal_generation"] = generations[-1][0] + 1 if generations else 0
+        pending = {payment_id: p for payment_id, p in state["payments"].items() if p.get("status") == "pending"}
+        _write_state_file(snapshot.encode_state(state, pending), STATE_SNAPSHOT_FILE)
+        journal.remove_before(STATE_JOURNAL_FILE, state["journal_generation"])
+        return len(state["numbers"])
+
+
+# Leases (leader election; trivial here, since the JSON state has one process)
+
+@_synchronized
+def acquire_lease(name: str, owner: str, ttl: float) -> bool:
+        """Take or renew the lease `name` for ttl seconds. Fails while another owner holds it."""
+        now = time.time()
+        current = _leases.get(name)
+        if current is not None and current[0] != owner and current[1] > now:
+                return False
+        _leases[name] = (owner, now + ttl)
+        return True
+
+
+@_synchronized
+def release_lease(name: str, owner: str) -> bool:
+        if _leases.get(name, ("", 0))[0] != owner:
+                return False
+        del _leases[name]
+        return True
+
+
+if STORAGE_BACKEND == "sqlite":
+        from .storage_sqlite import *  # noqa: E402,F401,F403
+elif STORAGE_BACKEND != "json":
+        raise RuntimeError(f"Unknown STORAGE_BACKEND '{STORAGE_BACKEND}'. Use 'json' or 'sqlite'.")
+if STATE_FORMAT not in ("snapshot", "json"):
+        raise RuntimeError(f"Unknown STATE_FORMAT '{STATE_FORMAT}'. Use 'snapshot' or 'json'.")
+if STATE_JOURNAL not in ("fsync", "off"):
+        raise RuntimeError(f"Unknown STATE_JOURNAL '{STATE_JOURNAL}'. Use 'fsync' or 'off'.")
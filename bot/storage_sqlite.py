@@ -0,0 +1,874 @@
+"""SQLite storage backend.
+
+Exposes the same functions as :mod:`bot.storage` and is selected with
+``STORAGE_BACKEND=sqlite``. Every entity lives in its own indexed table, so
+lookups are index seeks and mutations only touch the affected rows.
+
+One-shot import of an existing JSON state::
+
+        python -m bot.storage_sqlite import [data/state.json]
+"""
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import wraps
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from . import archive
+from .data import SEEDED_NUMBERS
+from .storage import (
+        DATA_DIR, ISO_FORMAT, PAGE_STATUSES, STATE_FILE, STATE_JOURNAL_FILE, STATE_SNAPSHOT_FILE, Cursor, _notify_expiry_change,
+        _read_saved_state, _read_state_file, _saved_state_file,
+)
+from . import journal
+
+__all__ = [
+        "list_numbers", "page_numbers", "get_number", "set_number_status", "inventory_version", "inventory_counts",
+        "add_rental", "list_rentals", "extend_rental", "next_expiry", "release_if_expired",
+        "create_pending_payment", "get_payment", "list_pending_payments", "pending_payment_count", "set_payment_status",
+        "archive_payments",
+        "hold_number", "get_hold", "release_hold", "claim_number", "next_hold_expiry", "release_expired_holds",
+        "force_rental", "upsert_numbers", "scan_numbers",
+        "list_promocodes", "add_promocode", "get_promocode", "deactivate_promocode",
+        "register_user", "get_user",
+        "acquire_lease", "release_lease",
+        "load_session", "save_session", "purge_sessions",
+        "start_writer", "flush", "close",
+]
+
+SQLITE_FILE = os.path.abspath(os.getenv("STORAGE_SQLITE_PATH", os.path.join(DATA_DIR, "state.db")))
+# Seconds a write waits for another process to release the database lock
+SQLITE_BUSY_TIMEOUT = float(os.getenv("SQLITE_BUSY_TIMEOUT", "30"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS numbers (
+        number TEXT PRIMARY KEY,
+        status TEXT NOT NULL DEFAULT 'free',
+        category TEXT,
+        type TEXT,
+        price NUMERIC
+);
+CREATE INDEX IF NOT EXISTS idx_numbers_category_status ON numbers (category, status);
+
+CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('inventory_version', 0);
+
+CREATE TABLE IF NOT EXISTS rentals (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        number TEXT NOT NULL,
+        until TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_rentals_user ON rentals (user_id);
+CREATE INDEX IF NOT EXISTS idx_rentals_number ON rentals (number);
+CREATE INDEX IF NOT EXISTS idx_rentals_until ON rentals (until);
+
+CREATE TABLE IF NOT EXISTS payments (
+        payment_id TEXT PRIMARY KEY,
+        user_id INTEGER,
+        number TEXT,
+        status TEXT,
+        invoice_id INTEGER,
+        data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_payments_status ON payments (status);
+CREATE INDEX IF NOT EXISTS idx_payments_user ON payments (user_id);
+
+CREATE TABLE IF NOT EXISTS holds (
+        number TEXT PRIMARY KEY,
+        payment_id TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        until TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_holds_until ON holds (until);
+
+CREATE TABLE IF NOT EXISTS promocodes (
+        code TEXT PRIMARY KEY,
+        percent INTEGER NOT NULL,
+        active INTEGER NOT NULL DEFAULT 1,
+        created_at TEXT,
+        created_by INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        first_seen TEXT,
+        last_seen TEXT
+);
+
+CREATE TABLE IF NOT EXISTS leases (
+        name TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        expires REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS checkout_sessions (
+        key TEXT PRIMARY KEY,
+        state TEXT,
+        data TEXT NOT NULL,
+        expires REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_checkout_sessions_expires ON checkout_sessions (expires);
+"""
+
+_lock = threading.RLock()
+_conn: Optional[sqlite3.Connection] = None
+# One archiving pass per process at a time (the leader runs it, see bot/cluster.py)
+_archive_lock = threading.Lock()
+
+
+def _connect() -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(SQLITE_FILE), exist_ok=True)
+        conn = sqlite3.connect(SQLITE_FILE, timeout=SQLITE_BUSY_TIMEOUT, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        return conn
+
+
+def _db() -> sqlite3.Connection:
+        """Return the shared connection, creating and filling the database on first use."""
+        global _conn
+        if _conn is None:
+                with _lock:
+                        if _conn is None:
+                                conn = _connect()
+                                # Checked under the write lock, so processes starting together fill it once
+                                with _transaction(conn):
+                                        if conn.execute("SELECT 1 FROM numbers LIMIT 1").fetchone() is None:
+                                                # Fresh database: take over an existing JSON backend state (snapshot first,
+                                                # plus its journal) or seed
+                                                if (os.path.exists(STATE_SNAPSHOT_FILE) or os.path.exists(STATE_FILE)
+                                                                or journal.generations(STATE_JOURNAL_FILE)):
+                                                        _import_into(conn, _read_saved_state())
+                                                else:
+                                                        _insert_numbers(conn, SEEDED_NUMBERS)
+                                _conn = conn
+        return _conn
+
+
+@contextmanager
+def _transaction(conn: sqlite3.Connection) -> Iterator[sqlite3.Connection]:
+        """Write transaction that takes the database lock before its first read.
+
+        Several bot processes may share the file: with a deferred transaction
+        two of them could both read a number as free and both claim it.
+        """
+        conn.execute("BEGIN IMMEDIATE")
+        with conn:
+                yield conn
+
+
+def _synchronized(func: Callable) -> Callable:
+        """Serialize access to the shared connection."""
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+                with _lock:
+                        return func(*args, **kwargs)
+        return wrapper
+
+
+def _number_row(row: sqlite3.Row) -> Dict:
+        return {
+                "number": row["number"],
+                "status": row["status"],
+                "category": row["category"],
+                "type": row["type"],
+                "price": row["price"],
+        }
+
+
+def _rental_row(row: sqlite3.Row) -> Dict:
+        return {"number": row["number"], "until": row["until"]}
+
+
+def _payment_row(row: sqlite3.Row) -> Dict:
+        payment = json.loads(row["data"])
+        payment["status"] = row["status"]
+        if row["invoice_id"] is not None:
+                payment["invoice_id"] = row["invoice_id"]
+        return payment
+
+
+def _promocode_row(row: sqlite3.Row) -> Dict:
+        return {
+                "code": row["code"],
+                "percent": row["percent"],
+                "active": bool(row["active"]),
+                "created_at": row["created_at"],
+                "created_by": row["created_by"],
+        }
+
+
+def _user_row(row: sqlite3.Row) -> Dict:
+        return {
+                "username": row["username"],
+                "first_seen": row["first_seen"],
+                "last_seen": row["last_seen"],
+        }
+
+
+def _insert_numbers(conn: sqlite3.Connection, numbers: List[Dict]) -> None:
+        conn.executemany(
+                "INSERT OR REPLACE INTO numbers (number, status, category, type, price) VALUES (?, ?, ?, ?, ?)",
+                [(n["number"], n.get("status", "free"), n.get("category"), n.get("type"), n.get("price")) for n in numbers],
+        )
+
+
+def _insert_payment(conn: sqlite3.Connection, payment_id: str, payload: Dict) -> None:
+        conn.execute(
+                "INSERT OR REPLACE INTO payments (payment_id, user_id, number, status, invoice_id, data) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                        payment_id,
+                        payload.get("user_id"),
+                        payload.get("number"),
+                        payload.get("status"),
+                        payload.get("invoice_id"),
+                        json.dumps(payload, ensure_ascii=False),
+                ),
+        )
+
+
+def _bump_inventory_version(conn: sqlite3.Connection) -> None:
+        conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'inventory_version'")
+
+
+def _now() -> str:
+        return datetime.utcnow().strftime(ISO_FORMAT)
+
+
+def _live_hold(conn: sqlite3.Connection, number: str) -> Optional[sqlite3.Row]:
+        return conn.execute("SELECT * FROM holds WHERE number = ? AND until > ?", (number, _now())).fetchone()
+
+
+def _claim(conn: sqlite3.Connection, number: str, user_id: int) -> bool:
+        """Compare-and-set a number from free to busy for user_id, consuming the caller's own reservation."""
+        row = conn.execute("SELECT status FROM numbers WHERE number = ?", (number,)).fetchone()
+        if row is None:
+                return True
+        if row["status"] != "free":
+                return False
+        hold = _live_hold(conn, number)
+        if hold and hold["user_id"] != int(user_id):
+                return False
+        conn.execute("DELETE FROM holds WHERE number = ?", (number,))
+        conn.execute("UPDATE numbers SET status = 'busy' WHERE number = ?", (number,))
+        _bump_inventory_version(conn)
+        return True
+
+
+def _new_rental(conn: sqlite3.Connection, user_id: int, number: str, months: int) -> Dict:
+        until = (datetime.utcnow() + timedelta(days=30 * months)).strftime(ISO_FORMAT)
+        conn.execute("INSERT INTO rentals (user_id, number, until) VALUES (?, ?, ?)", (int(user_id), number, until))
+        return {"number": number, "until": until}
+
+
+# Import
+
+def _read_json_state(path: Optional[str] = None) -> Dict:
+        """Read a JSON backend state file (JSON or snapshot), applying the same migrations as the JSON backend.
+
+        Without a path, or given the file the JSON backend's journal applies to,
+        the journal is replayed on top, so writes since its last compaction are kept.
+        """
+        if path is None or os.path.abspath(path) == _saved_state_file():
+                return _read_saved_state()
+        state, _ = _read_state_file(os.path.abspath(path))
+        return state
+
+
+def _import_into(conn: sqlite3.Connection, state: Dict) -> Dict[str, int]:
+        """Replace every table with the contents of state; the caller holds the transaction."""
+        for table in ("numbers", "rentals", "holds", "payments", "promocodes", "users"):
+                conn.execute(f"DELETE FROM {table}")
+        _insert_numbers(conn, state.get("numbers", []))
+        _bump_inventory_version(conn)
+        rentals = [
+                (int(user_key), r["number"], r["until"])
+                for user_key, items in state.get("rentals", {}).items()
+                for r in items
+        ]
+        conn.executemany("INSERT INTO rentals (user_id, number, until) VALUES (?, ?, ?)", rentals)
+        conn.executemany(
+                "INSERT INTO holds (number, payment_id, user_id, until) VALUES (?, ?, ?, ?)",
+                [(number, h["payment_id"], int(h["user_id"]), h["until"]) for number, h in state.get("holds", {}).items()],
+        )
+        for payment_id, payload in state.get("payments", {}).items():
+                _insert_payment(conn, payment_id, payload)
+        conn.executemany(
+                "INSERT OR IGNORE INTO promocodes (code, percent, active, created_at, created_by) VALUES (?, ?, ?, ?, ?)",
+                [
+                        (p["code"].upper(), p["percent"], int(p.get("active", True)), p.get("created_at"), p.get("created_by"))
+                        for p in state.get("promocodes", [])
+                ],
+        )
+        conn.executemany(
+                "INSERT INTO users (user_id, username, first_seen, last_seen) VALUES (?, ?, ?, ?)",
+                [
+                        (int(user_key), u.get("username"), u.get("first_seen"), u.get("last_seen"))
+                        for user_key, u in state.get("users", {}).items()
+                ],
+        )
+        return {
+                "numbers": len(state.get("numbers", [])),
+                "rentals": len(rentals),
+                "payments": len(state.get("payments", {})),
+                "promocodes": len(state.get("promocodes", [])),
+                "users": len(state.get("users", {})),
+        }
+
+
+@_synchronized
+def import_state(path: Optional[str] = None) -> Dict[str, int]:
+        """Replace the database contents with a JSON state file (the JSON backend's own state by default).
+
+        Returns row counts per table.
+        """
+        state = _read_json_state(path)
+        conn = _db()
+        with _transaction(conn):
+                return _import_into(conn, state)
+
+
+# Lifecycle (rows are committed per operation, so there is nothing to write behind)
+
+def start_writer() -> None:
+        _db()
+
+
+def flush() -> bool:
+        return False
+
+
+@_synchronized
+def close() -> None:
+        global _conn
+        if _conn is not None:
+                _conn.close()
+                _conn = None
+
+
+# Numbers
+
+@_synchronized
+def list_numbers(category: Optional[str] = None, status: Optional[str] = None) -> List[Dict]:
+        clauses, params = [], []
+        if category:
+                clauses.append("category = ?")
+                params.append(category)
+        if status:
+                clauses.append("status = ?")
+                params.append(status)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        rows = _db().execute(f"SELECT * FROM numbers{where} ORDER BY rowid", params)
+        return [_number_row(r) for r in rows]
+
+
+@_synchronized
+def page_numbers(category: str, limit: int, after: Optional[Cursor] = None,
+                 before: Optional[Cursor] = None, only_free: bool = False) -> Dict:
+        """See storage.page_numbers. Cursor positions are rowids, so every status
+        bucket is one range scan over idx_numbers_category_status."""
+        conn = _db()
+        statuses = PAGE_STATUSES[:1] if only_free else PAGE_STATUSES
+        forward = before is None
+        if forward:
+                rank, rowid = after if after is not None else (0, -1)
+                ranks = range(rank, len(statuses))
+        else:
+                rank, rowid = before
+                ranks = range(min(rank, len(statuses) - 1), -1, -1)
+        op, order = (">", "ASC") if forward else ("<", "DESC")
+        # One extra row tells whether anything lies beyond the page
+        found = []
+        for r in ranks:
+                bound = f" AND rowid {op} ?" if r == rank else ""
+                params = [category, statuses[r]] + ([rowid] if r == rank else []) + [limit + 1 - len(found)]
+                rows = conn.execute(
+                        f"SELECT rowid AS pos, * FROM numbers WHERE category = ? AND status = ?{bound} ORDER BY rowid {order} LIMIT ?",
+                        params,
+                )
+                found.extend(((r, row["pos"]), row) for row in rows)
+                if len(found) > limit:
+                        break
+        if forward:
+                has_prev, has_next = after is not None, len(found) > limit
+                found = found[:limit]
+        else:
+                has_prev, has_next = len(found) > limit, True
+                found = found[:limit][::-1]
+        return {
+                "items": [_number_row(row) for _, row in found],
+                "prev": found[0][0] if found and has_prev else None,
+                "next": found[-1][0] if found and has_next else None,
+        }
+
+
+@_synchronized
+def get_number(number: str) -> Optional[Dict]:
+        row = _db().execute("SELECT * FROM numbers WHERE number = ?", (number,)).fetchone()
+        return _number_row(row) if row else None
+
+
+@_synchronized
+def set_number_status(number: str, status: str) -> None:
+        conn = _db()
+        with _transaction(conn):
+                cur = conn.execute("UPDATE numbers SET status = ? WHERE number = ? AND status != ?", (status, number, status))
+                if cur.rowcount:
+                        _bump_inventory_version(conn)
+
+
+@_synchronized
+def inventory_counts() -> Dict[Tuple[str, str], int]:
+        """(category, status) -> how many numbers are in it."""
+        rows = _db().execute("SELECT category, status, COUNT(*) AS n FROM numbers GROUP BY category, status")
+        return {(r["category"], r["status"]): r["n"] for r in rows}
+
+
+@_synchronized
+def inventory_version() -> int:
+        """Counter that changes whenever a number's status or price changes."""
+        return _db().execute("SELECT value FROM meta WHERE key = 'inventory_version'").fetchone()["value"]
+
+
+# Rentals
+
+@_synchronized
+def add_rental(user_id: int, number: str, months: int) -> Optional[Dict]:
+        """Rent a free number. Returns None if it is busy or reserved by another user."""
+        conn = _db()
+        with _transaction(conn):
+                if not _claim(conn, number, user_id):
+                        return None
+                rental = _new_rental(conn, user_id, number, months)
+        _notify_expiry_change()
+        return rental
+
+
+@_synchronized
+def list_rentals(user_id: int) -> List[Dict]:
+        rows = _db().execute("SELECT number, until FROM rentals WHERE user_id = ? ORDER BY id", (int(user_id),))
+        return [_rental_row(r) for r in rows]
+
+
+@_synchronized
+def extend_rental(user_id: int, number: str, months: int) -> Optional[Dict]:
+        conn = _db()
+        with _transaction(conn):
+                row = conn.execute(
+                        "SELECT id, number, until FROM rentals WHERE user_id = ? AND number = ? ORDER BY id LIMIT 1",
+                        (int(user_id), number),
+                ).fetchone()
+                if not row:
+                        return None
+                until = datetime.strptime(row["until"], ISO_FORMAT) + timedelta(days=30 * months)
+                until_str = until.strftime(ISO_FORMAT)
+                conn.execute("UPDATE rentals SET until = ? WHERE id = ?", (until_str, row["id"]))
+        _notify_expiry_change()
+        return {"number": row["number"], "until": until_str}
+
+
+@_synchronized
+def next_expiry() -> Optional[datetime]:
+        """Return the earliest rental deadline, or None if nothing is rented."""
+        row = _db().execute("SELECT MIN(until) AS until FROM rentals").fetchone()
+        if row["until"] is None:
+                return None
+        return datetime.strptime(row["until"], ISO_FORMAT)
+
+
+@_synchronized
+def release_if_expired() -> int:
+        conn = _db()
+        now = _now()
+        with _transaction(conn):
+                expired = conn.execute("SELECT id, number FROM rentals WHERE until <= ?", (now,)).fetchall()
+                if not expired:
+                        return 0
+                conn.executemany("DELETE FROM rentals WHERE id = ?", [(r["id"],) for r in expired])
+                conn.executemany("UPDATE numbers SET status = 'free' WHERE number = ?", [(r["number"],) for r in expired])
+                _bump_inventory_version(conn)
+        return len(expired)
+
+
+# Reservations
+
+@_synchronized
+def hold_number(number: str, payment_id: str, user_id: int, ttl: int) -> bool:
+        """Reserve a free number for ttl seconds while its invoice is open."""
+        conn = _db()
+        with _transaction(conn):
+                row = conn.execute("SELECT status FROM numbers WHERE number = ?", (number,)).fetchone()
+                if row is None or row["status"] != "free":
+                        return False
+                hold = _live_hold(conn, number)
+                if hold and hold["user_id"] != int(user_id):
+                        return False
+                until = (datetime.utcnow() + timedelta(seconds=ttl)).strftime(ISO_FORMAT)
+                conn.execute(
+                        "INSERT OR REPLACE INTO holds (number, payment_id, user_id, until) VALUES (?, ?, ?, ?)",
+                        (number, payment_id, int(user_id), until),
+                )
+        _notify_expiry_change()
+        return True
+
+
+@_synchronized
+def get_hold(number: str) -> Optional[Dict]:
+        """Return the unexpired reservation on a number, if any."""
+        row = _live_hold(_db(), number)
+        if not row:
+                return None
+        return {"payment_id": row["payment_id"], "user_id": row["user_id"], "until": row["until"]}
+
+
+@_synchronized
+def release_hold(number: str, payment_id: str) -> bool:
+        """Drop a reservation if it still belongs to payment_id."""
+        conn = _db()
+        with _transaction(conn):
+                cur = conn.execute("DELETE FROM holds WHERE number = ? AND payment_id = ?", (number, payment_id))
+        return cur.rowcount > 0
+
+
+@_synchronized
+def claim_number(number: str, user_id: int) -> bool:
+        """Mark a number sold to user_id. Fails if it is busy or reserved by another user."""
+        conn = _db()
+        with _transaction(conn):
+                if conn.execute("SELECT 1 FROM numbers WHERE number = ?", (number,)).fetchone() is None:
+                        return False
+                return _claim(conn, number, user_id)
+
+
+@_synchronized
+def next_hold_expiry() -> Optional[datetime]:
+        """Return the earliest reservation deadline, or None if nothing is reserved."""
+        row = _db().execute("SELECT MIN(until) AS until FROM holds").fetchone()
+        if row["until"] is None:
+                return None
+        return datetime.strptime(row["until"], ISO_FORMAT)
+
+
+@_synchronized
+def release_expired_holds() -> int:
+        """Drop reservations whose deadline has passed."""
+        conn = _db()
+        with _transaction(conn):
+                cur = conn.execute("DELETE FROM holds WHERE until <= ?", (_now(),))
+        return cur.rowcount
+
+
+# Payments
+
+@_synchronized
+def create_pending_payment(payment_id: str, payload: Dict) -> None:
+        conn = _db()
+        with _transaction(conn):
+                _insert_payment(conn, payment_id, payload)
+
+
+@_synchronized
+def _hot_payment(payment_id: str) -> Optional[Dict]:
+        row = _db().execute("SELECT * FROM payments WHERE payment_id = ?", (payment_id,)).fetchone()
+        return _payment_row(row) if row else None
+
+
+def get_payment(payment_id: str) -> Optional[Dict]:
+        # The archive is read outside _lock, like it is written
+        payment = _hot_payment(payment_id)
+        return payment if payment is not None else archive.get_payment(payment_id)
+
+
+@_synchronized
+def list_pending_payments() -> Dict[str, Dict]:
+        """Return payment_id -> payment for every payment still waiting for its invoice."""
+        rows = _db().execute("SELECT * FROM payments WHERE status = 'pending'")
+        return {r["payment_id"]: _payment_row(r) for r in rows}
+
+
+@_synchronized
+def pending_payment_count() -> int:
+        return _db().execute("SELECT COUNT(*) FROM payments WHERE status = 'pending'").fetchone()[0]
+
+
+@_synchronized
+def set_payment_status(payment_id: str, status: str, invoice_id: int = None, expected_status: Optional[str] = None) -> bool:
+        """Update a payment's status. With expected_status, only if the current status matches (compare-and-set)."""
+        sql = "UPDATE payments SET status = ?, invoice_id = COALESCE(?, invoice_id) WHERE payment_id = ?"
+        params = [status, invoice_id, payment_id]
+        if expected_status is not None:
+                sql += " AND status = ?"
+                params.append(expected_status)
+        conn = _db()
+        with _transaction(conn):
+                cur = conn.execute(sql, params)
+        return cur.rowcount > 0
+
+
+def archive_payments(before: datetime, limit: int = 1000) -> int:
+        """See storage.archive_payments. The archive is written without holding the connection."""
+        with _archive_lock:
+                batch = _archivable_payments(before, limit)
+                if not batch:
+                        return 0
+                archive.append_payments(batch)
+                return _drop_archived(batch)
+
+
+@_synchronized
+def _archivable_payments(before: datetime, limit: int) -> List[Tuple[str, Dict]]:
+        batch = []
+        for row in _db().execute("SELECT * FROM payments WHERE status != 'pending' ORDER BY rowid"):
+                payment = _payment_row(row)
+                created = archive.payment_time(row["payment_id"], payment)
+                if created is None or created < before:
+                        batch.append((row["payment_id"], payment))
+                        if len(batch) >= limit:
+                                break
+        return batch
+
+
+@_synchronized
+def _drop_archived(batch: List[Tuple[str, Dict]]) -> int:
+        """Delete archived payments, except ones changed since they were read (by any process)."""
+        conn = _db()
+        archived = dict(batch)
+        dropped = []
+        with _transaction(conn):
+                ids = list(archived)
+                for start in range(0, len(ids), _IN_BATCH):
+                        chunk = ids[start:start + _IN_BATCH]
+                        marks = ",".join("?" * len(chunk))
+                        for row in conn.execute(f"SELECT * FROM payments WHERE payment_id IN ({marks})", chunk):
+                                if _payment_row(row) == archived[row["payment_id"]]:
+                                        dropped.append((row["payment_id"],))
+                conn.executemany("DELETE FROM payments WHERE payment_id = ?", dropped)
+        return len(dropped)
+
+
+# Bulk inventory (see bot/inventory.py)
+
+# Host parameters per IN (...) lookup, below SQLite's historical limit of 999
+_IN_BATCH = 500
+
+
+@_synchronized
+def upsert_numbers(records: List[Dict]) -> Dict[str, int]:
+        """See storage.upsert_numbers. The whole batch is one transaction."""
+        conn = _db()
+        counts = {"added": 0, "updated": 0, "retired": 0, "unchanged": 0, "in_use": 0}
+        now = _now()
+        with _transaction(conn):
+                existing: Dict[str, sqlite3.Row] = {}
+                in_use = set()
+                numbers = [rec["number"] for rec in records]
+                for start in range(0, len(numbers), _IN_BATCH):
+                        batch = numbers[start:start + _IN_BATCH]
+                        marks = ",".join("?" * len(batch))
+                        for row in conn.execute(f"SELECT * FROM numbers WHERE number IN ({marks})", batch):
+                                existing[row["number"]] = row
+                        in_use.update(r["number"] for r in conn.execute(f"SELECT number FROM rentals WHERE number IN ({marks})", batch))
+                        in_use.update(
+                                r["number"]
+                                for r in conn.execute(f"SELECT number FROM holds WHERE number IN ({marks}) AND until > ?", batch + [now])
+                        )
+                inserts, updates = [], []
+                for rec in records:
+                        row = existing.get(rec["number"])
+                        if row is None:
+                                inserts.append(rec)
+                                counts["added"] += 1
+                                continue
+                        if rec["status"] == "retired":
+                                if row["status"] == "retired":
+                                        counts["unchanged"] += 1
+                                elif rec["number"] in in_use:
+                                        counts["in_use"] += 1
+                                else:
+                                        updates.append(("retired", row["category"], row["type"], row["price"], rec["number"]))
+                                        counts["retired"] += 1
+                                continue
+                        status = rec["status"] if row["status"] == "retired" else row["status"]
+                        new = (status, rec["category"], rec["type"], rec["price"])
+                        if new == (row["status"], row["category"], row["type"], row["price"]):
+                                counts["unchanged"] += 1
+                        else:
+                                updates.append(new + (rec["number"],))
+                                counts["updated"] += 1
+                _insert_numbers(conn, inserts)
+                conn.executemany("UPDATE numbers SET status = ?, category = ?, type = ?, price = ? WHERE number = ?", updates)
+                if inserts or updates:
+                        _bump_inventory_version(conn)
+        return counts
+
+
+@_synchronized
+def scan_numbers(after: int = -1, limit: int = 1000) -> Tuple[List[Dict], Optional[int]]:
+        """See storage.scan_numbers; the cursor is a rowid."""
+        rows = _db().execute("SELECT rowid AS pos, * FROM numbers WHERE rowid > ? ORDER BY rowid LIMIT ?", (after, limit)).fetchall()
+        cursor = rows[-1]["pos"] if len(rows) == limit else None
+        return [_number_row(r) for r in rows], cursor
+
+
+# Admin/owner operations
+
+@_synchronized
+def force_rental(user_id: int, number: str, months: int) -> Optional[Dict]:
+        """Force-assign a number to a user. Replaces any existing holder and marks number busy."""
+        conn = _db()
+        with _transaction(conn):
+                if conn.execute("SELECT 1 FROM numbers WHERE number = ?", (number,)).fetchone() is None:
+                        return None
+                conn.execute("DELETE FROM rentals WHERE number = ?", (number,))
+                conn.execute("DELETE FROM holds WHERE number = ?", (number,))
+                conn.execute("UPDATE numbers SET status = 'busy' WHERE number = ?", (number,))
+                _bump_inventory_version(conn)
+                rental = _new_rental(conn, user_id, number, months)
+        _notify_expiry_change()
+        return rental
+
+
+# Promocodes
+
+@_synchronized
+def list_promocodes() -> List[Dict]:
+        """Get all promocodes."""
+        rows = _db().execute("SELECT * FROM promocodes ORDER BY rowid")
+        return [_promocode_row(r) for r in rows]
+
+
+@_synchronized
+def add_promocode(code: str, percent: int, created_by: int) -> Optional[Dict]:
+        """Add new promocode. Returns None if code already exists or percent invalid."""
+        if not (1 <= percent <= 100):
+                return None
+        promocode = {
+                "code": code.upper(),
+                "percent": percent,
+                "active": True,
+                "created_at": datetime.utcnow().strftime(ISO_FORMAT),
+                "created_by": created_by,
+        }
+        conn = _db()
+        with _transaction(conn):
+                cur = conn.execute(
+                        "INSERT OR IGNORE INTO promocodes (code, percent, active, created_at, created_by) VALUES (?, ?, 1, ?, ?)",
+                        (promocode["code"], percent, promocode["created_at"], created_by),
+                )
+        return promocode if cur.rowcount else None
+
+
+@_synchronized
+def get_promocode(code: str) -> Optional[Dict]:
+        """Get promocode by code (case-insensitive). Returns None if not found or inactive."""
+        row = _db().execute("SELECT * FROM promocodes WHERE code = ? AND active = 1", (code.upper(),)).fetchone()
+        return _promocode_row(row) if row else None
+
+
+@_synchronized
+def deactivate_promocode(code: str) -> bool:
+        """Deactivate promocode. Returns True if successful."""
+        conn = _db()
+        with _transaction(conn):
+                cur = conn.execute("UPDATE promocodes SET active = 0 WHERE code = ?", (code.upper(),))
+        return cur.rowcount > 0
+
+
+# Users
+
+@_synchronized
+def register_user(user_id: int, username: str = None) -> Dict:
+        """Register or update user. Returns user data."""
+        now = datetime.utcnow().strftime(ISO_FORMAT)
+        conn = _db()
+        with _transaction(conn):
+                conn.execute(
+                        "INSERT INTO users (user_id, username, first_seen, last_seen) VALUES (?, ?, ?, ?) "
+                        "ON CONFLICT(user_id) DO UPDATE SET last_seen = excluded.last_seen, "
+                        "username = COALESCE(NULLIF(excluded.username, ''), users.username)",
+                        (int(user_id), username, now, now),
+                )
+        return get_user(user_id)
+
+
+@_synchronized
+def get_user(user_id: int) -> Optional[Dict]:
+        """Get user data."""
+        row = _db().execute("SELECT * FROM users WHERE user_id = ?", (int(user_id),)).fetchone()
+        return _user_row(row) if row else None
+
+
+# Leases (leader election between processes)
+
+@_synchronized
+def acquire_lease(name: str, owner: str, ttl: float) -> bool:
+        """Take or renew the lease `name` for ttl seconds. Fails while another owner holds it."""
+        conn = _db()
+        now = time.time()
+        with _transaction(conn):
+                row = conn.execute("SELECT owner, expires FROM leases WHERE name = ?", (name,)).fetchone()
+                if row is not None and row["owner"] != owner and row["expires"] > now:
+                        return False
+                conn.execute("INSERT OR REPLACE INTO leases (name, owner, expires) VALUES (?, ?, ?)", (name, owner, now + ttl))
+        return True
+
+
+@_synchronized
+def release_lease(name: str, owner: str) -> bool:
+        conn = _db()
+        with _transaction(conn):
+                cur = conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+        return cur.rowcount > 0
+
+
+# Checkout sessions shared by all processes (see bot/sessions.py)
+
+@_synchronized
+def load_session(key: str) -> Optional[Tuple[Optional[str], Dict[str, Any]]]:
+        """Return (state, data) of a live session, or None."""
+        row = _db().execute("SELECT state, data FROM checkout_sessions WHERE key = ? AND expires > ?", (key, time.time())).fetchone()
+        if row is None:
+                return None
+        return row["state"], json.loads(row["data"])
+
+
+@_synchronized
+def save_session(key: str, state: Optional[str], data: Dict[str, Any], ttl: float) -> None:
+        """Store a session for ttl seconds; an empty one is deleted."""
+        conn = _db()
+        with _transaction(conn):
+                if state is None and not data:
+                        conn.execute("DELETE FROM checkout_sessions WHERE key = ?", (key,))
+                        return
+                conn.execute(
+                        "INSERT OR REPLACE INTO checkout_sessions (key, state, data, expires) VALUES (?, ?, ?, ?)",
+                        (key, state, json.dumps(data, ensure_ascii=False), time.time() + ttl),
+                )
+
+
+@_synchronized
+def purge_sessions() -> int:
+        conn = _db()
+        with _transaction(conn):
+                cur = conn.execute("DELETE FROM checkout_sessions WHERE expires <= ?", (time.time(),))
+        return cur.rowcount
+
+
+if __name__ == "__main__":
+        if len(sys.argv) < 2 or sys.argv[1] != "import":
+                print("Usage: python -m bot.storage_sqlite import [state.json|state.snap]")
+                sys.exit(2)
+        source = sys.argv[2] if len(sys.argv) > 2 else None
+        counts = import_state(source)
+        print(f"Imported {source or _saved_state_file()} into {SQLITE_FILE}: " + ", ".join(f"{k}={v}" for k, v in counts.items()))
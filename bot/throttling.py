@@ -0,0 +1,207 @@
+"""Rate limiting: token buckets per user and per handler class, and a global
+budget for outbound Crypto Pay calls.
+
+An update that is only slightly over its limit is deferred (the middleware
+sleeps until a token is due); one that would have to wait longer than
+``max_delay`` is dropped. Both are counted per handler class.
+"""
+import asyncio
+import os
+import time
+from collections import Counter, OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional, Tuple
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, Message, TelegramObject
+from .cluster import BOT_WORKERS
+
+
+def _parse_limits(spec: str) -> Dict[str, Tuple[float, float]]:
+        """Parse "class=rate/burst,..." (rate in tokens per second)."""
+        limits = {}
+        for item in filter(None, (part.strip() for part in spec.split(","))):
+                name, _, value = item.partition("=")
+                rate, _, burst = value.partition("/")
+                limits[name.strip()] = (float(rate), float(burst or 1))
+        return limits
+
+
+# Every update from one user
+THROTTLE_USER_RATE = float(os.getenv("THROTTLE_USER_RATE", "1"))
+THROTTLE_USER_BURST = float(os.getenv("THROTTLE_USER_BURST", "5"))
+# Per user and handler class, on top of the user limit: /start writes the user
+# record, "payment" covers invoice creation (including promo code answers) and
+# "Я оплатил" checks
+THROTTLE_CLASS_LIMITS = _parse_limits(os.getenv("THROTTLE_CLASS_LIMITS", "start=0.05/2,payment=0.2/3"))
+# Longest an update is held back before it is dropped instead (seconds)
+THROTTLE_MAX_DELAY = float(os.getenv("THROTTLE_MAX_DELAY", "1"))
+# Users tracked at once; the least recently seen bucket is forgotten first
+THROTTLE_MAX_USERS = int(os.getenv("THROTTLE_MAX_USERS", "100000"))
+
+# Outbound Crypto Pay requests for the whole process
+CRYPTO_PAY_RATE = float(os.getenv("CRYPTO_PAY_RATE", "10"))
+CRYPTO_PAY_BURST = float(os.getenv("CRYPTO_PAY_BURST", "20"))
+CRYPTO_PAY_MAX_WAIT = float(os.getenv("CRYPTO_PAY_MAX_WAIT", "10"))
+
+
+class TokenBucket:
+        """Classic token bucket; tokens may go negative to reserve a future slot."""
+
+        __slots__ = ("rate", "burst", "tokens", "updated")
+
+        def __init__(self, rate: float, burst: float):
+                self.rate = rate
+                self.burst = burst
+                self.tokens = burst
+                self.updated = time.monotonic()
+
+        def _refill(self, now: float) -> None:
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+        def wait_time(self, now: float) -> float:
+                """Seconds until a token is available (0 if one is available now)."""
+                self._refill(now)
+                if self.tokens >= 1:
+                        return 0.0
+                return (1 - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+        def take(self) -> None:
+                self.tokens -= 1
+
+
+def _reserve(buckets: Iterable[TokenBucket], max_wait: float) -> Optional[float]:
+        """Take a token from every bucket if all of them can serve within max_wait.
+
+        Returns the delay to honour, or None (nothing taken) if the request must be dropped.
+        """
+        buckets = list(buckets)
+        now = time.monotonic()
+        delay = max(bucket.wait_time(now) for bucket in buckets)
+        if delay > max_wait:
+                return None
+        for bucket in buckets:
+                bucket.take()
+        return delay
+
+
+def handler_class(event: TelegramObject, state: Optional[str] = None,
+                  payment_states: Iterable[str] = ()) -> str:
+        """Group updates by the kind of work they trigger.
+
+        state is the user's FSM state; a message in one of payment_states
+        (e.g. a promo code answer, which creates an invoice) is a payment.
+        """
+        if isinstance(event, CallbackQuery):
+                action = (event.data or "").split(":", 1)[0]
+                if action in ("paid", "buy", "skip_promo"):
+                        return "payment"
+                return "callback"
+        if isinstance(event, Message):
+                text = event.text or event.caption or ""
+                if text.startswith("/start"):
+                        return "start"
+                if text.startswith("/"):
+                        return "command"
+                if state is not None and state in payment_states:
+                        return "payment"
+        return "message"
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+        """Outer middleware for message and callback_query updates.
+
+        Register the same instance on both observers so a user shares one
+        bucket across update types.
+        """
+
+        def __init__(self, rate: float = THROTTLE_USER_RATE, burst: float = THROTTLE_USER_BURST,
+                     class_limits: Optional[Dict[str, Tuple[float, float]]] = None,
+                     max_delay: float = THROTTLE_MAX_DELAY, max_users: int = THROTTLE_MAX_USERS,
+                     exempt: Iterable[int] = (), payment_states: Iterable[str] = ()):
+                self.rate = rate
+                self.burst = burst
+                self.class_limits = THROTTLE_CLASS_LIMITS if class_limits is None else class_limits
+                self.max_delay = max_delay
+                self.max_users = max_users
+                self.exempt = set(exempt)
+                # FSM states whose messages create invoices
+                self.payment_states = frozenset(payment_states)
+                # user_id -> {None: user bucket, class: class bucket}
+                self._buckets: "OrderedDict[int, Dict[Optional[str], TokenBucket]]" = OrderedDict()
+                self.passed: Counter = Counter()
+                self.deferred: Counter = Counter()
+                self.dropped: Counter = Counter()
+
+        def _user_buckets(self, user_id: int, kind: str) -> Iterable[TokenBucket]:
+                buckets = self._buckets.get(user_id)
+                if buckets is None:
+                        buckets = self._buckets[user_id] = {None: TokenBucket(self.rate, self.burst)}
+                        if len(self._buckets) > self.max_users:
+                                self._buckets.popitem(last=False)
+                else:
+                        self._buckets.move_to_end(user_id)
+                selected = [buckets[None]]
+                if kind in self.class_limits:
+                        if kind not in buckets:
+                                buckets[kind] = TokenBucket(*self.class_limits[kind])
+                        selected.append(buckets[kind])
+                return selected
+
+        async def __call__(
+                self,
+                handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                event: TelegramObject,
+                data: Dict[str, Any],
+        ) -> Any:
+                user = getattr(event, "from_user", None)
+                if user is None or user.id in self.exempt:
+                        return await handler(event, data)
+                # raw_state is set by aiogram's FSM middleware, which runs on the update before this one
+                kind = handler_class(event, data.get("raw_state"), self.payment_states)
+                delay = _reserve(self._user_buckets(user.id, kind), self.max_delay)
+                if delay is None:
+                        self.dropped[kind] += 1
+                        if isinstance(event, CallbackQuery):
+                                # Stop the button spinner; the click itself is ignored
+                                try:
+                                        await event.answer("Слишком много запросов, подождите немного.")
+                                except Exception:
+                                        pass
+                        return None
+                if delay > 0:
+                        self.deferred[kind] += 1
+                        await asyncio.sleep(delay)
+                else:
+                        self.passed[kind] += 1
+                return await handler(event, data)
+
+
+class RateBudget:
+        """Process-wide async token bucket for outbound API calls.
+
+        acquire() waits for a token; it gives up (returns False) when the wait
+        would exceed max_wait, so a burst of clicks cannot queue up minutes of
+        API calls.
+        """
+
+        def __init__(self, rate: float, burst: float, max_wait: float):
+                self.max_wait = max_wait
+                self._bucket = TokenBucket(rate, burst)
+                self.granted = 0
+                self.deferred = 0
+                self.rejected = 0
+
+        async def acquire(self) -> bool:
+                delay = _reserve((self._bucket,), self.max_wait)
+                if delay is None:
+                        self.rejected += 1
+                        return False
+                if delay > 0:
+                        self.deferred += 1
+                        await asyncio.sleep(delay)
+                self.granted += 1
+                return True
+
+
+# Each worker process gets an equal share of the budget
+crypto_pay_budget = RateBudget(CRYPTO_PAY_RATE / BOT_WORKERS, max(1.0, CRYPTO_PAY_BURST / BOT_WORKERS), CRYPTO_PAY_MAX_WAIT)
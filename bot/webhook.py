@@ -0,0 +1,61 @@
+"""Telegram webhook transport: bounded concurrency and graceful drain on shutdown."""
+import asyncio
+import hashlib
+from typing import Any, Dict
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+
+
+def default_secret_token(bot_token: str) -> str:
+        """Secret derived from the bot token, identical on every replica behind a load balancer."""
+        return hashlib.sha256(f"webhook:{bot_token}".encode()).hexdigest()
+
+
+class TelegramWebhookHandler(SimpleRequestHandler):
+        """Feeds webhook updates to the dispatcher in background tasks.
+
+        At most `concurrency` updates are processed at once; further deliveries
+        wait before being acknowledged, which pushes back on Telegram instead of
+        queueing unbounded work. During drain new deliveries get 503 so Telegram
+        redelivers them to a live instance.
+        """
+
+        def __init__(self, dispatcher: Dispatcher, bot: Bot, secret_token: str, concurrency: int, **data: Any):
+                super().__init__(dispatcher=dispatcher, bot=bot, handle_in_background=True, secret_token=secret_token, **data)
+                self._slots = asyncio.Semaphore(concurrency)
+                self._draining = False
+
+        @property
+        def in_flight(self) -> int:
+                return len(self._background_feed_update_tasks)
+
+        async def handle(self, request: web.Request) -> web.Response:
+                if self._draining:
+                        return web.Response(status=503, text="shutting down")
+                return await super().handle(request)
+
+        async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+                update: Dict[str, Any] = await request.json(loads=bot.session.json_loads)
+                await self._slots.acquire()
+                if self._draining:
+                        # Drain started while this update waited for a slot; it is not in drain's
+                        # snapshot and could run after storage is stopped, so let Telegram redeliver it
+                        self._slots.release()
+                        return web.Response(status=503, text="shutting down")
+                task = asyncio.create_task(self._background_feed_update(bot=bot, update=update))
+                self._background_feed_update_tasks.add(task)
+                task.add_done_callback(self._background_feed_update_tasks.discard)
+                task.add_done_callback(lambda _: self._slots.release())
+                return web.json_response({}, dumps=bot.session.json_dumps)
+
+        async def drain(self, timeout: float) -> None:
+                """Stop accepting updates and wait up to timeout seconds for in-flight ones."""
+                self._draining = True
+                tasks = list(self._background_feed_update_tasks)
+                if tasks:
+                        await asyncio.wait(tasks, timeout=timeout)
+
+        async def close(self) -> None:
+                # The bot session is owned and closed by main()
+                pass